@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+""" bench_batch.py [parts] [size-kb] [runs]
+
+Downloads parts files from a local http server (HTTP/1.1 with keep-alive,
+in its own process) once with a curl.CurlSpoon per part and once with a
+single curl.CurlBatchSpoon, prints wall time and cpu time (this process
+and its children, the server isn't counted).
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import curl
+import forks
+
+DEFAULT_PARTS = 50
+DEFAULT_SIZE = 512
+DEFAULT_RUNS = 3
+PORT = 18766
+
+# SimpleHTTPServer, but keeps connections alive
+SERVER = """
+import sys, BaseHTTPServer, SimpleHTTPServer
+handler = SimpleHTTPServer.SimpleHTTPRequestHandler
+handler.protocol_version = 'HTTP/1.1'
+handler.log_message = lambda *args: None
+BaseHTTPServer.HTTPServer(('127.0.0.1', int(sys.argv[1])),
+    handler).serve_forever()
+"""
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage.ru_utime + usage.ru_stime +
+        children.ru_utime + children.ru_stime)
+
+
+def _wait_for_server():
+    for i in xrange(50):
+        try:
+            socket.create_connection(('127.0.0.1', PORT), 1.0).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception("http server didn't start")
+
+
+def _wait(spoon):
+    # a reactor notices the exit right away (update_loop polls for it)
+    reactor = forks.Reactor()
+    reactor.add_spoon(spoon, None)
+    reactor.shutdown()
+    reactor.loop()
+    return spoon.get_status()[forks.RETURN_CODE]
+
+
+def single(parts):
+    for (link, dest) in parts:
+        rc = _wait(curl.CurlSpoon(link, dest))
+        if rc != 0:
+            return rc
+    return 0
+
+
+def batch(parts):
+    return _wait(curl.CurlBatchSpoon(parts))
+
+
+def run(name, download, parts, runs):
+    wall = 0.0
+    cpu = 0.0
+    for i in xrange(runs):
+        start_cpu = _cpu()
+        start = time.time()
+        rc = download(parts)
+        wall += time.time() - start
+        cpu += _cpu() - start_cpu
+        if rc != 0:
+            print "%s failed (rc %d)" % (name, rc)
+    print "%-6s wall=%.3fs cpu=%.3fs (mean of %d)" % (name, wall / runs,
+        cpu / runs, runs)
+
+
+def main(args):
+    count = DEFAULT_PARTS
+    size = DEFAULT_SIZE
+    runs = DEFAULT_RUNS
+    if len(args) > 0:
+        count = int(args[0])
+    if len(args) > 1:
+        size = int(args[1])
+    if len(args) > 2:
+        runs = int(args[2])
+    
+    if not curl.batch_supported():
+        print "curl %d.%d.%d can't download in batches" % curl.curl_version()
+        return
+    
+    tmp = tempfile.mkdtemp()
+    server = None
+    try:
+        parts = []
+        block = os.urandom(size * 1024)
+        for i in xrange(count):
+            name = "bench.part%d.rar" % (i + 1)
+            f = open(os.path.join(tmp, name), 'wb')
+            f.write(block)
+            f.close()
+            parts.append(("http://127.0.0.1:%d/%s" % (PORT, name),
+                os.path.join(tmp, 'out.' + name)))
+        
+        server = subprocess.Popen([sys.executable, '-c', SERVER, str(PORT)],
+            cwd=tmp)
+        _wait_for_server()
+        
+        run('single', single, parts, runs)
+        run('batch', batch, parts, runs)
+    finally:
+        if not (server is None):
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__": main(sys.argv[1:])
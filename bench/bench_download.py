@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+""" bench_download.py [size-mb] [runs]
+
+Downloads a file from a local http server (SimpleHTTPServer in its own
+process) with curl.CurlSpoon and with curl.HttpSpoon and prints wall
+time and cpu time (this process and its children, the server isn't
+counted).
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import curl
+
+DEFAULT_SIZE = 200
+DEFAULT_RUNS = 3
+PORT = 18765
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage.ru_utime + usage.ru_stime +
+        children.ru_utime + children.ru_stime)
+
+
+def _wait_for_server():
+    for i in xrange(50):
+        try:
+            socket.create_connection(('127.0.0.1', PORT), 1.0).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception("http server didn't start")
+
+
+def run(name, create, dest, runs):
+    wall = 0.0
+    cpu = 0.0
+    for i in xrange(runs):
+        start_cpu = _cpu()
+        start = time.time()
+        status = create(dest).update_loop()
+        wall += time.time() - start
+        cpu += _cpu() - start_cpu
+        if status['rc'] != 0:
+            print "%s failed (rc %d)" % (name, status['rc'])
+    print "%-6s wall=%.3fs cpu=%.3fs (mean of %d)" % (name, wall / runs,
+        cpu / runs, runs)
+
+
+def main(args):
+    size = DEFAULT_SIZE
+    runs = DEFAULT_RUNS
+    if len(args) > 0:
+        size = int(args[0])
+    if len(args) > 1:
+        runs = int(args[1])
+    
+    tmp = tempfile.mkdtemp()
+    server = None
+    try:
+        f = open(os.path.join(tmp, 'part.rar'), 'wb')
+        block = os.urandom(1024 * 1024)
+        for i in xrange(size):
+            f.write(block)
+        f.close()
+        
+        server = subprocess.Popen([sys.executable, '-m', 'SimpleHTTPServer',
+            str(PORT)], cwd=tmp, stdout=open(os.devnull, 'w'),
+            stderr=subprocess.STDOUT)
+        _wait_for_server()
+        
+        link = "http://127.0.0.1:%d/part.rar" % PORT
+        dest = os.path.join(tmp, 'out.rar')
+        run('curl', lambda d: curl.CurlSpoon(link, d), dest, runs)
+        run('native', lambda d: curl.HttpSpoon(link, d), dest, runs)
+    finally:
+        if not (server is None):
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__": main(sys.argv[1:])
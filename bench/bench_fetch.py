@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+""" bench_fetch.py [pages] [size-kb] [runs]
+
+Fetches pages from a local fake hoster (an http server in its own
+process) and searches them for the rapidshare link (pfscan.RSDL_LINK_RE)
+once the old way (curl.simple_download, then the regex) and once with
+curl.match_download. Every page is size-kb big, the link is in its
+first KB and the server sends 16 KB every 10 ms like a slow site.
+Prints wall time and bytes read per page. Then checks that the link
+after a form action is found (pfutil.FORM_LINK_RE with its anchor) if
+it's FORM_GAP bytes behind it (more than curl.MATCH_OVERLAP) and
+another link comes before the form.
+"""
+
+import os
+import sys
+import time
+import socket
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import curl
+import pfscan
+import pfutil
+
+DEFAULT_PAGES = 20
+DEFAULT_SIZE = 512
+DEFAULT_RUNS = 3
+PORT = 18768
+FORM_GAP = 40 * 1024
+
+# a page with the link at the beginning, sent slowly
+SERVER = """
+import sys, time, BaseHTTPServer, SocketServer
+size = int(sys.argv[2]) * 1024
+gap = int(sys.argv[3])
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        number = self.path.split('/')[-1]
+        page = ('<html><form action="http://rs%s.rapidshare.com/files/%s/'
+            'bench.part%s.rar"></form>' % (number, number, number))
+        if self.path.startswith('/form/'):
+            page = ('<html><a href="http://other.example.com/x">x</a>'
+                '<form action="/dl" method="post">' + ' ' * gap +
+                '<input value="http://rs%s.rapidshare.com/files/%s/'
+                'bench.part%s.rar"></form>' % (number, number, number))
+        page += ' ' * (size - len(page))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        try:
+            for i in xrange(0, len(page), 16384):
+                self.wfile.write(page[i:i + 16384])
+                self.wfile.flush()
+                time.sleep(0.01)
+        except IOError:
+            pass
+    def log_message(self, *args):
+        pass
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    def handle_error(self, *args):
+        # the client closed the connection early
+        pass
+server(('127.0.0.1', int(sys.argv[1])), handler).serve_forever()
+"""
+
+
+def _wait_for_server():
+    for i in xrange(50):
+        try:
+            socket.create_connection(('127.0.0.1', PORT), 1.0).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception("http server didn't start")
+
+
+def whole(link):
+    data = curl.simple_download(link, '--silent')
+    return (pfscan.RSDL_LINK_RE.search(data), len(data))
+
+
+def matching(link):
+    (match, data) = curl.match_download(link, pfscan.RSDL_LINK_RE)
+    return (match, len(data))
+
+
+def run(name, fetch, links, runs):
+    wall = 0.0
+    size = 0
+    found = 0
+    # curl.simple_download prints every command line
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for i in xrange(runs):
+            start = time.time()
+            for link in links:
+                (match, read) = fetch(link)
+                size += read
+                found += int(not (match is None))
+            wall += time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        
+    print "%-8s wall=%.3fs read=%dk/page found=%d/%d (mean of %d)" % (name,
+        wall / runs, size / 1024 / (runs * len(links)), found / runs,
+        len(links), runs)
+
+
+def check_form():
+    link = "http://127.0.0.1:%d/form/1" % PORT
+    expected = 'rs1.rapidshare.com'
+    for (name, anchor) in (('overlap', None),
+        ('anchor', pfutil.FORM_ACTION_RE)):
+        (match, data) = curl.match_download(link, pfutil.FORM_LINK_RE,
+            anchor=anchor)
+        found = None
+        if not (match is None):
+            found = match.group(1)
+        print "%-8s form link %d bytes away: %s" % (name, FORM_GAP,
+            ['wrong (%s)' % found, 'found'][found == expected])
+
+
+def main(args):
+    count = DEFAULT_PAGES
+    size = DEFAULT_SIZE
+    runs = DEFAULT_RUNS
+    if len(args) > 0:
+        count = int(args[0])
+    if len(args) > 1:
+        size = int(args[1])
+    if len(args) > 2:
+        runs = int(args[2])
+        
+    links = ["http://127.0.0.1:%d/file/%d" % (PORT, i + 1)
+        for i in xrange(count)]
+    server = subprocess.Popen([sys.executable, '-c', SERVER, str(PORT),
+        str(size), str(FORM_GAP)])
+    try:
+        _wait_for_server()
+        run('whole', whole, links, runs)
+        run('matching', matching, links, runs)
+        check_form()
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__": main(sys.argv[1:])
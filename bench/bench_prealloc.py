@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+""" bench_prealloc.py [dir] [files] [size-mb] [runs]
+
+Writes files parts at once into dir (default: a temporary directory)
+like parallel downloads do, once the way curl does (16k writes, files
+grow a little at a time) and once like HttpSpoon does (disk space is
+allocated first, aligned writes of curl.WRITE_BUFFER_SIZE). Slow
+downloads are written back to disk long before they are complete, that
+is simulated by an fdatasync every SYNC_EVERY bytes.
+Afterwards the files are dropped from the page cache and read one after
+another (like unrar reads the volumes), prints read time and number of
+extents (if filefrag is installed).
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import curl
+import forks
+
+DEFAULT_FILES = 4
+DEFAULT_SIZE = 64
+DEFAULT_RUNS = 3
+CURL_WRITE_SIZE = 16 * 1024
+SYNC_EVERY = 256 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def write_files(paths, size, write_size, preallocate):
+    fds = [os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        for path in paths]
+    block = os.urandom(write_size)
+    try:
+        if preallocate:
+            for fd in fds:
+                forks.fallocate(fd, 0, size)
+                
+        written = 0
+        while written < size:
+            # every file gets the next chunk, like interleaved downloads
+            for fd in fds:
+                os.write(fd, block)
+                if (written + write_size) % SYNC_EVERY < write_size:
+                    os.fdatasync(fd)
+            written += write_size
+            
+        for fd in fds:
+            os.fsync(fd)
+            forks.fadvise(fd, 0, 0, forks.FADV_DONTNEED)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def read_files(paths):
+    start = time.time()
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            while os.read(fd, READ_SIZE) != '':
+                pass
+        finally:
+            os.close(fd)
+    return time.time() - start
+
+
+def extents(paths):
+    count = 0
+    for path in paths:
+        try:
+            output = subprocess.Popen(['filefrag', path],
+                stdout=subprocess.PIPE).communicate()[0]
+        except OSError:
+            return None
+        count += int(output.split(':')[-1].split()[0])
+    return count
+
+
+def run(name, directory, count, size, write_size, preallocate, runs):
+    paths = [os.path.join(directory, "bench.part%d.rar" % (i + 1))
+        for i in xrange(count)]
+    read_time = 0.0
+    extent_count = 0
+    
+    for i in xrange(runs):
+        write_files(paths, size, write_size, preallocate)
+        extent_count += extents(paths) or 0
+        read_time += read_files(paths)
+        for path in paths:
+            os.remove(path)
+            
+    print "%-8s read=%.3fs extents=%d (mean of %d)" % (name,
+        read_time / runs, extent_count / runs, runs)
+
+
+def main(args):
+    directory = None
+    count = DEFAULT_FILES
+    size = DEFAULT_SIZE
+    runs = DEFAULT_RUNS
+    if len(args) > 0:
+        directory = args[0]
+    if len(args) > 1:
+        count = int(args[1])
+    if len(args) > 2:
+        size = int(args[2])
+    if len(args) > 3:
+        runs = int(args[3])
+        
+    tmp = tempfile.mkdtemp(dir=directory)
+    try:
+        size = size * 1024 * 1024
+        run('curl', tmp, count, size, CURL_WRITE_SIZE, False, runs)
+        run('prealloc', tmp, count, size, curl.WRITE_BUFFER_SIZE, True, runs)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__": main(sys.argv[1:])
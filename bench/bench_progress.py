@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+""" bench_progress.py [frames] [runs]
+
+Parses a generated curl progress meter (stderr output) once the old way
+(split into frames, FULL_EXTR regex on every frame) and once with
+curl.ProgressParser (newest frame of every chunk only). The output is
+fed in chunks of forks.READ_SIZE bytes (output piled up in the pipe)
+and frame by frame (every read returns one frame).
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import curl
+import forks
+
+DEFAULT_FRAMES = 100000
+DEFAULT_RUNS = 3
+
+# the regex CurlSpoon used before
+FULL_EXTR =("\\s*(\\d{1,3})" +
+            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
+            "\\s*(\\d{1,3})" +
+            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
+            "\\s*(\\d{1,3})" +
+            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
+            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
+            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
+            "\\s*(\\d+[:]{1}\\d+[:]{1}\\d+)" +
+            "\\s*(\\d+[:]{1}\\d+[:]{1}\\d+)" +
+            "\\s*(\\d+[:]{1}\\d+[:]{1}\\d+)" +
+            "\\s*([0-9.]+[k,M,m,G,g]{0,1})\\s*")
+FULL_EXTR_EXPR = re.compile(FULL_EXTR)
+FRAME = ("%3d  195M  %3d %4dM    0     0  12.3M      0  0:00:15  0:00:%02d " +
+    " 0:00:%02d 12.2M\r")
+
+
+def make_frames(count):
+    return [FRAME % (i * 100 / count, i * 100 / count, i * 195 / count,
+        i % 60, 59 - i % 60) for i in xrange(count)]
+
+
+def chunked(frames, size):
+    data = "".join(frames)
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def regex(chunks):
+    rbuf = ''
+    expr = forks._delimiter_expr(forks.LINE_DELIMITERS)
+    parsed = 0
+    for chunk in chunks:
+        rbuf += chunk
+        start = 0
+        for match in expr.finditer(rbuf):
+            re_full = FULL_EXTR_EXPR.search(rbuf[start:match.start()])
+            if not (re_full is None):
+                parsed += 1
+            start = match.end()
+        rbuf = rbuf[start:]
+    return parsed
+
+
+def parser(chunks):
+    progress_parser = curl.ProgressParser()
+    parsed = 0
+    for chunk in chunks:
+        if not (progress_parser.feed(chunk) is None):
+            parsed += 1
+    return parsed
+
+
+def run(name, parse, chunks, runs):
+    best = None
+    for i in xrange(runs):
+        start = time.time()
+        parsed = parse(chunks)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-7s %-7s %.3fs (%d frames decoded, best of %d)" % (name,
+        parse.__name__, best, parsed, runs)
+
+
+def main(args):
+    count = DEFAULT_FRAMES
+    runs = DEFAULT_RUNS
+    if len(args) > 0:
+        count = int(args[0])
+    if len(args) > 1:
+        runs = int(args[1])
+        
+    frames = make_frames(count)
+    for (name, chunks) in (('chunks', chunked(frames, forks.READ_SIZE)),
+        ('frames', frames)):
+        run(name, regex, chunks, runs)
+        run(name, parser, chunks, runs)
+
+if __name__ == "__main__": main(sys.argv[1:])
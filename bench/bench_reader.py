@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+""" bench_reader.py [frames]
+
+Compares the old per-byte reader of forks.Spoon (one select() and one
+read(1) per character) with read_frames. A child process writes curl-like
+progress frames as fast as possible, both readers count their read
+syscalls and the cpu time used by this process is measured.
+"""
+
+import os
+import sys
+import time
+import select
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import forks
+
+FRAME = (" 45  700M   45  315M    0     0  1833k      0  0:06:31" +
+         "  0:02:56  0:03:35 1906k\r")
+DEFAULT_FRAMES = 50000
+
+CHILD = "import sys\nfor i in xrange(%d): sys.stderr.write(%r)\n"
+
+
+class CharSpoon(forks.Spoon):
+    "Reads like the old Spoon.read_char: select() + read(1) per byte."
+    
+    def __init__(self, frames):
+        forks.Spoon.__init__(self)
+        self.frames = 0
+        self.syscalls = 0
+        self._line = ''
+        self.start([sys.executable, '-c', CHILD % (frames, FRAME)],
+            use_stderr=True)
+    
+    def _read_char(self):
+        std_nr = self._stream.fileno()
+        while True:
+            self.syscalls += 1
+            if std_nr in select.select([std_nr], [], [], 1.0)[0]:
+                self.syscalls += 1
+                ch = self._stream.read(1)
+                if ch == '':
+                    self._status[forks.STREAM_OPEN] = False
+                return ch
+    
+    def _update(self):
+        while self._status[forks.STREAM_OPEN]:
+            ch = self._read_char()
+            if ch == '\r' or ch == '\n':
+                self.frames += 1
+                self._line = ''
+                return
+            elif ch != '':
+                self._line += ch
+
+
+class FrameSpoon(forks.Spoon):
+    "Uses read_frames."
+    
+    def __init__(self, frames):
+        forks.Spoon.__init__(self)
+        self.frames = 0
+        self.syscalls = 0
+        self.start([sys.executable, '-c', CHILD % (frames, FRAME)],
+            use_stderr=True)
+    
+    def _fill_buffer(self, wait):
+        # one select() and one os.read() per chunk
+        self.syscalls += 2
+        return forks.Spoon._fill_buffer(self, wait)
+    
+    def _update(self):
+        self.frames += len(self.read_frames(wait=1.0))
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(cls, frames):
+    cpu = _cpu()
+    wall = time.time()
+    spoon = cls(frames)
+    spoon.update_loop()
+    wall = time.time() - wall
+    cpu = _cpu() - cpu
+    print "%-10s frames=%-7d syscalls=%-9d cpu=%.3fs wall=%.3fs" % (
+        cls.__name__, spoon.frames, spoon.syscalls, cpu, wall)
+
+
+def main(args):
+    frames = DEFAULT_FRAMES
+    if len(args) > 0:
+        frames = int(args[0])
+    
+    run(CharSpoon, frames)
+    run(FrameSpoon, frames)
+
+if __name__ == "__main__": main(sys.argv[1:])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+""" bench_resolve.py [links] [hosts] [delay-ms] [runs]
+
+Resolves links with pfscan.resolve_all against a local fake hoster (a
+threaded http server in its own process, every page is delayed by
+delay-ms like a slow site) once one link after another (a pool with one
+worker, like before) and once with the default pfutil.resolver_pool.
+The links are spread over hosts loopback addresses (127.0.0.1,
+127.0.0.2, ...), the pool fetches at most RESOLVE_HOST_LIMIT pages from
+one of them at once. Prints wall time and checks that both return the
+same results in the same order.
+"""
+
+import os
+import sys
+import time
+import socket
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pfutil
+import pfscan
+
+DEFAULT_LINKS = 50
+DEFAULT_HOSTS = 2
+DEFAULT_DELAY = 200
+DEFAULT_RUNS = 3
+PORT = 18767
+
+# answers every path with a page which links to a rapidshare file
+SERVER = """
+import sys, time, threading, BaseHTTPServer, SocketServer
+delay = int(sys.argv[2]) / 1000.0
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(delay)
+        number = self.path.split('/')[-1]
+        page = ('<html><form action="http://rs%s.rapidshare.com/files/%s/'
+            'bench.part%s.rar"></form></html>' % (number, number, number))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+    def log_message(self, *args):
+        pass
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+for address in sys.argv[3:]:
+    thread = threading.Thread(target=server((address, int(sys.argv[1])),
+        handler).serve_forever)
+    thread.daemon = True
+    thread.start()
+while True:
+    time.sleep(60)
+"""
+
+
+def _wait_for_server(address):
+    for i in xrange(50):
+        try:
+            socket.create_connection((address, PORT), 1.0).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception("http server didn't start")
+
+
+def run(name, pool, links, runs):
+    wall = 0.0
+    results = None
+    # curl.simple_download prints every command line, curl its progress
+    stdout = sys.stdout
+    stderr = os.dup(2)
+    sys.stdout = open(os.devnull, 'w')
+    os.dup2(sys.stdout.fileno(), 2)
+    try:
+        for i in xrange(runs):
+            start = time.time()
+            results = pfscan.resolve_all(links, pool)
+            wall += time.time() - start
+    finally:
+        os.dup2(stderr, 2)
+        os.close(stderr)
+        sys.stdout.close()
+        sys.stdout = stdout
+        
+    failed = len([error for (link, result, error) in results
+        if not (error is None)])
+    print "%-10s wall=%.3fs failed=%d (mean of %d)" % (name, wall / runs,
+        failed, runs)
+    return results
+
+
+def main(args):
+    count = DEFAULT_LINKS
+    hosts = DEFAULT_HOSTS
+    delay = DEFAULT_DELAY
+    runs = DEFAULT_RUNS
+    if len(args) > 0:
+        count = int(args[0])
+    if len(args) > 1:
+        hosts = int(args[1])
+    if len(args) > 2:
+        delay = int(args[2])
+    if len(args) > 3:
+        runs = int(args[3])
+        
+    addresses = ["127.0.0.%d" % (i + 1) for i in xrange(hosts)]
+    links = ["http://%s:%d/file/%d" % (addresses[i % hosts], PORT, i + 1)
+        for i in xrange(count)]
+        
+    server = subprocess.Popen([sys.executable, '-c', SERVER, str(PORT),
+        str(delay)] + addresses)
+    try:
+        for address in addresses:
+            _wait_for_server(address)
+            
+        sequential = run('sequential', pfutil.resolver_pool(workers=1),
+            links, runs)
+        pool = run('pool', pfutil.resolver_pool(), links, runs)
+        if sequential != pool:
+            print "results differ"
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__": main(sys.argv[1:])
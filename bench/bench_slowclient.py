@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+""" bench_slowclient.py [updates] [msg-kb]
+
+Runs an info server with one client which reads everything and one
+which has stopped reading (msg-kb of messages are queued for it first,
+more than its socket buffers take), then sends updates status updates
+10 ms apart. Once with blocking sends to one client after another (like
+the info server did before) and once with the current server
+(non-blocking, per client queues). Prints how many updates the reading
+client got within a second after the last one, their mean and max
+delay, how many status messages of the stalled client were coalesced
+and if it was dropped.
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pfinfo
+import pfpacket
+
+DEFAULT_UPDATES = 100
+DEFAULT_MSG_SIZE = 16384
+PORT = 18771
+INTERVAL = 0.01
+
+
+class blocking_server(pfinfo.info_server):
+    "info_server which sends everything to a client before the next one."
+    
+    def _send(self, client):
+        
+        self._lock.acquire()
+        try:
+            client.sock.setblocking(1)
+            while client.pending():
+                if client.buffer == '':
+                    (kind, msg, names) = client.out.popleft()
+                    if kind == pfinfo.SNAPSHOT:
+                        msg = self._snapshot()
+                    elif msg is None:
+                        msg = self._delta(names)
+                    client.buffer = msg
+                client.sock.sendall(client.buffer)
+                client.buffer = ''
+            client.queued = 0
+        except socket.error:
+            self._remove(client)
+        finally:
+            self._lock.release()
+            
+    def _queue(self, client, msg, kind=pfinfo.OTHER, names=None):
+        
+        # nothing is merged, nobody is dropped
+        if not client.pending():
+            client.since = time.time()
+        client.out.append((kind, msg, names))
+
+
+def _reader(sock, arrivals):
+    buf = ''
+    while True:
+        data = sock.recv(65536)
+        if data == '':
+            break
+        buf += data
+        frames = buf.split('\n\n')
+        buf = frames.pop()
+        now = time.time()
+        for frame in frames:
+            if frame.startswith('delta'):
+                arrivals.append(now)
+
+
+def _update(server, pack, updates, sent, stalled, msg_size, found):
+    # messages only for the stalled client
+    server._lock.acquire()
+    try:
+        for client in server._clients:
+            if client.address == stalled.getsockname():
+                found.append(client)
+                for i in xrange(msg_size / 64):
+                    server._queue(client, "msg " + 'x' * 64 * 1024 + '\n\n')
+    finally:
+        server._lock.release()
+    server._wake()
+    time.sleep(0.5)
+    
+    for i in xrange(updates):
+        pack.add("http://rapidshare.com/files/1/bench.part%d.rar" % (i + 2))
+        sent.append(time.time())
+        server.update_status([pack])
+        time.sleep(INTERVAL)
+
+
+def run(name, server_class, updates, msg_size):
+    pack = pfpacket.pf_packet("bench")
+    pack.add("http://rapidshare.com/files/1/bench.part1.rar")
+    server = server_class(PORT)
+    server.update_status([pack])
+    
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect(('127.0.0.1', PORT))
+    reader = socket.create_connection(('127.0.0.1', PORT))
+    arrivals = []
+    thread = threading.Thread(target=_reader, args=(reader, arrivals))
+    thread.daemon = True
+    thread.start()
+    time.sleep(0.5)
+    
+    # sends may block the thread which queues messages
+    sent = []
+    found = []
+    updater = threading.Thread(target=_update, args=(server, pack, updates,
+        sent, stalled, msg_size, found))
+    updater.daemon = True
+    updater.start()
+    updater.join(updates * INTERVAL + 2.0)
+    time.sleep(1.0)
+    
+    got = list(arrivals)
+    delays = [arrival - start for (arrival, start) in zip(got, sent)]
+    # read without the lock, the blocking server holds it until the
+    # stalled client is gone
+    coalesced = found[0].coalesced
+    stalled.close()
+    dropped = server.client_stats()[1]
+    if len(delays) > 0:
+        print "%-9s got %d/%d updates, delay mean %.1fms max %.1fms, " \
+            "coalesced %d, dropped %d" % (name, len(got), updates,
+            sum(delays) * 1000 / len(delays), max(delays) * 1000,
+            coalesced, dropped)
+    else:
+        # update_status waits for the lock the sending thread holds
+        print "%-9s got 0/%d updates, %d sent, coalesced %d, dropped %d" % (
+            name, updates, len(sent), coalesced, dropped)
+            
+    server.kill()
+    reader.close()
+
+
+def main(args):
+    updates = DEFAULT_UPDATES
+    msg_size = DEFAULT_MSG_SIZE
+    if len(args) > 0:
+        updates = int(args[0])
+    if len(args) > 1:
+        msg_size = int(args[1])
+        
+    run('blocking', blocking_server, updates, msg_size)
+    run('queued', pfinfo.info_server, updates, msg_size)
+
+if __name__ == "__main__": main(sys.argv[1:])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+""" bench_spawn.py [rss-mb ...]
+
+Measures how long it takes to start (and reap) a tiny program with
+every forks launcher while this process has grown to rss-mb megabytes
+(default 0, 256 and 1024) and 4 extra threads are running, like a
+long-running pfserver.
+"""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import forks
+
+RUNS = 50
+DEFAULT_SIZES = (0, 256, 1024)
+PAGE = 4096
+
+
+class NullSpoon(forks.Spoon):
+    
+    def _update(self):
+        self.read_frames()
+
+
+def _idle(event):
+    event.wait()
+
+
+def measure(launcher):
+    start = time.time()
+    for i in xrange(RUNS):
+        spoon = NullSpoon()
+        spoon.start(['true'], launcher=launcher)
+        spoon.update_loop(wait=0.001)
+    return (time.time() - start) / RUNS
+
+
+def main(args):
+    sizes = DEFAULT_SIZES
+    if len(args) > 0:
+        sizes = [int(i) for i in args]
+    
+    event = threading.Event()
+    threads = [threading.Thread(target=_idle, args=(event,))
+        for i in xrange(4)]
+    for thread in threads:
+        thread.start()
+    
+    ballast = []
+    allocated = 0
+    try:
+        for size in sizes:
+            chunk = bytearray((size - allocated) * 1024 * 1024)
+            for i in xrange(0, len(chunk), PAGE):
+                chunk[i] = 1
+            ballast.append(chunk)
+            allocated = size
+            
+            results = []
+            for launcher in (forks.LAUNCHER_POPEN, forks.LAUNCHER_SPAWN):
+                results.append("%s %.2fms" % (launcher,
+                    measure(launcher) * 1000))
+            print "rss +%5dM: %s" % (size, ", ".join(results))
+    finally:
+        event.set()
+
+if __name__ == "__main__": main(sys.argv[1:])
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+""" bench_startup.py [links] [finished] [runs]
+
+Measures what pfserver does before it answers commands. First binds a
+port which is in TIME_WAIT (a connection was just closed by the server)
+once with a plain socket (the old way, it failed and slept 60 seconds)
+and once with pfutil.listen. Then loads a cfg directory with links
+pending links (5 parts per packet) in its backup file and finished names
+in its finished file (file_detainer like pfserver, auto sync on every
+link) once the old way (every link replayed before the manager returns,
+was_downloaded reads the finished file every time) and once like now
+(manager returns right away, the links are loaded in the background).
+Prints the time until the manager is ready and until all packets are
+loaded.
+"""
+
+import os
+import sys
+import time
+import errno
+import shutil
+import socket
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pfutil
+import pfdetainer
+import pfmanager
+
+DEFAULT_LINKS = 2000
+DEFAULT_FINISHED = 20000
+DEFAULT_RUNS = 3
+PARTS = 5
+PORT = 18769
+
+
+class old_detainer(pfdetainer.file_detainer):
+    "file_detainer which reads the finished file for every name."
+    
+    def was_downloaded(self, name):
+        
+        self._lock.acquire()
+        try:
+            if name in self._finished:
+                return True
+            elif os.path.exists(self._fin):
+                done = False
+                f = open(self._fin, 'r')
+                for line in f:
+                    if name == line.strip('\r').strip('\n').strip('\r'):
+                        done = True
+                f.close()
+                return done
+        finally:
+            self._lock.release()
+        return False
+
+
+def _time_wait():
+    "Leaves PORT in TIME_WAIT (the server side closes first)."
+    
+    server = pfutil.listen(PORT)
+    client = socket.create_connection(('127.0.0.1', PORT))
+    (conn, address) = server.accept()
+    conn.close()
+    time.sleep(0.1)
+    client.close()
+    server.close()
+
+
+def bind():
+    _time_wait()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        start = time.time()
+        sock.bind(('', PORT))
+        print "%-8s bind=%.3fs" % ('plain', time.time() - start)
+    except socket.error, ex:
+        if ex.errno != errno.EADDRINUSE:
+            raise
+        print "%-8s bind failed (address in use, slept 60s)" % 'plain'
+    sock.close()
+    
+    _time_wait()
+    start = time.time()
+    sock = pfutil.listen(PORT)
+    print "%-8s bind=%.3fs" % ('reuse', time.time() - start)
+    sock.close()
+
+
+def make_cfg(directory, links, finished):
+    f = open(os.path.join(directory, 'backup'), 'w')
+    for i in xrange(links):
+        f.write("http://rapidshare.com/files/%d/bench%d.part%d.rar\n" %
+            (i, i / PARTS, i % PARTS + 1))
+    f.close()
+    
+    f = open(os.path.join(directory, 'finished-packet'), 'w')
+    for i in xrange(finished):
+        f.write("done%d\n" % i)
+    f.close()
+    
+    f = open(os.path.join(directory, 'backup'))
+    backup = f.read()
+    f.close()
+    return backup
+
+
+def old(directory):
+    start = time.time()
+    det = old_detainer(directory, auto_sync_count=1)
+    man = pfmanager.manager({}, det, load_pending=False)
+    for link in det.get_pending():
+        man._add_link(link)
+    ready = time.time() - start
+    man.kill()
+    return (ready, ready, len(man.get_packets()))
+
+
+def background(directory):
+    start = time.time()
+    det = pfdetainer.file_detainer(directory, auto_sync_count=1)
+    man = pfmanager.manager({}, det, load_pending=True)
+    ready = time.time() - start
+    man.wait_loaded()
+    loaded = time.time() - start
+    man.kill()
+    return (ready, loaded, len(man.get_packets()))
+
+
+def run(name, load, directory, backup, runs):
+    ready = 0.0
+    loaded = 0.0
+    for i in xrange(runs):
+        result = load(directory)
+        ready += result[0]
+        loaded += result[1]
+        # the old way rewrites the backup file, start every run the same
+        f = open(os.path.join(directory, 'backup'), 'w')
+        f.write(backup)
+        f.close()
+    print "%-10s ready=%.3fs loaded=%.3fs packets=%d (mean of %d)" % (name,
+        ready / runs, loaded / runs, result[2], runs)
+
+
+def main(args):
+    links = DEFAULT_LINKS
+    finished = DEFAULT_FINISHED
+    runs = DEFAULT_RUNS
+    if len(args) > 0:
+        links = int(args[0])
+    if len(args) > 1:
+        finished = int(args[1])
+    if len(args) > 2:
+        runs = int(args[2])
+        
+    bind()
+    
+    tmp = tempfile.mkdtemp()
+    try:
+        backup = make_cfg(tmp, links, finished)
+        run('old', old, tmp, backup, runs)
+        run('background', background, tmp, backup, runs)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__": main(sys.argv[1:])
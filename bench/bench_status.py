@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+""" bench_status.py [packets] [updates] [clients]
+
+Runs an info server with packets pf_packets and clients connected
+clients, changes one packet before every update (like a download in
+progress) and calls update_status updates times. Once with the old
+update_status (every packet formatted, the whole text sent when it
+changed) and once with the current one (only packets with a new version
+are formatted, a delta is sent). Prints time per update and bytes every
+client received per update.
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pfinfo
+import pfpacket
+
+DEFAULT_PACKETS = 500
+DEFAULT_UPDATES = 200
+DEFAULT_CLIENTS = 4
+PORT = 18770
+
+
+class old_server(pfinfo.info_server):
+    "info_server which formats and sends all packets."
+    
+    def update_status(self, packets, force=False):
+        
+        buffer = ""
+        for i in packets:
+            buffer += "".join((i.get_name(), ' ', i.status(), '\n'))
+            
+        buffer = self._correct_msg(buffer)
+        
+        self._lock.acquire()
+        try:
+            if buffer != getattr(self, '_old_status', '') or force:
+                self._broadcast("status " + buffer + '\n\n')
+                self._old_status = buffer
+        finally:
+            self._lock.release()
+
+
+def _reader(sock, received):
+    while True:
+        data = sock.recv(65536)
+        if data == '':
+            break
+        received[0] += len(data)
+
+
+def run(name, server_class, count, updates, client_count):
+    packets = [pfpacket.pf_packet("bench%d" % i) for i in xrange(count)]
+    for pack in packets:
+        pack.add("http://rapidshare.com/files/1/%s.part1.rar" %
+            pack.get_name())
+            
+    server = server_class(PORT)
+    server.update_status(packets)
+    clients = []
+    for i in xrange(client_count):
+        sock = socket.create_connection(('127.0.0.1', PORT))
+        received = [0]
+        thread = threading.Thread(target=_reader, args=(sock, received))
+        thread.start()
+        clients.append((sock, received, thread))
+    # snapshots of the new clients
+    time.sleep(1.0)
+    before = sum([client[1][0] for client in clients])
+    
+    start = time.time()
+    for i in xrange(updates):
+        pack = packets[i % count]
+        pack.add("http://rapidshare.com/files/1/%s.part%d.rar" %
+            (pack.get_name(), i + 2))
+        server.update_status(packets)
+    elapsed = time.time() - start
+    
+    # everything sent
+    while sum([stats[1] for stats in server.client_stats()[0]]) > 0:
+        time.sleep(0.1)
+    time.sleep(0.5)
+    
+    received = sum([client[1][0] for client in clients]) - before
+    server.kill()
+    for (sock, count, thread) in clients:
+        thread.join()
+        sock.close()
+        
+    print "%-5s %.2fms/update %d bytes/update per client" % (name,
+        elapsed * 1000 / updates, received / updates / client_count)
+
+
+def main(args):
+    count = DEFAULT_PACKETS
+    updates = DEFAULT_UPDATES
+    client_count = DEFAULT_CLIENTS
+    if len(args) > 0:
+        count = int(args[0])
+    if len(args) > 1:
+        updates = int(args[1])
+    if len(args) > 2:
+        client_count = int(args[2])
+        
+    run('full', old_server, count, updates, client_count)
+    run('delta', pfinfo.info_server, count, updates, client_count)
+
+if __name__ == "__main__": main(sys.argv[1:])
@@ -1,23 +1,17 @@
 import re
+import os
+import time
+import select
+import signal
+import errno
+import socket
+import ssl
 import subprocess
+import threading
+import urlparse
 
 import forks
 
-FULL_EXTR =("\\s*(\\d{1,3})" + 
-            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" + 
-            "\\s*(\\d{1,3})" +
-            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
-            "\\s*(\\d{1,3})" +
-            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
-            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
-            "\\s*([0-9.]+[k,M,m,G,g]{0,1})" +
-            "\\s*(\\d+[:]{1}\\d+[:]{1}\\d+)" +
-            "\\s*(\\d+[:]{1}\\d+[:]{1}\\d+)" +
-            "\\s*(\\d+[:]{1}\\d+[:]{1}\\d+)" +
-            "\\s*([0-9.]+[k,M,m,G,g]{0,1})\\s*")
-
-FULL_EXTR_EXPR = re.compile(FULL_EXTR)
-
 PERCENT = 'percent'
 SPEED = 'speed'
 DL_SIZE = 'dlsize'
@@ -25,11 +19,109 @@ TOTAL_SIZE = 'totalsize'
 TIME_LEFT = 'eta'
 
 DEFAULT_WAITTIME = 1
+MIN_CALLBACK_INTERVAL = 0.5
+
+HTTP_CHUNK_SIZE = 256 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+# writes (but the last one) end at a multiple of that (file offset)
+WRITE_ALIGN = 64 * 1024
+HTTP_TIMEOUT = 30.0
+HTTP_MAX_HEADER = 64 * 1024
+PROGRESS_INTERVAL = 0.5
+HEADER_END = '\r\n\r\n'
+STATUS_LINE_RE = re.compile("HTTP/\\d[.]\\d\\s+(\\d{3})")
+CONTENT_RANGE_RE = re.compile("bytes\\s+(\\d+)-(\\d+)/(\\d+)")
+MIN_SEGMENT_SIZE = 1024 * 1024
+# next to a part downloaded in segments: its size and the byte ranges
+# which are still missing
+SEGMENTS_SUFFIX = '.segments'
+PART = 'part'
+ERROR_PAGE = 'errpage'
+# only the beginning of a body is searched for error page signatures
+SNIFF_SIZE = 4096
+# bigger bodies are never error pages
+ERROR_PAGE_MAX_SIZE = 1024 * 1024
+# curl's output is buffered, the file is checked if that much has arrived
+CURL_SNIFF_DELAY = 64 * 1024
+BATCH_MARKER = 'pf-part-done'
+# written to stderr by curl after every part (of a batch)
+BATCH_WRITE_OUT = ('%{stderr}\n' + BATCH_MARKER +
+    ' %{exitcode} %{http_code} %{size_download}\n')
+BATCH_DONE_RE = re.compile(BATCH_MARKER + " (\\d+) (\\d+) (\\d+)")
+# first curl which knows %{stderr} and %{exitcode}
+WRITE_OUT_VERSION = (7, 75, 0)
+CURL_VERSION_RE = re.compile("curl (\\d+)[.](\\d+)[.](\\d+)")
+# a token bucket holds at most this many seconds of its rate
+BUCKET_DEPTH = 0.5
+RATE_RE = re.compile("([0-9.]+)\\s*([kKmMgG]?)$")
+RATE_UNITS = {'' : 1, 'k' : 1024, 'm' : 1024 ** 2, 'g' : 1024 ** 3,
+    't' : 1024 ** 4, 'p' : 1024 ** 5}
+# fields of a progress frame: 3 percent/size pairs, 2 average speeds,
+# 3 times (total, spent, left) and the current speed
+PROGRESS_FIELDS = 12
+# incomplete output which is kept (an incomplete frame is never longer)
+PROGRESS_MAX_PARTIAL = 4096
+UNKNOWN_TIME = '--:--:--'
+# match_download reads at most that much of a page
+PAGE_MAX_SIZE = 256 * 1024
+# longest match a StreamMatcher finds across chunks
+MATCH_OVERLAP = 4096
+
+# same exit codes as curl
+RC_OK = 0
+RC_CONNECT = 7
+RC_PARTIAL = 18
+RC_HTTP = 22
+RC_WRITE = 23
+RC_TIMEOUT = 28
+RC_RANGE = 33
+RC_KILLED = -signal.SIGTERM
+# not a curl code, the server sent an error page (see error_page)
+RC_ERROR_PAGE = 1000
+
+ENGINE_CURL = 'curl'
+ENGINE_NATIVE = 'native'
 
 def _mklist(*elements):
     return elements
 
 
+_curl_version = None
+
+def curl_version():
+    """ curl_version()
+    
+    Returns version of the curl tool as tuple of ints, (0, 0, 0) if it
+    can't be found out (only asks curl once).
+    """
+    
+    global _curl_version
+    if _curl_version is None:
+        try:
+            output = subprocess.Popen(['curl', '--version'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE).communicate()[0]
+        except OSError:
+            output = ''
+        re_version = CURL_VERSION_RE.match(output)
+        if re_version is None:
+            _curl_version = (0, 0, 0)
+        else:
+            _curl_version = tuple([int(value)
+                for value in re_version.groups()])
+    return _curl_version
+
+
+def batch_supported():
+    """ batch_supported()
+    
+    Returns True if curl can tell where a part ends (BATCH_WRITE_OUT),
+    without it there is no CurlBatchSpoon and CurlSpoon has no size.
+    """
+    
+    return curl_version() >= WRITE_OUT_VERSION
+
+
 def simple_download(link, *args):
     """ simple_download(link, *args)
     Just starts curl: 'curl link args[0] args[1] ...'
@@ -43,6 +135,275 @@ def simple_download(link, *args):
     return subp.communicate()[0]
 
 
+class StreamMatcher(object):
+    """ StreamMatcher(expr, overlap=MATCH_OVERLAP, anchor=None)
+    
+    Searches the compiled regex expr in data which is fed chunk by
+    chunk, already searched data isn't searched again (but the last
+    overlap bytes, matches mustn't be longer). A match which ends at
+    the end of the data is only accepted at the end of the stream,
+    more data could extend it. All data is kept in self.data.
+    If expr can match more than overlap bytes, anchor (compiled regex,
+    shorter than overlap) should match its beginning: expr is only
+    searched once anchor has been found and from there on the search
+    always starts at anchor, however far away the end of the match is.
+    """
+    
+    def __init__(self, expr, overlap=MATCH_OVERLAP, anchor=None):
+        
+        self._expr = expr
+        self._overlap = overlap
+        self._anchor = anchor
+        self._anchored = (anchor is None)
+        self._start = 0
+        self.data = ''
+    
+    def feed(self, data, final=False):
+        """ feed(self, data, final=False)
+        
+        Appends data (final: it's the end of the stream), returns the
+        match or None.
+        """
+        
+        self.data += data
+        if not self._anchored:
+            found = self._anchor.search(self.data, self._start)
+            if found is None:
+                self._start = max(self._start,
+                    len(self.data) - self._overlap)
+                return None
+            self._anchored = True
+            self._start = found.start()
+        
+        match = self._expr.search(self.data, self._start)
+        if match is None:
+            # the search starts at anchor until it matches
+            if self._anchor is None:
+                self._start = max(self._start,
+                    len(self.data) - self._overlap)
+            return None
+        
+        if final or match.end() < len(self.data):
+            return match
+        
+        # try again from there when there is more data
+        self._start = match.start()
+        return None
+
+
+def match_download(link, expr, *args, **options):
+    """ match_download(link, expr, *args, max_size=PAGE_MAX_SIZE,
+                       anchor=None)
+    
+    Starts curl like simple_download, but reads its output only until
+    the compiled regex expr matches it (see StreamMatcher, anchor is
+    passed to it) or max_size bytes have been read, then curl is
+    stopped. Returns (match, data), match is None if expr wasn't found,
+    data is the output read so far.
+    """
+    
+    max_size = options.get('max_size', PAGE_MAX_SIZE)
+    
+    subp = subprocess.Popen(_mklist('curl', '--silent', link, *args),
+        stdout=subprocess.PIPE)
+    matcher = StreamMatcher(expr, anchor=options.get('anchor'))
+    match = None
+    try:
+        while match is None and len(matcher.data) < max_size:
+            chunk = os.read(subp.stdout.fileno(),
+                min(forks.READ_SIZE, max_size - len(matcher.data)))
+            match = matcher.feed(chunk, final=(chunk == ''))
+            if chunk == '':
+                break
+    finally:
+        if subp.poll() is None:
+            subp.kill()
+        subp.stdout.close()
+        subp.wait()
+    
+    return (match, matcher.data)
+
+
+def error_page(data, signatures):
+    """ error_page(data, signatures)
+    
+    Returns name of the first signature (dict name -> text) found in
+    data, None if data doesn't look like an error page.
+    """
+    
+    for name in sorted(signatures):
+        if data.find(signatures[name]) >= 0:
+            return name
+    return None
+
+
+def _read_head(path):
+    "Returns first SNIFF_SIZE bytes of file path ('' if it can't be read)."
+    
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return ''
+    try:
+        return f.read(SNIFF_SIZE)
+    finally:
+        f.close()
+
+
+def _resume_offset(dest, args):
+    "Size of dest if curl resumes it (-C in args), else 0."
+    
+    if not ('-C' in args):
+        return 0
+    try:
+        return os.path.getsize(dest)
+    except OSError:
+        return 0
+
+
+def _progress_size(text):
+    "Converts a size or speed of curl's progress meter ('12.3M') to bytes."
+    
+    if text[-1] <= '9':
+        return int(text)
+    return int(float(text[:-1]) * RATE_UNITS[text[-1].lower()])
+
+
+def _progress_time(text):
+    "Converts a time of curl's progress meter ('0:01:02') to seconds."
+    
+    if text == UNKNOWN_TIME:
+        return None
+    (hours, minutes, seconds) = text.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def _progress_times(fields):
+    """ _progress_times(fields)
+    
+    Converts the time fields of a progress frame (like _progress_time,
+    long times are '3d 04h' (two fields) or '125d') to seconds.
+    """
+    
+    times = []
+    i = 0
+    while i < len(fields):
+        field = fields[i]
+        if field.endswith('d'):
+            seconds = int(field[:-1]) * 86400
+            if i + 1 < len(fields) and fields[i + 1].endswith('h'):
+                i += 1
+                seconds += int(fields[i][:-1]) * 3600
+            times.append(seconds)
+        else:
+            times.append(_progress_time(field))
+        i += 1
+    return times
+
+
+class ProgressParser(object):
+    """ ProgressParser
+    
+    Decodes the progress meter curl writes to stderr. Feed it raw chunks
+    of output, it splits them into frames (terminated by '\r' or '\n'),
+    keeps the incomplete rest and decodes only the newest complete
+    progress frame (older ones are outdated anyway). Values are integers:
+    sizes in bytes, speeds in bytes per second, times in seconds (None if
+    curl doesn't know yet).
+    If marker is set, complete frames starting with it are collected
+    (take_marks) and, if reset is True, only progress frames after the
+    last one count.
+    """
+    
+    def __init__(self, marker=None, reset=True):
+        
+        self._partial = ''
+        self._marker = marker
+        self._reset = reset
+        self._marks = []
+    
+    def feed(self, data, final=False):
+        """ feed(self, data, final=False)
+        
+        Returns dict (status keys like PERCENT) of the newest progress
+        frame in data (and the incomplete frame of the last call), None
+        if there is none. Final means the stream has ended, so the
+        incomplete frame is complete.
+        """
+        
+        data = self._partial + data
+        if final:
+            data += '\n'
+        
+        end = max(data.rfind('\r'), data.rfind('\n'))
+        self._partial = data[end + 1:][-PROGRESS_MAX_PARTIAL:]
+        if end < 0:
+            return None
+        
+        start = 0
+        if not (self._marker is None):
+            start = self._collect_marks(data, end)
+            if not self._reset:
+                start = 0
+        
+        # frames from the newest one back to start, the newest is
+        # usually a progress frame
+        while end > start:
+            begin = max(data.rfind('\r', start, end),
+                data.rfind('\n', start, end), start - 1) + 1
+            progress = self._decode(data[begin:end])
+            if not (progress is None):
+                return progress
+            end = begin - 1
+        
+        return None
+    
+    def _collect_marks(self, data, end):
+        "Collects marker frames before end, returns where the last ends."
+        
+        start = 0
+        pos = data.find(self._marker, 0, end)
+        while pos >= 0:
+            frame_end = data.find('\n', pos, end + 1)
+            if frame_end < 0:
+                frame_end = data.find('\r', pos, end + 1)
+            self._marks.append(data[pos:frame_end])
+            start = frame_end + 1
+            pos = data.find(self._marker, start, end)
+        return start
+    
+    def take_marks(self):
+        "Returns (and forgets) marker frames collected so far."
+        
+        marks = self._marks
+        self._marks = []
+        return marks
+    
+    def _decode(self, frame):
+        
+        fields = frame.split()
+        if len(fields) < PROGRESS_FIELDS or not fields[0].isdigit():
+            return None
+        
+        try:
+            if len(fields) == PROGRESS_FIELDS:
+                time_left = _progress_time(fields[10])
+            else:
+                # days have two fields
+                times = _progress_times(fields[8:-1])
+                if len(times) != 3:
+                    return None
+                time_left = times[2]
+            
+            return {PERCENT : int(fields[2]),
+                TOTAL_SIZE : _progress_size(fields[1]),
+                DL_SIZE : _progress_size(fields[3]),
+                SPEED : _progress_size(fields[-1]),
+                TIME_LEFT : time_left}
+        except (ValueError, KeyError):
+            return None
+
+
 class CurlSpoon(forks.Spoon):
     """ CurlSpoon
     This is a download class which uses the tool curl to download stuff.
@@ -55,49 +416,1000 @@ class CurlSpoon(forks.Spoon):
     with some threading.RLock() ...
     """
     
-    def __init__(self, link, dest, args=[], cookie=None):
+    def __init__(self, link, dest, args=[], cookie=None, profile=None,
+        signatures=None):
         """ __init__(self, link, dest, *args)
         This constructor starts downloading link and safes it to 
         dest (file). Args will be passed to curl tool.
+        Profile (forks.ResourceProfile) is applied to the curl process.
+        Sizes and speeds in the status are bytes (per second) and eta
+        is in seconds, just like HttpSpoon ('???' until curl knows them).
+        If the beginning of dest matches one of signatures (see
+        error_page) curl is stopped and error_page is set to its name.
+        Size is the size dest should have in the end (like the one of
+        HttpSpoon), None until curl is done (or if it's too old to tell,
+        see batch_supported).
         """
         
         forks.Spoon.__init__(self)
+        # the marker is curl's last line, the progress before it counts
+        self._parser = ProgressParser(marker=BATCH_MARKER, reset=False)
+        self._dest = dest
+        self._signatures = signatures
+        self._sniffed = not signatures
+        self.error_page = None
+        self.size = None
+        self._offset = _resume_offset(dest, args)
         self._status[PERCENT] = 0
         self._status[SPEED] = '???'
         self._status[DL_SIZE] = '???'
         self._status[TOTAL_SIZE] = '???'
         self._status[TIME_LEFT] = '???'
-        self._line = ""
+        self.set_callback_policy(min_interval=MIN_CALLBACK_INTERVAL,
+            changes_only=True)
         
+        if batch_supported():
+            args = _mklist('--write-out', BATCH_WRITE_OUT, *args)
         if cookie is None:
             args = _mklist('curl', link, '-o', dest, *args)
         else:
             args = _mklist('curl', link, '-o', dest, '--cookie', '-',
                             *args)
         
-        self.start(args, in_data=cookie, use_stderr=True)
+        self.start(args, in_data=cookie, use_stderr=True, profile=profile)
     
-    def _read_line(self):
+    def _read_progress(self):
+        "Reads one chunk of output, returns newest progress (or None)."
         
-        while self._status[forks.STREAM_OPEN]:
-            
-            ch = self.read_char(wait=DEFAULT_WAITTIME)
+        data = self.read_chunk(wait=DEFAULT_WAITTIME)
+        return self._parser.feed(data,
+            final=not self._status[forks.STREAM_OPEN])
+    
+    def _set_progress(self, progress):
+        
+        for (key, value) in progress.iteritems():
+            if value is None:
+                value = '???'
+            self._status[key] = value
+    
+    def _sniff(self, dest, finished=False):
+        """ _sniff(self, dest, finished=False)
+        
+        Checks (once) if dest is an error page as soon as enough has been
+        received (or curl has finished dest), returns its name or None.
+        """
+        
+        if self._sniffed:
+            return None
+        
+        total = self._status[TOTAL_SIZE]
+        if isinstance(total, int) and total > ERROR_PAGE_MAX_SIZE:
+            self._sniffed = True
+            return None
+        
+        received = self._status[DL_SIZE]
+        if not finished and not (isinstance(received, int) and
+            received >= CURL_SNIFF_DELAY):
+            return None
+        
+        self._sniffed = True
+        name = error_page(_read_head(dest), self._signatures)
+        if not (name is None):
+            self.error_page = name
+            self._status[ERROR_PAGE] = name
+        return name
+    
+    def _update(self):
+        
+        progress = self._read_progress()
+        if not (progress is None):
+            self._set_progress(progress)
+        
+        for mark in self._parser.take_marks():
+            re_done = BATCH_DONE_RE.match(mark)
+            if not (re_done is None):
+                # what curl received of a resumed download comes after
+                # what was there
+                self.size = self._offset + int(re_done.group(3))
+        
+        if not (self._sniff(self._dest,
+            finished=not self._status[forks.STREAM_OPEN]) is None):
+            self.kill()
+
+
+class CurlBatchSpoon(CurlSpoon):
+    """ CurlBatchSpoon
+    Downloads several links with one curl process, so the connection
+    (and DNS, TLS, ...) to a host is reused for all of them. Progress
+    fields are those of the current part (PART), the result of every
+    finished part is appended to results as (link, dest, rc, http_code,
+    size), size is the one of CurlSpoon (None if curl was stopped).
+    A part which is an error page ends the batch (rc RC_ERROR_PAGE).
+    Needs curl >= 7.75 (see batch_supported).
+    """
+    
+    def __init__(self, parts, args=[], cookie=None, profile=None,
+        signatures=None):
+        """ __init__(self, parts, args=[], cookie=None, profile=None,
+                     signatures=None)
+        
+        Starts downloading parts, a list of (link, dest) tuples, args are
+        passed to curl and apply to all parts, signatures are the ones
+        of CurlSpoon.
+        """
+        
+        self.parts = list(parts)
+        self.results = []
+        self._signatures = signatures
+        self.error_page = None
+        # curl hasn't touched any part yet
+        self._offsets = [_resume_offset(dest, args)
+            for (link, dest) in self.parts]
+        
+        curl_args = ['curl', '--write-out', BATCH_WRITE_OUT]
+        for (link, dest) in self.parts:
+            curl_args.extend((link, '-o', dest))
+        if not (cookie is None):
+            curl_args.extend(('--cookie', '-'))
+        curl_args.extend(args)
+        
+        forks.Spoon.__init__(self)
+        self._parser = ProgressParser(marker=BATCH_MARKER)
+        self._reset_progress()
+        self.set_callback_policy(min_interval=MIN_CALLBACK_INTERVAL,
+            changes_only=True)
+        
+        self.start(curl_args, in_data=cookie, use_stderr=True,
+            profile=profile)
+    
+    def _reset_progress(self):
+        
+        self._sniffed = not self._signatures
+        self._status[PERCENT] = 0
+        self._status[SPEED] = '???'
+        self._status[DL_SIZE] = '???'
+        self._status[TOTAL_SIZE] = '???'
+        self._status[TIME_LEFT] = '???'
+        
+        done = len(self.results)
+        if done < len(self.parts):
+            self._status[PART] = "%d/%d %s" % (done + 1, len(self.parts),
+                os.path.basename(self.parts[done][1]))
+        else:
+            self._status[PART] = "%d/%d" % (done, len(self.parts))
+    
+    def _update(self):
+        
+        progress = self._read_progress()
+        
+        for mark in self._parser.take_marks():
+            re_done = BATCH_DONE_RE.match(mark)
+            if re_done is None or len(self.results) >= len(self.parts):
+                continue
             
-            if ch == '\r' or ch == '\n':
-                re_full = FULL_EXTR_EXPR.search(self._line)
-                if not (re_full is None):
-                    self._status[PERCENT] = int(re_full.group(3))
-                    self._status[SPEED] = re_full.group(12)
-                    self._status[TOTAL_SIZE] = re_full.group(2)
-                    self._status[DL_SIZE] = re_full.group(4)
-                    self._status[TIME_LEFT] = re_full.group(11)
-                    self._line = ''
-                    return True
-            elif ch != '':
-                self._line += ch
+            (link, dest) = self.parts[len(self.results)]
+            rc = int(re_done.group(1))
+            if not (self._sniff(dest, finished=True) is None):
+                rc = RC_ERROR_PAGE
+            size = self._offsets[len(self.results)] + int(re_done.group(3))
+            self.results.append((link, dest, rc, int(re_done.group(2)),
+                size))
+            if rc == RC_ERROR_PAGE:
+                self.kill()
+                return
+            self._reset_progress()
         
-        return False
+        # progress is of a frame after the last mark
+        if not (progress is None):
+            self._set_progress(progress)
+        
+        if len(self.results) < len(self.parts):
+            (link, dest) = self.parts[len(self.results)]
+            if not (self._sniff(dest) is None):
+                self.results.append((link, dest, RC_ERROR_PAGE, 0, None))
+                self.kill()
+
+
+def parse_rate(text):
+    """ parse_rate(text)
+    
+    Parses a rate like curl's --limit-rate does ('200k', '1.5M', ...),
+    returns bytes per second, raises ValueError.
+    """
+    
+    re_rate = RATE_RE.match(text.strip())
+    if re_rate is None:
+        raise ValueError("invalid rate: %s" % text)
+    return int(float(re_rate.group(1)) * RATE_UNITS[re_rate.group(2).lower()])
+
+
+def format_rate(rate):
+    "Formats bytes per second like curl (e.g. '200k'), 0 is 'unlimited'."
+    
+    if rate <= 0:
+        return 'unlimited'
+    for unit in ('g', 'm', 'k'):
+        if rate >= RATE_UNITS[unit]:
+            return "%.1f%s" % (float(rate) / RATE_UNITS[unit], unit.upper())
+    return str(rate)
+
+
+class TokenBucket(object):
+    """ TokenBucket
+    
+    Limits the read rate (bytes per second) of in-process downloads, a
+    rate of 0 means unlimited. Tokens are refilled continuously up to
+    BUCKET_DEPTH seconds of the rate. The rate can be changed by another
+    thread, the tokens are only used by the reactor thread (several
+    spoons may share one bucket, e.g. SegmentedDownload).
+    """
+    
+    def __init__(self, rate=0):
+        
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._tokens = rate * BUCKET_DEPTH
+        self._stamp = time.time()
+    
+    def _refill(self):
+        
+        now = time.time()
+        self._tokens = min(self._tokens + (now - self._stamp) * self._rate,
+            self._rate * BUCKET_DEPTH)
+        self._stamp = now
+    
+    def _quantum(self, count):
+        "Don't read less than that (no tiny reads at low rates)."
+        
+        return max(1, min(count, int(self._rate * BUCKET_DEPTH / 2)))
+    
+    def set_rate(self, rate):
+        
+        self._lock.acquire()
+        try:
+            self._refill()
+            self._rate = rate
+            self._tokens = min(self._tokens, rate * BUCKET_DEPTH)
+        finally:
+            self._lock.release()
+    
+    def get_rate(self):
+        
+        self._lock.acquire()
+        try:
+            return self._rate
+        finally:
+            self._lock.release()
+    
+    def take(self, count):
+        """ take(self, count)
+        
+        Returns number of bytes (at most count) which may be read now, 0
+        if the reader has to wait (see wait_time). Call consume with the
+        number of bytes which have actually been read.
+        """
+        
+        self._lock.acquire()
+        try:
+            if self._rate <= 0:
+                return count
+            self._refill()
+            if self._tokens < self._quantum(count):
+                return 0
+            return min(count, int(self._tokens))
+        finally:
+            self._lock.release()
+    
+    def consume(self, count):
+        
+        self._lock.acquire()
+        try:
+            if self._rate > 0:
+                self._tokens -= count
+        finally:
+            self._lock.release()
+    
+    def wait_time(self, count):
+        "Seconds until take(count) returns something."
+        
+        self._lock.acquire()
+        try:
+            if self._rate <= 0:
+                return 0.0
+            self._refill()
+            return max(0.0, (self._quantum(count) - self._tokens) / self._rate)
+        finally:
+            self._lock.release()
+
+
+def cookie_header(data, host):
+    """ cookie_header(data, host)
+    
+    Returns value of a 'Cookie' header for host from data which is either
+    a cookie file (netscape format, like curl uses) or just name=value
+    lines. Returns None if there is no cookie for host.
+    """
+    
+    cookies = []
+    
+    for line in data.split('\n'):
+        line = line.strip('\r').strip()
+        if line == '' or line.startswith('#'):
+            continue
+        
+        fields = line.split('\t')
+        if len(fields) >= 7:
+            domain = fields[0].lstrip('.')
+            if host == domain or host.endswith('.' + domain):
+                cookies.append("%s=%s" % (fields[5], fields[6]))
+        elif '=' in line:
+            cookies.append(line.strip(';'))
+    
+    if len(cookies) <= 0:
+        return None
+    return "; ".join(cookies)
+
+
+def _read_header(sock):
+    """ _read_header(sock)
+    
+    Reads a response header, returns (status, header, data) where header
+    is a dict (lower case keys) and data is what has already been
+    received after the header.
+    """
+    
+    data = ''
+    pos = -1
+    
+    while pos < 0:
+        chunk = sock.recv(HTTP_CHUNK_SIZE)
+        if chunk == '' or len(data) > HTTP_MAX_HEADER:
+            raise socket.error("no valid response header")
+        start = max(0, len(data) - 3)
+        data += chunk
+        pos = data.find(HEADER_END, start)
+    
+    lines = data[:pos].split('\r\n')
+    re_status = STATUS_LINE_RE.match(lines[0])
+    if re_status is None:
+        raise socket.error("no valid response header")
+    
+    header = {}
+    for line in lines[1:]:
+        (key, sep, value) = line.partition(':')
+        header[key.strip().lower()] = value.strip()
+    
+    return (int(re_status.group(1)), header, data[pos + len(HEADER_END):])
+
+
+def native_supported(link):
+    """ native_supported(link)
+    
+    Returns False if link can't be downloaded with ENGINE_NATIVE (https
+    needs certificate checks, python >= 2.7.9), curl has to be used.
+    """
+    
+    return (urlparse.urlsplit(link).scheme != 'https' or
+        hasattr(ssl, 'create_default_context'))
+
+
+_ssl_context = None
+
+def _wrap_ssl(sock, hostname):
+    "Returns sock wrapped in a verified ssl connection to hostname."
+    
+    global _ssl_context
+    if not native_supported('https:'):
+        sock.close()
+        raise socket.error("no certificate checks in this python")
+    if _ssl_context is None:
+        # loads the system certificates, done only once
+        _ssl_context = ssl.create_default_context()
+    
+    try:
+        return _ssl_context.wrap_socket(sock, server_hostname=hostname)
+    except ssl.CertificateError, ex:
+        sock.close()
+        raise socket.error("certificate error: %s" % ex)
+    except:
+        sock.close()
+        raise
+
+
+def http_get(link, cookie=None, headers=[]):
+    """ http_get(link, cookie=None, headers=[])
+    
+    Sends a GET request for link (HTTP/1.0, so the body is never
+    chunked), cookie is a cookie file (see cookie_header) and headers
+    are additional header lines. Returns (sock, status, header, data)
+    after the response header has been read (see _read_header), raises
+    socket.error (or socket.timeout). The certificate of an https
+    server is verified (see native_supported).
+    """
+    
+    url = urlparse.urlsplit(link)
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    
+    request = ["GET %s HTTP/1.0" % path, "Host: %s" % url.netloc,
+        "User-Agent: pfserver", "Accept: */*"]
+    if not (cookie is None):
+        value = cookie_header(cookie, url.hostname)
+        if not (value is None):
+            request.append("Cookie: %s" % value)
+    request.extend(headers)
+    request.append('')
+    request.append('')
+    
+    if url.scheme == 'https':
+        sock = socket.create_connection((url.hostname, url.port or 443),
+            HTTP_TIMEOUT)
+        sock = _wrap_ssl(sock, url.hostname)
+    else:
+        sock = socket.create_connection((url.hostname, url.port or 80),
+            HTTP_TIMEOUT)
+    
+    try:
+        sock.sendall("\r\n".join(request))
+        (status, header, data) = _read_header(sock)
+    except:
+        sock.close()
+        raise
+    
+    return (sock, status, header, data)
+
+
+def read_segments(dest):
+    """ read_segments(dest)
+    
+    Returns the byte ranges [(first, last), ...] SegmentedDownload still
+    has to fetch to complete dest, None if dest isn't a partial
+    segmented download (or it has been changed since).
+    """
+    
+    try:
+        f = open(dest + SEGMENTS_SUFFIX, 'r')
+        try:
+            lines = f.read().split('\n')
+        finally:
+            f.close()
+        total = int(lines[0])
+        ranges = [tuple([int(value) for value in line.split()])
+            for line in lines[1:] if line.strip()]
+        if os.path.getsize(dest) != total:
+            return None
+    except (IOError, OSError, ValueError):
+        return None
+    
+    if len([r for r in ranges if len(r) != 2]) > 0:
+        return None
+    return ranges
+
+
+def _write_segments(dest, total, ranges):
+    "Stores the missing ranges of dest (see read_segments)."
+    
+    path = dest + SEGMENTS_SUFFIX
+    if len(ranges) <= 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    
+    f = open(path + '.tmp', 'w')
+    try:
+        f.write("%d\n" % total)
+        for (first, last) in ranges:
+            f.write("%d %d\n" % (first, last))
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+
+def probe_size(link, cookie=None):
+    """ probe_size(link, cookie=None)
+    
+    Returns size of link if the server supports byte ranges, else None.
+    """
+    
+    try:
+        (sock, status, header, data) = http_get(link, cookie,
+            ["Range: bytes=0-0"])
+        sock.close()
+    except socket.error:
+        return None
+    
+    if status != 206:
+        return None
+    
+    re_range = CONTENT_RANGE_RE.match(header.get('content-range', ''))
+    if re_range is None or int(re_range.group(1)) != 0:
+        return None
+    return int(re_range.group(3))
+
+
+class HttpSpoon(forks.Spoon):
+    """ HttpSpoon
+    
+    Downloads link to dest without an external program, provides the
+    same status keys as CurlSpoon (but sizes and speed in bytes, eta in
+    seconds). The body is read with recv_into into one reusable write
+    buffer, which is written to dest whenever it's (nearly) full, at
+    offsets aligned to WRITE_ALIGN. If the size is known, disk space for
+    the whole body is allocated first. Connecting and reading the
+    response header (with HTTP_TIMEOUT) happens in its own thread (see
+    forks.Call), the stream of the spoon is the one of the call until
+    then. HttpSpoon can be used like any other spoon (update_loop,
+    forks.Reactor), a reactor thread never waits for a server.
+    Return codes are the ones curl would use (RC_OK, RC_HTTP, ...),
+    like curl (without -f) the body of an error response is written too.
+    A body which is an error page (see error_page) isn't written, the
+    download ends with RC_ERROR_PAGE as soon as it's recognized.
+    """
+    
+    def __init__(self, link, dest, cookie=None, profile=None, first=None,
+        last=None, bucket=None, write_buffer=WRITE_BUFFER_SIZE,
+        signatures=None):
+        """ __init__(self, link, dest, cookie=None, profile=None,
+                     first=None, last=None, bucket=None,
+                     write_buffer=WRITE_BUFFER_SIZE, signatures=None)
+        
+        Starts downloading link to dest. Cookie is a cookie file (see
+        cookie_header), profile is ignored (there is no process).
+        If first is set, only bytes first..last (inclusive, last=None
+        means up to the end, e.g. to resume) are requested and written at
+        the same offset of dest (which isn't truncated then). If the
+        server ignores the range, the download ends with RC_RANGE.
+        After the header has been received, total is the size of the
+        response body and size is the size of the whole file (if known).
+        Bucket (TokenBucket) limits the rate the body is read with,
+        write_buffer is the size of the write buffer (at least
+        HTTP_CHUNK_SIZE). Signatures (dict name -> text) are searched in
+        the first SNIFF_SIZE bytes of a body of at most ERROR_PAGE_MAX_SIZE
+        bytes (only if first isn't set), the name of the one which matched
+        is stored in error_page.
+        """
+        
+        forks.Spoon.__init__(self)
+        self._status[PERCENT] = 0
+        self._status[SPEED] = 0
+        self._status[DL_SIZE] = 0
+        self._status[TOTAL_SIZE] = '???'
+        self._status[TIME_LEFT] = '???'
+        self._status[forks.RUNNING] = True
+        self.set_callback_policy(min_interval=MIN_CALLBACK_INTERVAL,
+            changes_only=True)
+        
+        self.received = 0
+        self.total = None
+        self.size = None
+        self.http_status = None
+        self._buffer = bytearray(max(write_buffer, HTTP_CHUNK_SIZE))
+        self._chunk = memoryview(self._buffer)
+        self._filled = 0
+        self._offset = first or 0
+        self._sock = None
+        self._fd = None
+        self._rc = None
+        self._start_time = time.time()
+        self._next_progress = 0.0
+        self._speed_mark = (self._start_time, 0)
+        self._first = first
+        self._last = last
+        self.bucket = bucket
+        self.error_page = None
+        self._signatures = signatures
+        self._sniff_data = None
+        self._dest = dest
+        
+        headers = []
+        if not (self._first is None):
+            if self._last is None:
+                headers.append("Range: bytes=%d-" % self._first)
+            else:
+                headers.append("Range: bytes=%d-%d" % (self._first,
+                    self._last))
+        
+        self._call = forks.Call(http_get, (link, cookie, headers),
+            discard=lambda response: response[0].close())
+        self._stream = self._call._stream
+    
+    def _connect(self):
+        "Takes over the response of the call (once it has returned)."
+        
+        error = self._call.error
+        if isinstance(error, socket.timeout):
+            self._done(RC_TIMEOUT)
+            return
+        elif not (error is None):
+            self._done(RC_CONNECT)
+            return
+        
+        (sock, self.http_status, header, body) = self._call.result
+        
+        try:
+            self.total = int(header.get('content-length'))
+            self._status[TOTAL_SIZE] = self.total
+            self.size = self.total
+        except (TypeError, ValueError):
+            pass
+        
+        flags = os.O_WRONLY | os.O_CREAT
+        if self._first is None:
+            flags |= os.O_TRUNC
+            # the whole file replaces a segmented download
+            if os.path.exists(self._dest + SEGMENTS_SUFFIX):
+                os.remove(self._dest + SEGMENTS_SUFFIX)
+        else:
+            re_range = CONTENT_RANGE_RE.match(header.get('content-range', ''))
+            if self.http_status != 206 or re_range is None or (
+                int(re_range.group(1)) != self._first):
+                # server ignored range, don't overwrite other segments
+                sock.close()
+                self._done(RC_RANGE)
+                return
+            self.size = int(re_range.group(3))
+        
+        try:
+            self._fd = os.open(self._dest, flags, 0644)
+            if not (self._first is None):
+                os.lseek(self._fd, self._first, os.SEEK_SET)
+        except OSError:
+            sock.close()
+            self._done(RC_WRITE)
+            return
+        
+        # hosters send error pages under the name of the file with any
+        # content type, only the size tells them apart
+        if self._signatures and self._first is None and (
+            self.total is None or self.total <= ERROR_PAGE_MAX_SIZE):
+            self._sniff_data = ''
+        
+        if self._last is None and not (self.size is None):
+            # segments are allocated by SegmentedDownload
+            forks.fallocate(self._fd, self._offset, self.size - self._offset)
+        
+        self._sock = sock
+        self._stream = sock
+        sock.setblocking(0)
+        
+        try:
+            while body and self._rc is None:
+                count = min(len(body), len(self._buffer) - self._filled)
+                self._buffer[self._filled:self._filled + count] = body[:count]
+                body = body[count:]
+                self._received(count)
+        except OSError:
+            self._done(RC_WRITE)
+            return
+        self._check_complete()
+    
+    def _received(self, count):
+        "Count bytes have been put into the write buffer."
+        
+        if not (self._sniff_data is None):
+            missing = SNIFF_SIZE - len(self._sniff_data)
+            self._sniff_data += str(self._buffer[self._filled:
+                self._filled + min(count, missing)])
+            if len(self._sniff_data) >= SNIFF_SIZE:
+                if self._check_error_page():
+                    self._done(RC_ERROR_PAGE)
+                    return
+        
+        self._filled += count
+        self.received += count
+        if len(self._buffer) - self._filled < HTTP_CHUNK_SIZE:
+            self._flush()
+    
+    def _check_error_page(self):
+        "Checks the sniffed beginning of the body (once)."
+        
+        data = self._sniff_data
+        self._sniff_data = None
+        self.error_page = error_page(data, self._signatures)
+        if self.error_page is None:
+            return False
+        
+        self._status[ERROR_PAGE] = self.error_page
+        return True
+    
+    def _flush(self, everything=False):
+        """ _flush(self, everything=False)
+        
+        Writes the write buffer up to the last WRITE_ALIGN boundary (or
+        everything) to dest, raises OSError.
+        """
+        
+        count = self._filled
+        if not everything:
+            count -= (self._offset + self._filled) % WRITE_ALIGN
+            if count <= 0:
+                count = self._filled
+        
+        written = 0
+        while written < count:
+            written += os.write(self._fd, self._chunk[written:count])
+        
+        # the unaligned rest is less than WRITE_ALIGN
+        rest = self._filled - count
+        self._buffer[0:rest] = self._buffer[count:self._filled]
+        self._filled = rest
+        self._offset += count
+    
+    def _progress(self, force=False):
+        "Updates status entries (every PROGRESS_INTERVAL seconds)."
+        
+        now = time.time()
+        if not force and now < self._next_progress:
+            return
+        self._next_progress = now + PROGRESS_INTERVAL
+        
+        (mark_time, mark_bytes) = self._speed_mark
+        if now - mark_time >= 1.0 or force:
+            elapsed = max(now - mark_time, 0.001)
+            self._status[SPEED] = int((self.received - mark_bytes) / elapsed)
+            self._speed_mark = (now, self.received)
+        
+        self._status[DL_SIZE] = self.received
+        self._status[forks.WALL_TIME] = round(now - self._start_time, 1)
+        
+        if self.total:
+            self._status[PERCENT] = int(self.received * 100 / self.total)
+            speed = self._status[SPEED]
+            if speed > 0:
+                self._status[TIME_LEFT] = int(
+                    (self.total - self.received) / speed)
+    
+    def _check_complete(self):
+        
+        if not (self.total is None) and self.received >= self.total:
+            self._done(self._success_rc())
+    
+    def _success_rc(self):
+        
+        if self.http_status >= 400:
+            return RC_HTTP
+        return RC_OK
+    
+    def _done(self, rc):
+        "Ends the transfer with return code rc."
+        
+        # still connecting, the response is closed when it arrives
+        self._call.kill()
+        if not (self._sock is None):
+            self._sock.close()
+            self._sock = None
+        if self._rc is None and rc in (RC_OK, RC_HTTP) and (
+            not (self._sniff_data is None)) and self._check_error_page():
+            # the whole body was shorter than SNIFF_SIZE
+            rc = RC_ERROR_PAGE
+        
+        if not (self._fd is None):
+            try:
+                if rc != RC_ERROR_PAGE:
+                    self._flush(everything=True)
+            except OSError:
+                if rc == RC_OK:
+                    rc = RC_WRITE
+            os.close(self._fd)
+            self._fd = None
+        
+        if self._rc is None:
+            self._rc = rc
+            if self.received > 0:
+                self._progress(force=True)
+        
+        self._status[forks.STREAM_OPEN] = False
+        self._status[forks.RETURN_CODE] = self._rc
+        self._status[forks.RUNNING] = False
     
     def _update(self):
         
-        self._read_line()
+        if self._status[forks.RUNNING] and not self._call.is_done():
+            self._call._update()
+            if self._call.is_done():
+                self._connect()
+            return
+        
+        sock = self._sock
+        if sock is None:
+            return
+        
+        size = HTTP_CHUNK_SIZE
+        if not (self.bucket is None):
+            size = self.bucket.take(HTTP_CHUNK_SIZE)
+            if size <= 0:
+                return
+        
+        # ssl could have buffered data select doesn't know about
+        if not (hasattr(sock, 'pending') and sock.pending()):
+            if not select.select([sock], [], [], DEFAULT_WAITTIME)[0]:
+                return
+        
+        size = min(size, len(self._buffer) - self._filled)
+        
+        try:
+            count = sock.recv_into(self._chunk[self._filled:], size)
+        except ssl.SSLError, ex:
+            if ex.args and ex.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                ssl.SSL_ERROR_WANT_WRITE):
+                return
+            self._done(RC_PARTIAL)
+            return
+        except socket.error, ex:
+            if ex.args and ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._done(RC_PARTIAL)
+            return
+        
+        if not (self.bucket is None):
+            self.bucket.consume(count)
+        
+        if count == 0:
+            if self.total is None:
+                self._done(self._success_rc())
+            else:
+                self._done(RC_PARTIAL)
+            return
+        
+        try:
+            self._received(count)
+        except OSError:
+            self._done(RC_WRITE)
+            return
+        
+        if not (self._rc is None):
+            return
+        
+        self._progress()
+        self._check_complete()
+    
+    def _pause_time(self):
+        
+        if self.bucket is None or self._sock is None:
+            return 0.0
+        return self.bucket.wait_time(HTTP_CHUNK_SIZE)
+    
+    def _exit_fd(self):
+        return None
+    
+    def _poll(self):
+        pass
+    
+    def kill(self):
+        
+        if self._rc is None:
+            self._done(RC_KILLED)
+            return True
+        return False
+
+
+class SegmentedDownload(object):
+    """ SegmentedDownload
+    
+    Downloads link over count connections at once, every connection
+    (HttpSpoon) fetches one byte range and writes it at its offset of
+    dest, which is created (and allocated) with its final size first.
+    The ranges which are still missing are kept in dest plus
+    SEGMENTS_SUFFIX (updated on every callback, removed when dest is
+    complete), a partial download is resumed with them (see
+    read_segments). Use it in a job
+    (see forks.run_job) by yielding steps(), callback gets the status of
+    all segments added up (same keys as HttpSpoon).
+    """
+    
+    def __init__(self, link, dest, total, count, cookie=None, callback=None,
+        bucket=None, write_buffer=WRITE_BUFFER_SIZE, ranges=None):
+        """ __init__(self, link, dest, total, count, cookie=None,
+                     callback=None, bucket=None,
+                     write_buffer=WRITE_BUFFER_SIZE, ranges=None)
+        
+        Total is the size of link (see probe_size), all segments share
+        bucket (TokenBucket), write_buffer is used by every segment.
+        If ranges (see read_segments) is set, only these are fetched
+        (one connection each) into the existing dest, count is ignored.
+        """
+        
+        self.total = total
+        self._dest = dest
+        self._callback = callback
+        self._version = 0
+        self._changes = None
+        self._view = None
+        
+        if ranges is None:
+            fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                forks.fallocate(fd, 0, total)
+                os.ftruncate(fd, total)
+            finally:
+                os.close(fd)
+            
+            size = total / count
+            ranges = []
+            for i in xrange(count):
+                first = i * size
+                last = first + size - 1
+                if i == count - 1:
+                    last = total - 1
+                ranges.append((first, last))
+        
+        # bytes which were already there
+        self._resumed = total - sum([last - first + 1
+            for (first, last) in ranges])
+        _write_segments(dest, total, ranges)
+        self._saved = list(ranges)
+        
+        self.spoons = []
+        for (first, last) in ranges:
+            self.spoons.append(HttpSpoon(link, dest, cookie=cookie,
+                first=first, last=last, bucket=bucket,
+                write_buffer=write_buffer))
+    
+    def steps(self):
+        "Returns list of (spoon, callback) which has to be yielded."
+        
+        return [(spoon, self._update) for spoon in self.spoons]
+    
+    def get_status(self):
+        "Returns status of all segments (forks.StatusView)."
+        
+        # a new view only if a segment has changed
+        changes = [(spoon.get_status().version, spoon.received)
+            for spoon in self.spoons]
+        if changes == self._changes:
+            return self._view
+        self._changes = changes
+        
+        received = self._resumed
+        speed = 0
+        running = False
+        stream_open = False
+        rc = 0
+        wall = 0.0
+        
+        for spoon in self.spoons:
+            status = spoon.get_status()
+            received += spoon.received
+            speed += status[SPEED]
+            running = running or status[forks.RUNNING]
+            stream_open = stream_open or status[forks.STREAM_OPEN]
+            wall = max(wall, status[forks.WALL_TIME])
+            if rc == 0 and status[forks.RETURN_CODE] != 0:
+                rc = status[forks.RETURN_CODE]
+        
+        if running:
+            rc = None
+        
+        eta = '???'
+        if speed > 0:
+            eta = int((self.total - received) / speed)
+        
+        self._version += 1
+        self._view = forks.StatusView({forks.RUNNING : running,
+            forks.RETURN_CODE : rc, forks.STREAM_OPEN : stream_open,
+            forks.WALL_TIME : wall, PERCENT : int(received * 100 / self.total),
+            SPEED : speed, DL_SIZE : received, TOTAL_SIZE : self.total,
+            TIME_LEFT : eta, 'segments' : len(self.spoons)}, self._version)
+        return self._view
+    
+    def _save(self):
+        "Stores the ranges which haven't been written yet."
+        
+        # _offset: next byte of the segment which isn't on the disk
+        ranges = [(spoon._offset, spoon._last) for spoon in self.spoons
+            if spoon._offset <= spoon._last]
+        if ranges == self._saved:
+            return
+        
+        try:
+            _write_segments(self._dest, self.total, ranges)
+            self._saved = ranges
+        except (IOError, OSError):
+            pass
+    
+    def _update(self, status):
+        
+        self._save()
+        if not (self._callback is None):
+            self._callback(self.get_status())
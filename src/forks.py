@@ -5,14 +5,426 @@ import signal
 import select
 import copy
 import time
+import sys
+import threading
+import traceback
+import errno
+import fcntl
+import platform
 
 RUNNING = 'run'
 RETURN_CODE = 'rc'
 STREAM_OPEN = 'popen'
+CPU_USER = 'utime'
+CPU_SYS = 'stime'
+MAX_RSS = 'maxrss'
+READ_BYTES = 'rbytes'
+WRITE_BYTES = 'wbytes'
+WALL_TIME = 'wall'
+DELAY_LEFT = 'delay'
 
 FORKS_VERSION = "0.0.1"
 
 EXTRA_WAIT_TIME = 1
+HEARTBEAT_INTERVAL = 1.0
+READ_SIZE = 16384
+LINE_DELIMITERS = '\r\n'
+
+PIDFD_OPEN_NR = 434
+LAUNCHER_POPEN = 'popen'
+LAUNCHER_SPAWN = 'spawn'
+SAMPLE_INTERVAL = 1.0
+
+IOPRIO_CLASSES = {'rt' : 1, 'be' : 2, 'idle' : 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_NR = {'x86_64' : 251, 'i386' : 289, 'i686' : 289,
+                 'armv7l' : 314, 'aarch64' : 30, 'ppc64le' : 273}
+PRIO_PROCESS = 0
+CPU_SET_SIZE = 128
+FALLOC_FL_KEEP_SIZE = 1
+FADV_SEQUENTIAL = 2
+FADV_WILLNEED = 3
+FADV_DONTNEED = 4
+
+_delimiter_exprs = {}
+
+try:
+    _CLK_TCK = float(os.sysconf('SC_CLK_TCK'))
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _CLK_TCK = 100.0
+    _PAGE_SIZE = 4096
+
+_launcher = LAUNCHER_POPEN
+
+try:
+    import ctypes
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _syscall = _libc.syscall
+except (ImportError, OSError, AttributeError):
+    _libc = None
+    _syscall = None
+
+# enough for posix_spawn_file_actions_t of every libc i know
+_FILE_ACTIONS_SIZE = 256
+
+def _delimiter_expr(delimiters):
+    "Returns (cached) regex which matches any char of delimiters."
+    
+    expr = _delimiter_exprs.get(delimiters)
+    if expr is None:
+        expr = re.compile('[%s]' % re.escape(delimiters))
+        _delimiter_exprs[delimiters] = expr
+    return expr
+
+
+def _pidfd_open(pid):
+    "Returns a pidfd (readable after exit of pid) or None (if unsupported)."
+    
+    if _syscall is None or not sys.platform.startswith('linux'):
+        return None
+    
+    fd = _syscall(PIDFD_OPEN_NR, pid, 0)
+    if fd < 0:
+        return None
+    return fd
+
+
+def spawn_supported(cwd=None):
+    "True if programs can be started with posix_spawn (in cwd)."
+    
+    if _libc is None or not hasattr(_libc, 'posix_spawnp'):
+        return False
+    if not (cwd is None):
+        return hasattr(_libc, 'posix_spawn_file_actions_addchdir_np')
+    return True
+
+
+def set_launcher(launcher):
+    """ set_launcher(launcher)
+    
+    Sets how spoons start external programs by default:
+    - LAUNCHER_POPEN: subprocess.Popen (fork + exec)
+    - LAUNCHER_SPAWN: posix_spawn, its costs don't depend on the size of
+      this process (Popen is used if posix_spawn isn't supported).
+    """
+    
+    global _launcher
+    if not (launcher in (LAUNCHER_POPEN, LAUNCHER_SPAWN)):
+        raise ForksException("unknown launcher %s" % launcher)
+    _launcher = launcher
+
+
+def get_launcher():
+    return _launcher
+
+
+class _SpawnedProcess(object):
+    "Just the parts of subprocess.Popen Spoon needs (see _spawn)."
+    
+    def __init__(self, pid, stdin, stdout, stderr):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+    
+    def _handle_exitstatus(self, sts):
+        
+        if os.WIFSIGNALED(sts):
+            self.returncode = -os.WTERMSIG(sts)
+        elif os.WIFEXITED(sts):
+            self.returncode = os.WEXITSTATUS(sts)
+    
+    def poll(self):
+        
+        if self.returncode is None:
+            try:
+                (pid, sts) = os.waitpid(self.pid, os.WNOHANG)
+            except OSError, ex:
+                if ex.errno != errno.ECHILD:
+                    raise
+                self.returncode = 0
+            else:
+                if pid == self.pid:
+                    self._handle_exitstatus(sts)
+        
+        return self.returncode
+
+
+def _cloexec_pipe():
+    
+    (r, w) = os.pipe()
+    for fd in (r, w):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return (r, w)
+
+
+def _spawn(args, with_stdin=False, use_stderr=False, cwd=None):
+    """ _spawn(args, with_stdin=False, use_stderr=False, cwd=None)
+    
+    Starts args with posix_spawnp, stdin (if with_stdin) and stdout (or
+    stderr) are connected to pipes. Returns a _SpawnedProcess.
+    """
+    
+    args = [str(arg) for arg in args]
+    argv = (ctypes.c_char_p * (len(args) + 1))(*(args + [None]))
+    env = ["%s=%s" % item for item in os.environ.iteritems()]
+    envp = (ctypes.c_char_p * (len(env) + 1))(*(env + [None]))
+    pid = ctypes.c_int()
+    actions = ctypes.create_string_buffer(_FILE_ACTIONS_SIZE)
+    child_fds = []
+    parent_fds = []
+    
+    (out_r, out_w) = _cloexec_pipe()
+    child_fds.append((out_w, use_stderr and 2 or 1))
+    parent_fds.append(out_r)
+    
+    if with_stdin:
+        (in_r, in_w) = _cloexec_pipe()
+        child_fds.append((in_r, 0))
+        parent_fds.append(in_w)
+    
+    _libc.posix_spawn_file_actions_init(actions)
+    try:
+        for (fd, target) in child_fds:
+            _libc.posix_spawn_file_actions_adddup2(actions, fd, target)
+        if not (cwd is None):
+            _libc.posix_spawn_file_actions_addchdir_np(actions, str(cwd))
+        
+        result = _libc.posix_spawnp(ctypes.byref(pid), args[0], actions,
+            None, argv, envp)
+    finally:
+        _libc.posix_spawn_file_actions_destroy(actions)
+        for (fd, target) in child_fds:
+            os.close(fd)
+    
+    if result != 0:
+        for fd in parent_fds:
+            os.close(fd)
+        raise OSError(result, os.strerror(result))
+    
+    stream = os.fdopen(out_r, 'rb', 0)
+    stdin = None
+    if with_stdin:
+        stdin = os.fdopen(in_w, 'wb', 0)
+    
+    if use_stderr:
+        return _SpawnedProcess(pid.value, stdin, None, stream)
+    else:
+        return _SpawnedProcess(pid.value, stdin, stream, None)
+
+
+def _read_proc_usage(pid):
+    """ _read_proc_usage(pid)
+    
+    Reads /proc/<pid>/stat and /proc/<pid>/io, returns tuple
+    (utime, stime, rss, read_bytes, write_bytes) with times in seconds
+    and sizes in bytes or None if /proc isn't available. Read and write
+    bytes are None if io accounting can't be read.
+    """
+    
+    try:
+        f = open('/proc/%d/stat' % pid)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    
+    # the program name (2nd field) could contain spaces and brackets
+    fields = data[data.rfind(')') + 2:].split(' ')
+    utime = int(fields[11]) / _CLK_TCK
+    stime = int(fields[12]) / _CLK_TCK
+    rss = int(fields[21]) * _PAGE_SIZE
+    read_bytes = None
+    write_bytes = None
+    
+    try:
+        f = open('/proc/%d/io' % pid)
+        try:
+            for line in f:
+                (key, value) = line.split(':', 1)
+                if key == 'read_bytes':
+                    read_bytes = int(value)
+                elif key == 'write_bytes':
+                    write_bytes = int(value)
+        finally:
+            f.close()
+    except IOError:
+        pass
+    
+    return (utime, stime, rss, read_bytes, write_bytes)
+
+
+class ResourceProfile(object):
+    """ ResourceProfile
+    
+    Scheduling settings for external programs (see Spoon.start):
+    - nice: nice level (-20 .. 19)
+    - ioclass: io scheduling class ('rt', 'be' or 'idle')
+    - ioprio: priority within ioclass (0 highest .. 7 lowest)
+    - cpus: list of cpu numbers the program may run on
+    None means 'don't change'.
+    """
+    
+    def __init__(self, nice=None, ioclass=None, ioprio=None, cpus=None):
+        
+        if not (ioclass is None or ioclass in IOPRIO_CLASSES):
+            raise ForksException("unknown io class %s" % ioclass)
+        
+        for cpu in (cpus or []):
+            if cpu < 0 or cpu >= CPU_SET_SIZE * 8:
+                raise ForksException("invalid cpu number %d" % cpu)
+        
+        self.nice = nice
+        self.ioclass = ioclass
+        self.ioprio = ioprio
+        self.cpus = cpus
+    
+    def apply(self, pid=0):
+        """ apply(self, pid=0)
+        
+        Applies profile to process pid (0 is the calling process).
+        Settings which aren't supported on this system are ignored,
+        raises OSError if the kernel refuses a setting.
+        """
+        
+        if _libc is None:
+            return
+        
+        if not (self.nice is None):
+            _check(_libc.setpriority(PRIO_PROCESS, pid, self.nice))
+        
+        nr = IOPRIO_SET_NR.get(platform.machine())
+        if not (self.ioclass is None or nr is None):
+            value = IOPRIO_CLASSES[self.ioclass] << IOPRIO_CLASS_SHIFT
+            if self.ioclass != 'idle':
+                value |= (self.ioprio or 0)
+            _check(_syscall(nr, IOPRIO_WHO_PROCESS, pid, value))
+        
+        if not (self.cpus is None):
+            mask = (ctypes.c_ubyte * CPU_SET_SIZE)()
+            for cpu in self.cpus:
+                mask[cpu / 8] |= 1 << (cpu % 8)
+            _check(_libc.sched_setaffinity(pid, CPU_SET_SIZE, mask))
+    
+    def __str__(self):
+        
+        items = []
+        if not (self.nice is None):
+            items.append("nice=%d" % self.nice)
+        if not (self.ioclass is None):
+            items.append("ioclass=%s" % self.ioclass)
+        if not (self.ioprio is None):
+            items.append("ioprio=%d" % self.ioprio)
+        if not (self.cpus is None):
+            items.append("cpus=%s" % ",".join([str(i) for i in self.cpus]))
+        return " ".join(items)
+
+
+def parse_profile(text):
+    """ parse_profile(text)
+    
+    Creates a ResourceProfile from a string like
+    'nice=10 ioclass=be ioprio=7 cpus=0,1' (every item is optional).
+    """
+    
+    params = {}
+    
+    for item in text.split():
+        (key, value) = item.split('=', 1)
+        if key in ('nice', 'ioprio'):
+            params[key] = int(value)
+        elif key == 'ioclass':
+            params[key] = value
+        elif key == 'cpus':
+            params[key] = [int(i) for i in value.split(',')]
+        else:
+            raise ForksException("unknown profile setting %s" % key)
+    
+    return ResourceProfile(**params)
+
+
+def _check(result):
+    "Raises OSError if a libc call failed."
+    
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def fallocate(fd, offset, length, keep_size=True):
+    """ fallocate(fd, offset, length, keep_size=True)
+    
+    Allocates disk space for bytes offset..offset+length of fd in one
+    go, so a file which is written a little at a time (or several at
+    once) isn't fragmented. If keep_size is set, the size of the file
+    doesn't change (so a partial download still has the size of what's
+    been written). Returns False if the file system can't do that.
+    """
+    
+    if length <= 0 or _libc is None:
+        return False
+    
+    try:
+        if keep_size:
+            result = _libc.fallocate64(fd, FALLOC_FL_KEEP_SIZE,
+                ctypes.c_longlong(offset), ctypes.c_longlong(length))
+            return result == 0
+        
+        # returns the error instead of setting errno
+        return _libc.posix_fallocate64(fd, ctypes.c_longlong(offset),
+            ctypes.c_longlong(length)) == 0
+    except AttributeError:
+        return False
+
+
+def fadvise(fd, offset, length, advice):
+    """ fadvise(fd, offset, length, advice)
+    
+    Tells the kernel how bytes offset..offset+length of fd (length 0
+    means up to the end) will be used (FADV_WILLNEED, ...), returns
+    False if that isn't supported.
+    """
+    
+    if _libc is None or not hasattr(_libc, 'posix_fadvise64'):
+        return False
+    
+    return _libc.posix_fadvise64(fd, ctypes.c_longlong(offset),
+        ctypes.c_longlong(length), advice) == 0
+
+
+def run_job(job):
+    """ run_job(job)
+    
+    A job is a generator which yields (spoon, callback) tuples, each spoon
+    has already been started. run_job runs the update-loop of every spoon
+    in the calling thread (see Reactor.add_job for the asynchronous way).
+    The job can use spoon.get_status() after the yield statement.
+    A job can also yield a list of (spoon, callback) tuples, these spoons
+    run at the same time (run_job uses a Reactor in the calling thread).
+    """
+    
+    for step in job:
+        if isinstance(step, list):
+            reactor = Reactor()
+            for (spoon, callback) in step:
+                reactor.add_spoon(spoon, callback)
+            reactor.shutdown()
+            reactor.loop()
+        else:
+            (spoon, callback) = step
+            spoon.update_loop(callback=callback)
+
+
+def _spoon_job(spoon, callback):
+    "Job for just one spoon."
+    
+    yield (spoon, callback)
 
 
 class ForksException(Exception):
@@ -41,6 +453,49 @@ class SpoonNotStartedError(ForksException):
     pass
 
 
+class StatusView(dict):
+    """ Read-only snapshot of a spoon's status
+    
+    Callback functions get these instead of copies. A new view is only
+    created if the status has changed, version is increased with every
+    change (so you can easily check whether something has changed).
+    """
+    
+    def __init__(self, status, version):
+        dict.__init__(self, status)
+        self.version = version
+    
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("status view is read-only")
+    
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+    
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self, memo):
+        return self
+
+
+class _VersionedDict(dict):
+    "Dict which increases version whenever a value changes."
+    
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = 0
+    
+    def __setitem__(self, key, value):
+        if not (key in self) or dict.__getitem__(self, key) != value:
+            dict.__setitem__(self, key, value)
+            self.version += 1
+
+
 class UninitializedHelper(object):
     """ Helper class used by Spoon
     
@@ -62,7 +517,8 @@ class Spoon(object):
     external programs. It's also possible to write data either to 
     stdout or to stderr.
     To uses this class simply derive your custom class from forks.Spoon
-    and implement the _update function. You can use read_char to read 
+    and implement the _update function. You can use read_frames to read
+    complete lines (or any other delimited frames) or read_char to read 
     characters from output stream of the external application. See
     TestSpoon class for implementation details.
     """
@@ -75,15 +531,36 @@ class Spoon(object):
         - RUNNING: is the external application still running?
         - RETURN_CODE: return code of application after exit
         - STREAM_OPEN: is the connected stream still opened?
+        and resource usage of the external application (sampled while
+        it runs, exact values after it exited):
+        - CPU_USER, CPU_SYS: cpu time in seconds
+        - MAX_RSS: maximum (sampled) resident set size in bytes
+        - READ_BYTES, WRITE_BYTES: bytes read from/written to disk
+        - WALL_TIME: seconds since start
         """
         
-        self._status = {RUNNING : None, RETURN_CODE : None,
-                        STREAM_OPEN : True}
+        self._status = _VersionedDict({RUNNING : None, RETURN_CODE : None,
+                        STREAM_OPEN : True, CPU_USER : 0.0,
+                        CPU_SYS : 0.0, MAX_RSS : 0, READ_BYTES : 0,
+                        WRITE_BYTES : 0, WALL_TIME : 0.0})
+        self._view = None
         self._callback = None
+        self._min_interval = 0.0
+        self._changes_only = False
+        self._heartbeat = HEARTBEAT_INTERVAL
+        self._last_call = 0.0
+        self._last_version = -1
+        self._suppressed = False
+        self._start_time = None
+        self._next_sample = 0.0
         self._stream = UninitializedHelper()
+        self._rbuf = ''
+        self._rpos = 0
     
-    def start(self, args, in_data=None, use_stderr=False, cwd=None):
-        """ start(self, args, in_data=None, usestderr=False, cwd=None)
+    def start(self, args, in_data=None, use_stderr=False, cwd=None,
+        launcher=None, profile=None):
+        """ start(self, args, in_data=None, usestderr=False, cwd=None,
+                  launcher=None, profile=None)
         
         This method executes args[0] with parameters args[1:].
         If in_data is a valid string, it will be written to stdin of
@@ -91,11 +568,43 @@ class Spoon(object):
         If use_stderr is True, stderr is read in spite of stdout.
         If cwd is a valid string, the external application will be 
         started in cwd directory if possible.
+        Launcher overrides the default launcher (see set_launcher).
+        Profile (ResourceProfile) is applied in the child before exec
+        (posix_spawn can't do that, so the program is started with
+        Popen if there is a profile).
         """
         
         self._status[RUNNING] = True
+        self._start_time = time.time()
+        
+        if launcher is None:
+            launcher = _launcher
+        
+        # a profile applied after the spawn would only reach the main
+        # thread of the program (and miss everything it started before)
+        if (launcher == LAUNCHER_SPAWN and profile is None and
+            spawn_supported(cwd)):
+            self._sproc = _spawn(args, with_stdin=not (in_data is None),
+                use_stderr=use_stderr, cwd=cwd)
+            if not (in_data is None):
+                self._sproc.stdin.write(in_data)
+                self._sproc.stdin.close()
+        else:
+            self._popen(args, in_data, use_stderr, cwd, profile)
+        
+        if use_stderr:
+            self._stream = self._sproc.stderr
+        else:
+            self._stream = self._sproc.stdout
+    
+    def _popen(self, args, in_data, use_stderr, cwd, profile):
+        "Starts args with subprocess.Popen."
+        
         params = {}
         
+        if not (profile is None):
+            params['preexec_fn'] = profile.apply
+        
         if not (cwd is None):
             params['cwd'] = cwd
         
@@ -111,40 +620,271 @@ class Spoon(object):
                 **params)
             self._sproc.stdin.write(in_data)
             self._sproc.stdin.close()
+    
+    def set_callback_policy(self, min_interval=0.0, changes_only=False,
+        heartbeat=HEARTBEAT_INTERVAL):
+        """ set_callback_policy(self, min_interval=0.0, changes_only=False,
+                                heartbeat=HEARTBEAT_INTERVAL)
         
-        if use_stderr:
-            self._stream = self._sproc.stderr
-        else:
-            self._stream = self._sproc.stdout
+        Limits how often the callback function is called: never more
+        often than every min_interval seconds and, if changes_only is
+        True, only if the status has changed or heartbeat seconds have
+        passed (so the callback can still kill the spoon). A call which
+        came too early is made once min_interval has passed. The last
+        call after the external program exited is never skipped.
+        """
+        
+        self._min_interval = min_interval
+        self._changes_only = changes_only
+        self._heartbeat = heartbeat
     
-    def _call_callback(self):
-        "calls callback function (just a shorthand)."
+    def _snapshot(self):
+        "Returns StatusView of current status (only copies on change)."
         
-        if not (self._callback is None):
-            status = copy.copy(self._status)
-            self._callback(status)
+        if self._view is None or self._view.version != self._status.version:
+            self._view = StatusView(self._status, self._status.version)
+        return self._view
     
-    def read_char(self, wait=0.0):
-        """ read_char(self, wait=0)
+    def _call_callback(self, force=False):
+        "calls callback function (if the callback policy allows it)."
         
-        This method should be used to read a character in the _update
-        function.
-        Wait defines the wait time before the callback function is 
-        called if there is no new data. If wait is set to None, it will
-        block forever.
+        if self._callback is None:
+            return
+        
+        now = time.time()
+        if not force:
+            elapsed = now - self._last_call
+            if elapsed < self._min_interval:
+                # made later, see _trailing_time
+                self._suppressed = True
+                return
+            if (self._changes_only and elapsed < self._heartbeat and
+                self._status.version == self._last_version):
+                self._suppressed = False
+                return
+        
+        status = self._snapshot()
+        self._last_call = now
+        self._last_version = status.version
+        self._suppressed = False
+        self._callback(status)
+    
+    def _trailing_time(self):
+        """ _trailing_time(self)
+        
+        Returns the time at which a call of the callback function which
+        min_interval has suppressed is due (None if there is none).
+        """
+        
+        if self._callback is None or not self._suppressed:
+            return None
+        return self._last_call + self._min_interval
+    
+    def _fill_buffer(self, wait):
+        """ _fill_buffer(self, wait)
+        
+        Waits until the stream is readable (calling the callback function
+        every wait seconds) and appends one chunk of up to READ_SIZE bytes
+        to the read buffer. Returns False if the stream has been closed.
         """
         
         std_nr = self._stream.fileno()
         
+        # drops what read_char has consumed
+        if self._rpos > 0:
+            self._rbuf = self._rbuf[self._rpos:]
+            self._rpos = 0
+        
         while True:
-            if std_nr in select.select([std_nr], [], [], wait)[0]:
-                ch = self._stream.read(1)
-                if ch == '':
+            timeout = wait
+            due = self._trailing_time()
+            if not (due is None):
+                timeout = max(0.0, due - time.time())
+                if not (wait is None):
+                    timeout = min(timeout, wait)
+            
+            if std_nr in select.select([std_nr], [], [], timeout)[0]:
+                data = os.read(std_nr, READ_SIZE)
+                if data == '':
                     self._status[STREAM_OPEN] = False
-                return ch
+                    return False
+                self._rbuf += data
+                return True
             else:
                 self._call_callback()
     
+    def read_char(self, wait=0.0):
+        """ read_char(self, wait=0)
+        
+        This method could be used to read a character in the _update
+        function (read_frames is a lot cheaper).
+        Wait defines the wait time before the callback function is 
+        called if there is no new data. If wait is set to None, it will
+        block forever.
+        """
+        
+        if self._rpos >= len(self._rbuf):
+            if not self._fill_buffer(wait):
+                return ''
+        
+        ch = self._rbuf[self._rpos]
+        self._rpos += 1
+        return ch
+    
+    def read_chunk(self, wait=0.0):
+        """ read_chunk(self, wait=0)
+        
+        Reads one chunk from the stream and returns it (with data left
+        by read_char or read_frames), '' if the stream has been closed.
+        Use this if the output should be parsed without splitting it
+        into frames first. Wait has the same meaning as in read_char.
+        """
+        
+        self._fill_buffer(wait)
+        data = self._rbuf
+        self._rbuf = ''
+        return data
+    
+    def read_frames(self, delimiters=LINE_DELIMITERS, wait=0.0):
+        """ read_frames(self, delimiters=LINE_DELIMITERS, wait=0)
+        
+        This method should be used to read output in the _update function.
+        It reads one chunk from the stream and returns a list of
+        (frame, delimiter) tuples for every complete frame, a frame is
+        terminated by any character in delimiters (e.g. '\\r\\n\\x08').
+        Incomplete data is kept until the next call. If the stream has
+        been closed, the remaining data is returned as last frame with
+        delimiter ''.
+        Wait has the same meaning as in read_char.
+        """
+        
+        if not self._fill_buffer(wait):
+            if self._rbuf == '':
+                return []
+            frames = [(self._rbuf, '')]
+            self._rbuf = ''
+            return frames
+        
+        frames = []
+        start = 0
+        for match in _delimiter_expr(delimiters).finditer(self._rbuf):
+            frames.append((self._rbuf[start:match.start()], match.group()))
+            start = match.end()
+        
+        self._rbuf = self._rbuf[start:]
+        return frames
+    
+    def _reap(self):
+        """ _reap(self)
+        
+        Reaps the external program (if it has exited) with os.wait4 and
+        stores its resource usage.
+        """
+        
+        try:
+            (pid, sts, usage) = os.wait4(self._sproc.pid, os.WNOHANG)
+        except OSError, ex:
+            if ex.errno != errno.ECHILD:
+                raise
+            # somebody else was faster, usage is lost
+            self._sproc.poll()
+            return
+        
+        if pid == self._sproc.pid:
+            self._sproc._handle_exitstatus(sts)
+            self._status[CPU_USER] = round(usage.ru_utime, 2)
+            self._status[CPU_SYS] = round(usage.ru_stime, 2)
+            # ru_maxrss isn't used, it includes the memory this process
+            # had when the child was forked (or spawned), MAX_RSS is
+            # only sampled
+            self._status[READ_BYTES] = max(self._status[READ_BYTES],
+                usage.ru_inblock * 512)
+            self._status[WRITE_BYTES] = max(self._status[WRITE_BYTES],
+                usage.ru_oublock * 512)
+            self._status[WALL_TIME] = round(time.time() - self._start_time, 1)
+    
+    def _sample(self):
+        "Samples resource usage from /proc (every SAMPLE_INTERVAL seconds)."
+        
+        now = time.time()
+        if now < self._next_sample:
+            return
+        self._next_sample = now + SAMPLE_INTERVAL
+        
+        self._status[WALL_TIME] = round(now - self._start_time, 1)
+        usage = _read_proc_usage(self._sproc.pid)
+        if usage is None:
+            return
+        
+        (utime, stime, rss, read_bytes, write_bytes) = usage
+        self._status[CPU_USER] = round(utime, 2)
+        self._status[CPU_SYS] = round(stime, 2)
+        self._status[MAX_RSS] = max(self._status[MAX_RSS], rss)
+        if not (read_bytes is None):
+            self._status[READ_BYTES] = read_bytes
+            self._status[WRITE_BYTES] = write_bytes
+    
+    def _exit_fd(self):
+        "Returns a fd which gets readable when the program exits (or None)."
+        
+        return _pidfd_open(self._sproc.pid)
+    
+    def _poll(self):
+        "Updates RUNNING, RETURN_CODE and resource usage entries."
+        
+        if self._sproc.returncode is None:
+            self._reap()
+            if self._sproc.returncode is None:
+                self._sample()
+        
+        self._status[RETURN_CODE] = self._sproc.returncode
+        self._status[RUNNING] = (self._status[RETURN_CODE] is None)
+    
+    def _dispatch(self):
+        """ _dispatch(self)
+        
+        One iteration of the update-loop: calls _update (if the stream
+        is still open) and the callback function, kills the external
+        program if the callback asks for it.
+        """
+        
+        try:
+            if self._status[STREAM_OPEN]:
+                self._update()
+            self._call_callback()
+        except KillForkException:
+            self.kill()
+        self._poll()
+    
+    def _finish(self):
+        "Calls the callback function a last time, returns final status."
+        
+        try:
+            self._call_callback(force=True)
+        except KillForkException:
+            pass
+        
+        return self._snapshot()
+    
+    def _pause_time(self):
+        """ _pause_time(self)
+        
+        Seconds the spoon doesn't want to read its stream (e.g. a
+        throttled download), the output is left in the pipe or socket.
+        """
+        
+        return 0.0
+    
+    def is_done(self):
+        "True if the stream is closed and the external program exited."
+        
+        return not (self._status[STREAM_OPEN] or self._status[RUNNING])
+    
+    def get_status(self):
+        "Returns the current status (read-only StatusView)."
+        
+        return self._snapshot()
+    
     def update_loop(self, callback=None, wait=EXTRA_WAIT_TIME):
         """ update_loop(self, callback=None, wait=EXTRA_WAIT_TIME)
         
@@ -158,25 +898,16 @@ class Spoon(object):
         
         self._callback = callback
         
-        ch = 'a' # value doesn't matter unless it's ''
-        while self._status[STREAM_OPEN] or self._status[RUNNING]:
-            try:
-                if self._status[STREAM_OPEN]:
-                    self._update()
-                else:
-                    time.sleep(wait) # don't waste cpu time...
-                self._call_callback()
-            except KillForkException:
-                self.kill()
-            self._status[RETURN_CODE] = self._sproc.poll()
-            self._status[RUNNING] = (self._status[RETURN_CODE] is None)
-        
-        try:
-            self._call_callback()
-        except KillForkException:
-            pass
+        while not self.is_done():
+            if not self._status[STREAM_OPEN]:
+                time.sleep(wait) # don't waste cpu time...
+            self._dispatch()
+            
+            pause = self._pause_time()
+            if pause > 0 and not self.is_done():
+                time.sleep(min(pause, wait))
         
-        return copy.deepcopy(self._status)
+        return self._finish()
     
     def kill(self):
         """ kill(self)
@@ -185,13 +916,530 @@ class Spoon(object):
         if it's really necessary.
         """
         
-        if self._sproc.poll() is None:
+        # don't use poll, the exit status is reaped by _poll (wait4)
+        if self._sproc.returncode is None:
             os.kill(self._sproc.pid, signal.SIGTERM)
             return True
         else:
             return False
 
 
+class _ReactorEntry(object):
+    "Used by Reactor to keep track of one job and its current spoon."
+    
+    def __init__(self, job, finished):
+        self.job = job
+        self.finished = finished
+        self.spoon = None
+        self.stream_fd = None
+        self.pidfd = None
+        self.pending = 0
+        # time at which a paused stream is registered again
+        self.resume = None
+
+
+class Reactor(object):
+    """ Reactor
+    
+    The reactor supervises many spoons in one thread. It waits for output
+    of all external programs (and their exit, using pidfds if the kernel
+    supports them) with one epoll (or poll) object and calls _update and
+    the callback function of the spoon which is ready. Spoons without new
+    output get their callback called every wait seconds, so they can
+    still be killed by raising KillForkException.
+    
+    Note that _update will only be called if the stream is readable, so
+    it should read (e.g. by using read_frames) just once. A spoon may
+    replace its stream in _update (the old one must stay open).
+    """
+    
+    def __init__(self, wait=EXTRA_WAIT_TIME):
+        """ __init__(self, wait=EXTRA_WAIT_TIME)
+        
+        Creates the reactor, call start to run it in its own thread
+        or loop to run it in the calling thread.
+        """
+        
+        self._wait = wait
+        self._lock = threading.RLock()
+        self._running = True
+        self._new_jobs = []
+        self._entries = []
+        self._fds = {}
+        self._thread = None
+        
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._poll_scale = 1.0
+        else:
+            self._poller = select.poll()
+            self._poll_scale = 1000.0
+        
+        self._wake_r, self._wake_w = os.pipe()
+        self._poller.register(self._wake_r, select.POLLIN)
+    
+    def add_job(self, job, finished=None):
+        """ add_job(self, job, finished=None)
+        
+        Adds a job (see run_job), finished will be called without
+        arguments (in the reactor thread) after the job has ended.
+        """
+        
+        self._lock.acquire()
+        try:
+            self._new_jobs.append(_ReactorEntry(job, finished))
+        finally:
+            self._lock.release()
+        
+        os.write(self._wake_w, 'j')
+    
+    def add_spoon(self, spoon, callback=None, finished=None):
+        """ add_spoon(self, spoon, callback=None, finished=None)
+        
+        Supervises one (started) spoon, just like spoon.update_loop would.
+        """
+        
+        self.add_job(_spoon_job(spoon, callback), finished)
+    
+    def job_count(self):
+        "Number of jobs which are currently supervised."
+        
+        self._lock.acquire()
+        try:
+            return len(self._entries) + len(self._new_jobs)
+        finally:
+            self._lock.release()
+    
+    def start(self):
+        "Runs loop in a new thread."
+        
+        self._thread = threading.Thread(target=self.loop,
+            name="Reactor-Thread")
+        self._thread.start()
+    
+    def shutdown(self):
+        "Waits until all jobs have ended and stops the reactor (blocking)."
+        
+        self._lock.acquire()
+        try:
+            self._running = False
+        finally:
+            self._lock.release()
+        
+        os.write(self._wake_w, 's')
+        
+        if not (self._thread is None):
+            self._thread.join()
+    
+    def _register(self, entry, fd):
+        
+        self._fds[fd] = entry
+        self._poller.register(fd, select.POLLIN)
+    
+    def _unregister(self, fd):
+        
+        if fd in self._fds:
+            del self._fds[fd]
+            self._poller.unregister(fd)
+    
+    def _next_spoon(self, entry):
+        "Starts next step of job, returns False if the job has ended."
+        
+        try:
+            step = entry.job.next()
+        except (StopIteration, KillForkException):
+            return False
+        except Exception:
+            traceback.print_exc()
+            return False
+        
+        if isinstance(step, list):
+            # spoons which run at the same time, each gets its own entry
+            # (pending is one too high until all of them are started)
+            entry.pending = len(step) + 1
+            for (spoon, callback) in step:
+                self._advance(_ReactorEntry(_spoon_job(spoon, callback),
+                    lambda: self._part_finished(entry)))
+            entry.pending -= 1
+            return True
+        
+        (spoon, callback) = step
+        spoon._callback = callback
+        entry.spoon = spoon
+        return True
+    
+    def _part_finished(self, entry):
+        "Called if one of the spoons of a list step has finished."
+        
+        entry.pending -= 1
+        if entry.pending <= 0:
+            self._advance(entry)
+    
+    def _drop_spoon(self, entry):
+        "Unregisters current spoon of entry and calls its last callback."
+        
+        if not (entry.stream_fd is None):
+            self._unregister(entry.stream_fd)
+            entry.stream_fd = None
+        entry.resume = None
+        if not (entry.pidfd is None):
+            self._unregister(entry.pidfd)
+            os.close(entry.pidfd)
+            entry.pidfd = None
+        entry.spoon._finish()
+        entry.spoon = None
+    
+    def _advance(self, entry):
+        "Replaces the finished spoon of entry or removes entry."
+        
+        if not (entry.spoon is None):
+            self._drop_spoon(entry)
+        
+        while self._next_spoon(entry):
+            spoon = entry.spoon
+            if spoon is None:
+                # list step, _part_finished advances entry
+                if entry.pending > 0:
+                    return
+                continue
+            
+            if spoon.is_done():
+                # e.g. a download which couldn't even connect
+                self._drop_spoon(entry)
+                continue
+            
+            if spoon._status[STREAM_OPEN]:
+                entry.stream_fd = spoon._stream.fileno()
+                self._register(entry, entry.stream_fd)
+            entry.pidfd = spoon._exit_fd()
+            if not (entry.pidfd is None):
+                self._register(entry, entry.pidfd)
+            
+            if not (entry in self._entries):
+                self._entries.append(entry)
+            return
+        
+        if entry in self._entries:
+            self._entries.remove(entry)
+        if not (entry.finished is None):
+            try:
+                entry.finished()
+            except Exception:
+                traceback.print_exc()
+    
+    def _dispatch(self, entry):
+        "Calls _dispatch of the spoon, kills the spoon if it fails."
+        
+        spoon = entry.spoon
+        try:
+            spoon._dispatch()
+        except Exception:
+            traceback.print_exc()
+            spoon.kill()
+            spoon._poll()
+        
+        if spoon._status[STREAM_OPEN] and (
+            spoon._stream.fileno() != entry.stream_fd):
+            # the spoon has a new stream (e.g. a download which has
+            # connected), the old one is still open
+            self._unregister(entry.stream_fd)
+            entry.stream_fd = spoon._stream.fileno()
+            self._register(entry, entry.stream_fd)
+        
+        if not spoon._status[STREAM_OPEN]:
+            self._unregister(entry.stream_fd)
+        elif entry.stream_fd in self._fds:
+            pause = spoon._pause_time()
+            if pause > 0:
+                # don't wake up for output the spoon won't read yet
+                self._unregister(entry.stream_fd)
+                entry.resume = time.time() + pause
+        
+        if spoon.is_done():
+            self._advance(entry)
+    
+    def _resume_streams(self):
+        "Registers paused streams again, returns time of the next one."
+        
+        now = time.time()
+        next_resume = None
+        
+        for entry in self._entries:
+            if entry.resume is None:
+                continue
+            
+            spoon = entry.spoon
+            if spoon is None or not spoon._status[STREAM_OPEN]:
+                entry.resume = None
+            elif entry.resume <= now:
+                entry.resume = None
+                self._register(entry, entry.stream_fd)
+            elif next_resume is None or entry.resume < next_resume:
+                next_resume = entry.resume
+        
+        return next_resume
+    
+    def _callback(self, entry):
+        "Calls the callback function of the spoon of entry (no output)."
+        
+        spoon = entry.spoon
+        try:
+            spoon._call_callback()
+        except KillForkException:
+            spoon.kill()
+        except Exception:
+            traceback.print_exc()
+        spoon._poll()
+        if spoon.is_done():
+            # e.g. killed spoon without a process
+            self._advance(entry)
+    
+    def _trailing_calls(self):
+        """ _trailing_calls(self)
+        
+        Makes the suppressed callback calls which are due, returns the
+        time of the next one.
+        """
+        
+        now = time.time()
+        next_call = None
+        
+        for entry in list(self._entries):
+            if entry.spoon is None:
+                continue
+            
+            due = entry.spoon._trailing_time()
+            if due is None:
+                continue
+            elif due <= now:
+                self._callback(entry)
+            elif next_call is None or due < next_call:
+                next_call = due
+        
+        return next_call
+    
+    def loop(self):
+        """ loop(self)
+        
+        Runs the reactor until shutdown has been called and all jobs
+        have ended.
+        """
+        
+        next_tick = time.time() + self._wait
+        
+        while True:
+            self._lock.acquire()
+            try:
+                new_jobs = self._new_jobs
+                self._new_jobs = []
+                run = self._running
+            finally:
+                self._lock.release()
+            
+            for entry in new_jobs:
+                self._advance(entry)
+            
+            if not run and len(self._entries) <= 0:
+                break
+            
+            wake = next_tick
+            next_resume = self._resume_streams()
+            if not (next_resume is None):
+                wake = min(wake, next_resume)
+            next_call = self._trailing_calls()
+            if not (next_call is None):
+                wake = min(wake, next_call)
+            
+            timeout = max(0.0, wake - time.time())
+            events = self._poller.poll(timeout * self._poll_scale)
+            
+            for (fd, event) in events:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, READ_SIZE)
+                    continue
+                
+                entry = self._fds.get(fd)
+                if entry is None:
+                    continue
+                
+                if fd == entry.pidfd:
+                    self._unregister(fd)
+                    entry.spoon._poll()
+                    if entry.spoon.is_done():
+                        self._advance(entry)
+                else:
+                    self._dispatch(entry)
+            
+            if time.time() >= next_tick:
+                next_tick = time.time() + self._wait
+                for entry in list(self._entries):
+                    if entry.spoon is None:
+                        continue
+                    if (entry.stream_fd in self._fds or
+                        not (entry.resume is None)):
+                        # no output since last tick (or paused), just
+                        # call callback
+                        self._callback(entry)
+                    else:
+                        self._dispatch(entry)
+        
+        self._poller.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+class Delay(Spoon):
+    """ Delay
+    
+    Spoon without external program which just ends after some seconds,
+    jobs can yield it to wait (without blocking a Reactor). It can be
+    killed like any other spoon, RETURN_CODE is 0 if it wasn't.
+    Status entry DELAY_LEFT are the remaining seconds.
+    """
+    
+    def __init__(self, seconds):
+        
+        Spoon.__init__(self)
+        self._until = time.time() + seconds
+        self._status[STREAM_OPEN] = False
+        self._status[RUNNING] = True
+        self._status[DELAY_LEFT] = int(seconds)
+    
+    def _update(self):
+        pass
+    
+    def _exit_fd(self):
+        return None
+    
+    def _poll(self):
+        
+        if not self._status[RUNNING]:
+            return
+        
+        left = self._until - time.time()
+        self._status[DELAY_LEFT] = max(0, int(left))
+        if left <= 0:
+            self._status[RETURN_CODE] = 0
+            self._status[RUNNING] = False
+    
+    def kill(self):
+        
+        if self._status[RUNNING]:
+            self._status[RETURN_CODE] = -signal.SIGTERM
+            self._status[RUNNING] = False
+            return True
+        return False
+    
+    def update_loop(self, callback=None, wait=EXTRA_WAIT_TIME):
+        
+        # don't sleep longer than necessary
+        wait = min(wait, max(0.0, self._until - time.time()))
+        return Spoon.update_loop(self, callback=callback, wait=wait)
+
+
+class Call(Spoon):
+    """ Call
+    
+    Spoon without external program which calls function(*args) in its
+    own thread, jobs can yield it to wait for a blocking call (e.g.
+    connecting to a server) without blocking a Reactor. Its stream gets
+    readable when the function has returned, after that result is its
+    return value and error the exception it raised (RETURN_CODE is 1
+    then). It can be killed like any other spoon, the function still
+    runs to its end but its result is passed to discard (if set, e.g.
+    to close a socket).
+    """
+    
+    def __init__(self, function, args=(), discard=None):
+        
+        Spoon.__init__(self)
+        self.result = None
+        self.error = None
+        self._discard = discard
+        self._returned = None
+        self._killed = False
+        self._call_lock = threading.Lock()
+        self._status[RUNNING] = True
+        
+        (ready_r, ready_w) = _cloexec_pipe()
+        self._stream = os.fdopen(ready_r, 'rb', 0)
+        thread = threading.Thread(target=self._run, args=(function, args,
+            ready_w), name="Call-Thread")
+        thread.daemon = True
+        thread.start()
+    
+    def _run(self, function, args, ready):
+        
+        try:
+            returned = (function(*args), None)
+        except Exception, ex:
+            returned = (None, ex)
+        
+        self._call_lock.acquire()
+        try:
+            killed = self._killed
+            if not killed:
+                self._returned = returned
+        finally:
+            self._call_lock.release()
+        
+        if killed:
+            self._discard_result(returned[0])
+        
+        try:
+            os.write(ready, 'r')
+        except OSError:
+            pass
+        os.close(ready)
+    
+    def _discard_result(self, result):
+        
+        if not (self._discard is None or result is None):
+            try:
+                self._discard(result)
+            except Exception:
+                traceback.print_exc()
+    
+    def _update(self):
+        
+        if not select.select([self._stream], [], [], EXTRA_WAIT_TIME)[0]:
+            return
+        
+        self._call_lock.acquire()
+        try:
+            (self.result, self.error) = self._returned
+        finally:
+            self._call_lock.release()
+        
+        self._status[STREAM_OPEN] = False
+        self._status[RUNNING] = False
+        self._status[RETURN_CODE] = int(not (self.error is None))
+    
+    def _exit_fd(self):
+        return None
+    
+    def _poll(self):
+        pass
+    
+    def kill(self):
+        
+        self._call_lock.acquire()
+        try:
+            if self._killed or not self._status[RUNNING]:
+                return False
+            self._killed = True
+            returned = self._returned
+        finally:
+            self._call_lock.release()
+        
+        if not (returned is None):
+            self._discard_result(returned[0])
+        
+        self._status[STREAM_OPEN] = False
+        self._status[RETURN_CODE] = -signal.SIGTERM
+        self._status[RUNNING] = False
+        return True
+
 class TestSpoon(Spoon):
     """ TestSpoon
     
@@ -138,6 +138,8 @@ class file_detainer(object):
         
         self._pending = []
         self._finished = []
+        # names in the finished file, read once by was_downloaded
+        self._done = None
         
         self._load_pending_links()
         
@@ -202,6 +204,8 @@ class file_detainer(object):
             for name in self._finished:
                 f.write(name.rstrip('\n') + '\n')
             
+            if not (self._done is None):
+                self._done.update(self._finished)
             self._finished = []
             f.close()
             
@@ -238,20 +242,26 @@ class file_detainer(object):
         try:
             if name in self._finished:
                 return True
-            elif os.path.exists(self._fin):
-                done = False
-                f = open(self._fin, 'r')
-                for line in f:
-                    if name == line.strip('\r').strip('\n').strip('\r'):
-                        done = True
-                f.close()
-                return done
+            
+            if self._done is None:
+                self._done = self._load_finished()
+            return name in self._done
         finally:
             self._lock.release()
+    
+    def _load_finished(self):
+        "Returns the set of names in the finished file."
         
-        self._log.warning("couln'd check if '%s' was downloaded, file (%s) not found"
-            % (name, self._fin))
-        return False
+        done = set()
+        if os.path.exists(self._fin):
+            f = open(self._fin, 'r')
+            for line in f:
+                done.add(line.strip('\r').strip('\n').strip('\r'))
+            f.close()
+        else:
+            self._log.warning("couln'd check what was downloaded, file (%s) not found"
+                % self._fin)
+        return done
     
     def get_finished(self, count=None):
         
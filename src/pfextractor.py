@@ -1,24 +1,35 @@
 import os
+import forks
 import unrar
 
 class extractor(object):
     
-    def __init__(self, source, dest, pwds):
+    def __init__(self, source, dest, pwds, profile=None, volumes=None):
         "Creates and configures an extractor-object"
         
         self._to = dest
         self._from = source
         self._pwd = pwds
+        self._profile = profile
+        self._volumes = volumes
         self.status = None
+        self.result = False
     
-    def extract(self, filename, proc=None):
-        "Starts extractor-utility and extracts packets."
+    def extract_job(self, filename, proc=None):
+        """ extract_job(self, filename, proc=None)
+        
+        Job (see forks.run_job) which tries every password, self.result
+        is True after the job if extraction was successful.
+        """
         
         file_path = os.path.join(self._from, filename)
+        self.result = False
         
         for pwd in self._pwd:
-            unr = unrar.UnrarSpoon(file_path, self._to, pwd)
-            status = unr.update_loop(callback=proc)
+            unr = unrar.UnrarSpoon(file_path, self._to, pwd,
+                profile=self._profile, volumes=self._volumes)
+            yield (unr, proc)
+            status = unr.get_status()
             
             self.status = status
             
@@ -27,6 +38,11 @@ class extractor(object):
                 if not (proc is None):
                     proc(status)
                 
-                return True
+                self.result = True
+                return
+    
+    def extract(self, filename, proc=None):
+        "Starts extractor-utility and extracts packets."
         
-        return False
+        forks.run_job(self.extract_job(filename, proc=proc))
+        return self.result
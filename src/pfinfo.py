@@ -1,11 +1,16 @@
 import socket
-import Queue
+import select
+import os
+import errno
+import fcntl
+import collections
 import threading
 import time
 import copy
 import logging
 import sys
 import traceback
+import pfutil
 
 LOGGER_NAME = 'pf-info'
 
@@ -29,34 +34,115 @@ else:
     log = logging.getLogger(LOGGER_NAME)
     log.setLevel(logging.CRITICAL)
 
-
 DEFAULT_SOCKET_TIMEOUT = 0.5
 DEFAULT_TIMEOUT = 1.0
-BIND_WAITTIME = 60.0
+RECV_SIZE = 4096
+SEND_SIZE = 64 * 1024
+# a client sends this line to get a new snapshot
+RESYNC_REQUEST = 'resync'
+REMOVED_PREFIX = '- '
+# a client with more unsent bytes or which hasn't taken any for that
+# long is dropped
+MAX_QUEUED = 1024 * 1024
+CLIENT_TIMEOUT = 60.0
+# handover waits that long for clients to take their half sent messages
+HANDOVER_TIMEOUT = 1.0
+# kinds of queued messages, status messages are coalesced
+OTHER = 'other'
+SNAPSHOT = 'status'
+DELTA = 'delta'
+
+
+class _client(object):
+    """ _client(sock, address)
+    
+    An info client and what it hasn't got yet: out holds (kind, data,
+    names) messages, data None is built when it's sent (a snapshot or a
+    delta of the packets names).
+    """
+    
+    def __init__(self, sock, address):
+        
+        self.sock = sock
+        self.address = address
+        self.out = collections.deque()
+        # the message which is being sent
+        self.buffer = ''
+        self.queued = 0
+        # since when the client has unsent messages, when it took bytes
+        self.since = None
+        self.last_sent = time.time()
+        self.sent = 0
+        self.coalesced = 0
+        self.request = ''
+    
+    def pending(self):
+        
+        return self.buffer != '' or len(self.out) > 0
+
 
 class info_server(object):
+    """ info_server(port, sock=None, clients=[])
+    
+    Tells the clients what's going on, every message ends with an empty
+    line. A client gets a snapshot first ('status ' and a line
+    '<name> <status>' per packet), then 'delta ' messages with the lines
+    of the packets which have changed and a line '- <name>' per removed
+    packet, 'msg ' and 'stats ' messages. A client which sends a line
+    'resync' gets a new snapshot.
     
-    def __init__(self, port):
-        "Initializes info server object, listens on port 'port'."
+    One thread sends to all clients without blocking. If a client hasn't
+    got its last status message when the next one comes, they are merged
+    into one (with the latest status of the packets, built when it's
+    sent). Clients which fall behind more than MAX_QUEUED bytes or
+    CLIENT_TIMEOUT seconds are dropped.
+    """
+    
+    def __init__(self, port, sock=None, clients=[]):
+        """ __init__(self, port, sock=None, clients=[])
+        
+        Initializes info server object, listens on port 'port' or takes
+        over the listening socket sock and its clients (see handover).
+        """
         
-        self._msgqueue = Queue.Queue()
         self._lock = threading.RLock()
-        self._msg_running = True
-        self._acc_running = True
+        self._running = True
+        # sockets are kept open for the next process
+        self._handover = False
         
         self._log = logging.getLogger(LOGGER_NAME)
         
+        # packet name -> (version, status line), names in packet order
+        self._status = {}
+        self._names = []
+        self._old_stats = ""
+        self._dropped = 0
+        
+        # the clients of the last process get a snapshot like new ones
         self._clients = []
-        self._old_status = ""
-        self._accept_thread = threading.Thread(target=self._accept,
-            args=(port,))
-        self._msg_thread = threading.Thread(target=self._msg)
+        self._lock.acquire()
+        try:
+            for sock in clients:
+                sock.setblocking(0)
+                client = _client(sock, _peer(sock))
+                self._clients.append(client)
+                self._queue(client, None, SNAPSHOT)
+        finally:
+            self._lock.release()
         
-        self._log.info("starting accept-thread...")
-        self._accept_thread.start()
+        if sock is None:
+            sock = pfutil.listen(port)
         
-        self._log.info("starting msg-thread...")
-        self._msg_thread.start()
+        self._sock = sock
+        # new messages wake the loop up
+        (self._wake_read, self._wake_write) = os.pipe()
+        for fd in (self._wake_read, self._wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        
+        self._thread = threading.Thread(target=self._loop,
+            name="Info-Server")
+        self._log.info("starting info-server thread...")
+        self._thread.start()
     
     def _correct_msg(self, msg):
         "checks if message has right format, returns valid message."
@@ -76,114 +162,329 @@ class info_server(object):
         "Pushes new message on queue and tells every client."
         
         msg = self._correct_msg(msg)
-        self._msgqueue.put("msg " + msg + '\n\n')
-        
-    def _msg(self):
-        "Message Loop, processes every message which was put into queue."
-        
-        while self._msg_is_running():
-            try:
-                msg = self._msgqueue.get(True, DEFAULT_TIMEOUT)
-                dead_clients = []
-                
-                self._lock.acquire()
-                try:
-                    for client in self._clients:
-                        try:
-                            client.sendall(msg)
-                        except socket.error:
-                            dead_clients.append(client.getsockname())
-                            self._clients.remove(client)
-                finally:
-                    self._lock.release()
-                
-                for client_addr in dead_clients:
-                    self._log.debug("client (%s:%d) was removed" % 
-                        client_addr) 
-            except Queue.Empty:
-                pass
+        self._broadcast("msg " + msg + '\n\n')
+    
+    def _broadcast(self, msg, kind=OTHER, names=None):
+        "Queues msg for every client (see _queue)."
         
-        self._log.info("shutting down info-server")
         self._lock.acquire()
         try:
             for client in self._clients:
-                client.close()
+                self._queue(client, msg, kind, names)
         finally:
             self._lock.release()
         
+        self._wake()
     
-    def update_status(self, packets, force=False):
-        "updates current buffer."
+    def _queue(self, client, msg, kind=OTHER, names=None):
+        """ _queue(self, client, msg, kind=OTHER, names=None)
+        
+        Queues msg for client (lock has to be held). A SNAPSHOT (msg is
+        None) replaces its unsent status messages, a DELTA (of the
+        packets names) is merged into an unsent one, both are built from
+        the latest status when they are sent then.
+        """
         
+        if not client.pending():
+            client.since = time.time()
         
-        buffer = ""
-        for i in packets:
-            buffer += "".join((i.get_name(), ' ', i.status(), '\n'))
+        unsent = [item for item in client.out if item[0] != OTHER]
+        if kind == DELTA and len(unsent) > 0:
+            # behind, the unsent message will have the latest status
+            client.coalesced += 1
+            (old_kind, old_msg, old_names) = unsent[0]
+            if old_kind == DELTA:
+                index = list(client.out).index(unsent[0])
+                client.out[index] = (DELTA, None, old_names +
+                    [name for name in names if not (name in old_names)])
+                client.queued -= len(old_msg or '')
+            return
         
-        buffer = self._correct_msg(buffer)
+        if kind == SNAPSHOT and len(unsent) > 0:
+            client.coalesced += len(unsent)
+            client.out = collections.deque([item for item in client.out
+                if item[0] == OTHER])
+            client.queued -= sum([len(item[1] or '') for item in unsent])
+        
+        client.out.append((kind, msg, names))
+        client.queued += len(msg or '')
     
+    def _wake(self):
+        
         self._lock.acquire()
-        try:    
-            if (buffer != '' and buffer != self._old_status):
-                self._msgqueue.put("status " + buffer + '\n\n')
-                self._old_status = buffer
-            elif force:
-                self._msgqueue.put("status " + buffer + '\n\n')
-                self._old_status = buffer
-             
+        try:
+            if not (self._wake_write is None):
+                os.write(self._wake_write, 'x')
+        except OSError:
+            # the pipe is full, the loop wakes up anyway
+            pass
         finally:
             self._lock.release()
+    
+    def update_status(self, packets, force=False):
+        """ update_status(self, packets, force=False)
+        
+        Tells every client the packets which have changed (a delta), only
+        packets with a new version (see pf_packet.get_version) are
+        formatted. If force is set, everything is formatted and sent as
+        a snapshot.
+        """
+        
+        changed = []
+        
+        self._lock.acquire()
+        try:
+            names = []
+            for pack in packets:
+                name = pack.get_name()
+                names.append(name)
+                version = pack.get_version()
+                old = self._status.get(name)
+                if force or old is None or old[0] != version:
+                    line = self._correct_msg(name + ' ' + pack.status())
+                    if old is None or old[1] != line:
+                        changed.append(name)
+                    self._status[name] = (version, line)
+            
+            current = set(names)
+            removed = [name for name in self._names if not (name in current)]
+            for name in removed:
+                del self._status[name]
+            self._names = names
             
-    def _accept(self, port):
-        "This loop accepts new connections."
+            if force:
+                self._broadcast(None, SNAPSHOT)
+            elif len(changed) > 0 or len(removed) > 0:
+                self._broadcast(self._delta(changed + removed),
+                    DELTA, changed + removed)
+        finally:
+            self._lock.release()
+    
+    def _snapshot(self):
+        "Returns the status message of all packets (lock has to be held)."
         
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        return ("status " + "\n".join([self._status[name][1]
+            for name in self._names]) + '\n\n')
+    
+    def _delta(self, names):
+        "Returns the delta message of packets names (lock has to be held)."
+        
+        lines = []
+        for name in names:
+            if name in self._status:
+                lines.append(self._status[name][1])
+            else:
+                lines.append(REMOVED_PREFIX + name)
+        return "delta " + "\n".join(lines) + '\n\n'
+    
+    def update_stats(self, stats, force=False):
+        """ update_stats(self, stats, force=False)
         
+        Tells every client the counters in stats (dict name -> value),
+        if they have changed.
+        """
+        
+        buffer = " ".join(["%s %s" % item for item in sorted(stats.items())])
+        
+        self._lock.acquire()
         try:
-            sock.bind(('', port))
-        except socket.error:
-            self._log.warning("socket.bind failed (retrying once) %s" % 
-                traceback.format_exc())
-            time.sleep(BIND_WAITTIME)
-            sock.bind(('', port))
-            self._log.info("now bind worked...")
+            if buffer != self._old_stats or force:
+                self._broadcast("stats " + buffer + '\n\n')
+                self._old_stats = buffer
+        finally:
+            self._lock.release()
+    
+    def client_stats(self):
+        """ client_stats(self)
+        
+        Returns (address, unsent bytes, lag in seconds, coalesced status
+        messages, sent bytes) per client, the lag is how long the client
+        has had unsent messages, and the number of dropped clients.
+        """
+        
+        now = time.time()
+        self._lock.acquire()
+        try:
+            stats = []
+            for client in self._clients:
+                lag = 0.0
+                if client.pending():
+                    lag = now - client.since
+                stats.append((client.address, client.queued, lag,
+                    client.coalesced, client.sent))
+            return (stats, self._dropped)
+        finally:
+            self._lock.release()
+    
+    def _loop(self):
+        "Accepts clients, reads their requests and sends their messages."
         
-        sock.listen(100)
-        sock.settimeout(DEFAULT_SOCKET_TIMEOUT)
+        self._sock.setblocking(0)
         
-        while self._acc_is_running():
+        while self._is_running():
+            self._lock.acquire()
             try:
-                client, address = sock.accept()
-                self._lock.acquire()
-                try:
-                    self._clients.append(client)
-                finally:
-                    self._lock.release()
-                peer = client.getpeername()
-                self._log.debug("accepted new client (%s:%d)" % peer)
-            except socket.timeout:
+                clients = dict([(client.sock.fileno(), client)
+                    for client in self._clients])
+                writers = [fd for (fd, client) in clients.iteritems()
+                    if client.pending()]
+            finally:
+                self._lock.release()
+            
+            try:
+                (readable, writable, errors) = select.select(
+                    [self._sock.fileno(), self._wake_read] + clients.keys(),
+                    writers, [], DEFAULT_TIMEOUT)
+            except select.error:
+                # a signal
+                continue
+            
+            for fd in readable:
+                if fd == self._sock.fileno():
+                    self._accept()
+                elif fd == self._wake_read:
+                    self._drain_wake()
+                elif fd in clients:
+                    self._read_request(clients[fd])
+            
+            for fd in writable:
+                self._send(clients[fd])
+            
+            self._drop_slow()
+        
+        self._log.info("shutting down info-server")
+        if not self._handover:
+            self._sock.close()
+            self._lock.acquire()
+            try:
+                for client in self._clients:
+                    client.sock.close()
+            finally:
+                self._lock.release()
+    
+    def _drain_wake(self):
+        
+        try:
+            while os.read(self._wake_read, RECV_SIZE) != '':
                 pass
-            except socket.error:
-                self._log.debug("socket error happend...")
+        except OSError:
+            pass
+    
+    def _accept(self):
+        "Accepts a new client, it gets a snapshot first."
+        
+        try:
+            sock, address = self._sock.accept()
+        except socket.error:
+            self._log.debug("socket error happend...")
+            return
+        
+        sock.setblocking(0)
+        client = _client(sock, address)
+        self._lock.acquire()
+        try:
+            self._clients.append(client)
+            self._queue(client, None, SNAPSHOT)
+            if self._old_stats != "":
+                self._queue(client, "stats " + self._old_stats + '\n\n')
+        finally:
+            self._lock.release()
         
-        self._log.info("shutting down accept-loop")
-        sock.close()
+        self._log.debug("accepted new client (%s:%d)" % address)
+    
+    def _read_request(self, client):
+        "Reads from client, answers 'resync' by a snapshot."
+        
+        try:
+            data = client.sock.recv(RECV_SIZE)
+        except socket.error, ex:
+            if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        
+        self._lock.acquire()
+        try:
+            if data == '':
+                # closed by the client
+                self._remove(client)
+                return
             
-    def _msg_is_running(self):
+            lines = (client.request + data).split('\n')
+            # a client which never ends its line isn't kept up with
+            client.request = lines.pop()[-RECV_SIZE:]
+            for line in lines:
+                if line.strip('\r') == RESYNC_REQUEST:
+                    self._queue(client, None, SNAPSHOT)
+                else:
+                    self._log.debug("unknown request: %s" % line)
+        finally:
+            self._lock.release()
+    
+    def _send(self, client):
+        "Sends what client takes without blocking."
+        
+        self._lock.acquire()
+        try:
+            while client in self._clients:
+                if client.buffer == '':
+                    if len(client.out) <= 0:
+                        client.since = None
+                        break
+                    (kind, msg, names) = client.out.popleft()
+                    if kind == SNAPSHOT:
+                        msg = self._snapshot()
+                        client.queued += len(msg)
+                    elif msg is None:
+                        msg = self._delta(names)
+                        client.queued += len(msg)
+                    client.buffer = msg
+                
+                try:
+                    sent = client.sock.send(client.buffer[:SEND_SIZE])
+                except socket.error, ex:
+                    if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    self._remove(client)
+                    break
+                
+                client.buffer = client.buffer[sent:]
+                client.queued -= sent
+                client.sent += sent
+                client.last_sent = time.time()
+        finally:
+            self._lock.release()
+    
+    def _drop_slow(self):
+        "Drops clients which are too far behind."
         
+        now = time.time()
         self._lock.acquire()
         try:
-            run = copy.copy(self._msg_running)
-            return run
+            for client in list(self._clients):
+                if not client.pending():
+                    continue
+                stalled = now - max(client.last_sent, client.since)
+                if client.queued > MAX_QUEUED or stalled > CLIENT_TIMEOUT:
+                    self._log.info("dropping slow client (%s:%d), %d bytes"
+                        " unsent" % (client.address + (client.queued,)))
+                    self._dropped += 1
+                    self._remove(client)
         finally:
             self._lock.release()
     
-    def _acc_is_running(self):
+    def _remove(self, client):
+        "Forgets client and closes it (lock has to be held)."
+        
+        if client in self._clients:
+            self._clients.remove(client)
+            client.sock.close()
+            self._log.debug("client (%s:%d) was removed" % client.address)
+    
+    def _is_running(self):
         
         self._lock.acquire()
         try:
-            run = copy.copy(self._acc_running)
-            return run
+            return self._running
         finally:
             self._lock.release()
     
@@ -192,16 +493,62 @@ class info_server(object):
         
         self._lock.acquire()
         try:
-            self._acc_running = False
+            self._running = False
+        finally:
+            self._lock.release()
+        
+        self._wake()
+        self._thread.join()
+        
+        self._lock.acquire()
+        try:
+            # kill can be called again (after handover)
+            if not (self._wake_write is None):
+                os.close(self._wake_read)
+                os.close(self._wake_write)
+                self._wake_read = None
+                self._wake_write = None
         finally:
             self._lock.release()
+    
+    def handover(self):
+        """ handover(self)
         
-        self._accept_thread.join()
+        Stops the server like kill, but leaves the listening socket and
+        the clients open for another process (see __init__), returns
+        (listening socket, clients).
+        """
         
         self._lock.acquire()
         try:
-            self._msg_running = False
+            self._handover = True
         finally:
             self._lock.release()
         
-        self._msg_thread.join()
+        self.kill()
+        # queued messages are lost, the next process sends a snapshot
+        # anyway, but a half sent one has to be finished
+        deadline = time.time() + HANDOVER_TIMEOUT
+        socks = []
+        for client in self._clients:
+            if client.buffer != '':
+                try:
+                    client.sock.settimeout(max(deadline - time.time(),
+                        0.001))
+                    client.sock.sendall(client.buffer)
+                except socket.error:
+                    self._log.info("client (%s:%d) didn't take its last "
+                        "message" % client.address)
+                    client.sock.close()
+                    continue
+            socks.append(client.sock)
+        return (self._sock, socks)
+
+
+def _peer(sock):
+    "Address of the other end of sock, ('?', 0) if it's unknown."
+    
+    try:
+        return sock.getpeername()
+    except socket.error:
+        return ('?', 0)
@@ -8,9 +8,15 @@ import pfutil
 import linering
 import logging
 import pfpacket
+import forks
+import curl
 import copy
+import traceback
 
 LOGGER_NAME = 'pf-manager'
+WORKER_COUNT = 2
+DEFAULT_WEIGHT = 1.0
+CHECKPOINT_TIMEOUT = 10.0
 
 import __main__
 if 'DEBUG_' in dir(__main__):
@@ -32,13 +38,153 @@ else:
     log = logging.getLogger(LOGGER_NAME)
     log.setLevel(logging.CRITICAL)
 
+def parse_bandwidth(text):
+    """ parse_bandwidth(text)
+    
+    Parses a bandwidth profile, either just a rate ('200k', see
+    curl.parse_rate) or time=rate items ('8:00=200k 23:00=0'), every rate
+    applies from its time of day on (until the next one, the last one
+    until the first one of the next day). A rate of 0 means unlimited.
+    Returns sorted list of (minute of day, rate), raises ValueError.
+    """
+    
+    profile = []
+    
+    for item in text.split():
+        if not ('=' in item):
+            profile.append((0, curl.parse_rate(item)))
+            continue
+        
+        (day_time, rate) = item.split('=', 1)
+        (hours, sep, minutes) = day_time.partition(':')
+        minute = int(hours) * 60 + int(minutes or 0)
+        if minute < 0 or minute >= 24 * 60:
+            raise ValueError("invalid time of day: %s" % day_time)
+        profile.append((minute, curl.parse_rate(rate)))
+    
+    profile.sort()
+    return profile
+
+
+class bandwidth(object):
+    """ bandwidth
+    
+    Shares the download rate of the current time of day (see
+    parse_bandwidth) between all packets which are downloading, weighted
+    by their weight (DEFAULT_WEIGHT if not set). Every downloading packet
+    gets its own curl.TokenBucket, rebalance (called by the manager)
+    updates the rates of all buckets.
+    """
+    
+    def __init__(self, profile=[]):
+        
+        self._lock = threading.RLock()
+        self._profile = list(profile)
+        self._weights = {}
+        self._buckets = {}
+    
+    def total_rate(self, now=None):
+        "Rate at time now (default: current time), 0 means unlimited."
+        
+        if len(self._profile) <= 0:
+            return 0
+        
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        
+        # before the first item of the day, the last one still applies
+        rate = self._profile[-1][1]
+        for (start, item_rate) in self._profile:
+            if start > minute:
+                break
+            rate = item_rate
+        return rate
+    
+    def get_weight(self, name):
+        
+        self._lock.acquire()
+        try:
+            return self._weights.get(name, DEFAULT_WEIGHT)
+        finally:
+            self._lock.release()
+    
+    def set_weight(self, name, weight):
+        
+        self._lock.acquire()
+        try:
+            self._weights[name] = weight
+            self.rebalance()
+        finally:
+            self._lock.release()
+    
+    def acquire(self, name):
+        "Returns token bucket for packet name, which starts downloading."
+        
+        self._lock.acquire()
+        try:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = curl.TokenBucket()
+                self._buckets[name] = bucket
+            self.rebalance()
+            return bucket
+        finally:
+            self._lock.release()
+    
+    def release(self, name):
+        "Packet name has stopped downloading."
+        
+        self._lock.acquire()
+        try:
+            if name in self._buckets:
+                del self._buckets[name]
+                self.rebalance()
+        finally:
+            self._lock.release()
+    
+    def rebalance(self):
+        
+        total = self.total_rate()
+        
+        self._lock.acquire()
+        try:
+            weights = dict([(name, self._weights.get(name, DEFAULT_WEIGHT))
+                for name in self._buckets])
+            weight_sum = sum(weights.values())
+            
+            for (name, bucket) in self._buckets.iteritems():
+                rate = 0
+                if total > 0 and weight_sum > 0:
+                    # never 0, that would be unlimited
+                    rate = max(1, int(total * weights[name] / weight_sum))
+                if bucket.get_rate() != rate:
+                    bucket.set_rate(rate)
+        finally:
+            self._lock.release()
+    
+    def rates(self):
+        "Returns dict packet name -> current rate of all downloading packets."
+        
+        self._lock.acquire()
+        try:
+            return dict([(name, bucket.get_rate())
+                for (name, bucket) in self._buckets.iteritems()])
+        finally:
+            self._lock.release()
+
+
 class manager(object):
     
     def __init__(self, config, detainer, info=None, load_pending=True, 
-        use_info_thread=False):
+        use_info_thread=False, use_reactor=False, max_active=WORKER_COUNT,
+        resolver=None):
         
         self._running = True
+        # links of a packet are passed through it before it's started
+        self._resolver = resolver
         self._packets = []
+        # name -> packet, packets are never removed
+        self._by_name = {}
         self._config = copy.copy(config)
         self._lock = threading.RLock()
         self._log = logging.getLogger(LOGGER_NAME)
@@ -47,17 +193,35 @@ class manager(object):
         self._cmds = Queue.Queue()
         self._worker = []
         self._info_thread = None
+        self._reactor = None
+        self._bandwidth = bandwidth(self._config.get('bandwidth', []))
+        self._loaded = threading.Event()
+        self._load_thread = None
+        # packet jobs which haven't ended (their children aren't reaped)
+        self._jobs = 0
+        self._jobs_done = threading.Condition(self._lock)
+        
+        if use_reactor:
+            # one thread supervises the children of all active packets,
+            # worker threads only hand packets over to it
+            self._active = threading.Semaphore(max_active)
+            self._reactor = forks.Reactor()
+            self._reactor.start()
         
         if load_pending:
-            for link in self._detainer.get_pending():
-                self._add_link(link)
+            # commands are accepted while the packets are built
+            self._load_thread = threading.Thread(target=self._load_pending,
+                name="Load-Thread")
+            self._load_thread.start()
+        else:
+            self._loaded.set()
         
         if (not (info is None)) and use_info_thread:
             self._info_thread = threading.Thread(
                 target=self._info_loop, name="Info-Thread")
             self._info_thread.start()
         
-        for i in xrange(2):
+        for i in xrange(WORKER_COUNT):
             self._worker.append(threading.Thread(target=self._workloop,
                 name=("Worker-%d" % i)))
         
@@ -79,8 +243,44 @@ class manager(object):
         if not self._info is None:
             self._info.update_status(self.get_packets(), force=force)
     
-    def _add_link(self, link):
-        "Only used by 'add' to add just one link to the list."
+    def _load_pending(self):
+        "Adds the pending links of the detainer to their packets."
+        
+        count = 0
+        for link in self._detainer.get_pending():
+            if not self._is_running():
+                break
+            if self._add_link(link, pending=True):
+                count += 1
+        
+        self._log.info("loaded %d pending links" % count)
+        self._loaded.set()
+        self.update_info()
+    
+    def wait_loaded(self, timeout=None):
+        """ wait_loaded(self, timeout=None)
+        
+        Waits until the pending links are loaded (see __init__), returns
+        True if they are.
+        """
+        
+        self._loaded.wait(timeout)
+        return self._loaded.is_set()
+    
+    def _is_running(self):
+        
+        self._lock.acquire()
+        try:
+            return self._running
+        finally:
+            self._lock.release()
+    
+    def _add_link(self, link, pending=False):
+        """ _add_link(self, link, pending=False)
+        
+        Only used by 'add' to add just one link to the list, pending
+        links are already known to the detainer.
+        """
         
         result = pfutil.PACKET_NAME_RE.search(link)
         
@@ -96,25 +296,26 @@ class manager(object):
         
         self._lock.acquire()
         try:
-            pack = None
-            
-            for i in self._packets:
-                if i.has_name(name):
-                    pack = i
-                    break
-            
+            pack = self._by_name.get(name)
             if pack is None:
-                pack = pfpacket.pf_packet(name, repeated=was_downloaded)
-                self._packets.append(pack)
+                pack = self._new_packet(name, was_downloaded)
         finally:
             self._lock.release()
         
-        if not was_downloaded:
+        if not (was_downloaded or pending):
             self._detainer.added(link)
         
         pack.add(link) # now its outside the locked block...
         return True
     
+    def known_links(self):
+        "Returns a set of the links of all packets and pending links."
+        
+        links = set(self._detainer.get_pending())
+        for pack in self.get_packets():
+            links.update(pack.get_links())
+        return links
+    
     def padd(self, links):
         "Adds all elements of 'links' to download."
         
@@ -145,23 +346,32 @@ class manager(object):
         except:
             self._log.error("no 'pwd' section in config (this is a problem)")
     
+    def _new_packet(self, name, repeated):
+        "Creates and adds packet name (the lock has to be held)."
+        
+        pack = pfpacket.pf_packet(name, repeated=repeated)
+        self._packets.append(pack)
+        self._by_name[name] = pack
+        return pack
+    
     def _find_packet(self, packet_name):
         
         self._lock.acquire()
         try:
-            for packet in self._packets:
-                if packet.has_name(packet_name):
-                    return packet
+            return self._by_name.get(packet_name)
         finally:
             self._lock.release()
         
-        return None
-        
     
     def pstart(self, packet_name):
         
+        result = self._start(self._find_packet(packet_name), packet_name)
+        self._detainer.sync()
+        return result
+    
+    def _start(self, packet, packet_name):
+        
         result = False
-        packet = self._find_packet(packet_name)
         
         if not (packet is None):
             if packet.set_waiting():
@@ -177,14 +387,21 @@ class manager(object):
         else:
             self._log.warning("couldn't start packet %s" % packet_name)
         
-        self._detainer.sync()
         return result
     
     
     def pkill(self, packet_name):
         
+        result = self._kill(self._find_packet(packet_name), packet_name)
+        
+        # well... no real need for that...
+        self._detainer.sync()
+        
+        return result
+    
+    def _kill(self, packet, packet_name):
+        
         result = False
-        packet = self._find_packet(packet_name)
         
         if not (packet is None):
             packet.kill()
@@ -195,16 +412,43 @@ class manager(object):
         else:
             self._log.warning("couldn't kill packet %s" % packet_name)
         
-        # well... no real need for that...
-        self._detainer.sync()
-        
         return result
     
     
+    def pweight(self, packet_name, weight):
+        """ pweight(self, packet_name, weight)
+        
+        Sets weight of packet, its share of the bandwidth is proportional
+        to its weight (only matters if there is a bandwidth limit).
+        """
+        
+        if weight <= 0:
+            self._log.warning("invalid weight %s for packet %s" % (weight,
+                packet_name))
+            return False
+        
+        self._bandwidth.set_weight(packet_name, weight)
+        self._log.debug("weight of packet %s is %s" % (packet_name, weight))
+        return True
+    
+    def rates(self):
+        """ rates(self)
+        
+        Returns (total, rates) where total is the current bandwidth limit
+        and rates is a dict packet name -> rate of downloading packets
+        (bytes per second, 0 means unlimited).
+        """
+        
+        return (self._bandwidth.total_rate(), self._bandwidth.rates())
+    
     def preset(self, packet_name, force=False):
         
+        return self._reset(self._find_packet(packet_name), packet_name,
+            force)
+    
+    def _reset(self, packet, packet_name, force=False):
+        
         result = False
-        packet = self._find_packet(packet_name)
         
         if not (packet is None):
             result = packet.reset(force=force)
@@ -215,8 +459,102 @@ class manager(object):
             self._log.warning("couldn't reset packet %s" % packet_name)
         
         return result
+    
+    def pbatch(self, ops):
+        """ pbatch(self, ops)
+        
+        Applies ops (list of (command, packet name, argument)), command
+        is 'start', 'kill', 'reset' or 'weight' (argument is the weight,
+        else ignored). All ops are applied under one lock and the
+        detainer is synced once. Returns the results (True/False) in
+        order.
+        """
+        
+        self._lock.acquire()
+        try:
+            results = []
+            for (command, name, arg) in ops:
+                packet = self._by_name.get(name)
+                if command == 'start':
+                    results.append(self._start(packet, name))
+                elif command == 'kill':
+                    results.append(self._kill(packet, name))
+                elif command == 'reset':
+                    results.append(self._reset(packet, name))
+                elif command == 'weight':
+                    results.append(self.pweight(name, arg))
+                else:
+                    results.append(False)
+        finally:
+            self._lock.release()
+        
+        self._detainer.sync()
+        return results
 
     
+    def checkpoint(self, timeout=CHECKPOINT_TIMEOUT):
+        """ checkpoint(self, timeout=CHECKPOINT_TIMEOUT)
+        
+        Stops all packets for a restart and waits (up to timeout seconds)
+        until their jobs have ended, i.e. their curl/unrar children have
+        exited and have been reaped. Partial downloads stay on disk and
+        are resumed from their size. Returns the state of the packets
+        for restore (a list which can be stored as json), None if jobs
+        are still running after timeout (don't restart then).
+        """
+        
+        packets = self.get_packets()
+        states = []
+        for pack in packets:
+            state = pack.get_state()
+            state['weight'] = self._bandwidth.get_weight(pack.get_name())
+            states.append(state)
+            pack.kill()
+        
+        deadline = time.time() + timeout
+        self._lock.acquire()
+        try:
+            while self._jobs > 0:
+                left = deadline - time.time()
+                if left <= 0:
+                    self._log.error("%d packet jobs still running after %ss"
+                        % (self._jobs, timeout))
+                    return None
+                self._jobs_done.wait(left)
+        finally:
+            self._lock.release()
+        
+        self._detainer.sync()
+        return states
+    
+    def restore(self, states):
+        """ restore(self, states)
+        
+        Restores packets saved by checkpoint (in another process), the
+        ones which were waiting, downloading or extracting are started.
+        Waits for the pending links first (they are replaced).
+        """
+        
+        self.wait_loaded()
+        for state in states:
+            name = str(state['name'])
+            self._lock.acquire()
+            try:
+                pack = self._find_packet(name)
+                if pack is None:
+                    pack = self._new_packet(name, state['repeated'])
+            finally:
+                self._lock.release()
+            
+            pack.restore(state)
+            if state['weight'] != DEFAULT_WEIGHT:
+                self._bandwidth.set_weight(name, state['weight'])
+            if state['status'] in (pfpacket.WAITING, pfpacket.LOADING,
+                pfpacket.DOWNLOADED, pfpacket.EXTRACTING):
+                self.pstart(name)
+        
+        self.update_info()
+    
     # worker-threads-main-loop
     
     def _workloop(self):
@@ -233,7 +571,12 @@ class manager(object):
                 cmd = self._cmds.get(timeout=1)
                 if cmd[0] == 'start':
                     pack = cmd[1]
-                    self._work(pack)
+                    try:
+                        self._work(pack)
+                    except Exception:
+                        # the next packet can still be started
+                        self._log.error("couldn't start packet %s: %s"
+                            % (pack.get_name(), traceback.format_exc()))
                 
                 self._cmds.task_done()
             except Queue.Empty:
@@ -253,13 +596,98 @@ class manager(object):
             src = self._config['from']
             dest = self._config['to']
             pwds = copy.copy(self._config['pwd'])
+            dl_profile = self._config.get('dl-profile')
+            ex_profile = self._config.get('ex-profile')
+            engine = self._config.get('downloader', curl.ENGINE_CURL)
+            segments = self._config.get('segments', {})
+            write_buffer = self._config.get('write-buffer',
+                curl.WRITE_BUFFER_SIZE)
+            readahead = self._config.get('readahead', False)
+            error_pages = self._config.get('error-pages',
+                pfpacket.ERROR_PAGES)
+        finally:
+            self._lock.release()
+        
+        job = self._packet_job(pack, src, dest, pwds, rs_cookie,
+            dl_profile, ex_profile, engine, segments, self._bandwidth,
+            write_buffer, readahead, error_pages)
+        
+        if self._reactor is None:
+            self._resolve(pack)
+            self._job_started()
+            try:
+                forks.run_job(job)
+            finally:
+                self._job_finished()
+        else:
+            self._active.acquire()
+            try:
+                self._resolve(pack)
+            except:
+                self._active.release()
+                raise
+            
+            # from now on _job_finished releases the slot
+            self._job_started()
+            try:
+                self._reactor.add_job(job, finished=self._job_finished)
+            except:
+                self._job_finished()
+                raise
+    
+    def _job_started(self):
+        
+        self._lock.acquire()
+        try:
+            self._jobs += 1
         finally:
             self._lock.release()
+    
+    def _job_finished(self):
+        "Called when a packet job has ended, its children are reaped."
         
-        pack.download(src, rs_cookie)
-        pack.extract(src, dest, pwds)
+        if not (self._reactor is None):
+            self._active.release()
+        
+        self._lock.acquire()
+        try:
+            self._jobs -= 1
+            self._jobs_done.notifyAll()
+        finally:
+            self._lock.release()
+    
+    def _resolve(self, pack):
+        "Resolves the links of pack (just before it's downloaded)."
+        
+        if not (self._resolver is None):
+            failed = pack.resolve_links(self._resolver)
+            if failed > 0:
+                self._log.info(("couldn't resolve %d links of %s, " +
+                    "reset it to try again") % (failed, pack.get_name()))
+    
+    def _packet_job(self, pack, src, dest, pwds, rs_cookie, dl_profile=None,
+        ex_profile=None, engine=curl.ENGINE_CURL, segments={},
+        bandwidth=None, write_buffer=curl.WRITE_BUFFER_SIZE,
+        readahead=False, error_pages=pfpacket.ERROR_PAGES):
+        "Job (see forks.run_job) which downloads and extracts packet."
         
         pack_name = pack.get_name()
+        bucket = None
+        if not (bandwidth is None):
+            bucket = bandwidth.acquire(pack_name)
+        
+        try:
+            for step in pack.download_job(src, rs_cookie, profile=dl_profile,
+                engine=engine, segments=segments, bucket=bucket,
+                write_buffer=write_buffer, error_pages=error_pages):
+                yield step
+        finally:
+            if not (bandwidth is None):
+                bandwidth.release(pack_name)
+        
+        for step in pack.extract_job(src, dest, pwds, profile=ex_profile,
+            readahead=readahead):
+            yield step
         
         if pack.is_finished():
             self._log.debug("finished packet %s" % pack_name)
@@ -273,6 +701,8 @@ class manager(object):
         run = True
         
         while run:
+            # the rate depends on the time of day
+            self._bandwidth.rebalance()
             self.update_info()
             time.sleep(pfutil.UPDATE_INTERVAL)
             
@@ -297,6 +727,9 @@ class manager(object):
         for i in packets:
             i.kill()
         
+        if not (self._load_thread is None):
+            self._load_thread.join()
+        
         self._detainer.sync()
         
         self._log.info("waiting for workerloop(s) to quit")
@@ -304,6 +737,10 @@ class manager(object):
         for i in self._worker:
             i.join()
         
+        if not (self._reactor is None):
+            self._log.info("waiting for reactor to finish all packets")
+            self._reactor.shutdown()
+        
         if not (self._info is None):
             
             if not (self._info_thread is None):
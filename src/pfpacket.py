@@ -4,6 +4,7 @@ import threading
 import re
 import os
 import time
+import urlparse
 
 import forks
 import pfextractor
@@ -11,7 +12,16 @@ import curl
 
 UPDATE_INTERVAL = 0.5
 FILENAME_RE = re.compile(".*/([^/]*)")
+PART_NUMBER_RE = re.compile("[.]part(\\d+)[.]rar$")
 EXCEED_MSG = 'You have exceeded the download limit.'
+# signatures of error pages (name -> text, see curl.error_page)
+ERROR_PAGES = {'exceeded' : EXCEED_MSG}
+RETRY_COUNT = 3
+RETRY_BACKOFF = 30.0
+BATCH_SIZE = 10
+# curl is restarted (and resumes) if its share of the bandwidth changes
+# by more than that
+RATE_TOLERANCE = 0.25
 
 INIT = 'none'
 WAITING = 'wait'
@@ -22,6 +32,55 @@ FINISHED = 'fin'
 ERROR = 'err'
 KILLED = 'kill'
 
+USAGE_SUMS = (forks.CPU_USER, forks.CPU_SYS, forks.READ_BYTES,
+    forks.WRITE_BYTES, forks.WALL_TIME)
+
+def _file_size(path):
+    "Size of file at path, 0 if it doesn't exist."
+    
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+def _checked_rc(rc, dest, size):
+    """ _checked_rc(rc, dest, size)
+    
+    Returns curl.RC_PARTIAL instead of rc 0 if dest hasn't size (the
+    one the server announced, None if it didn't), else rc.
+    """
+    
+    if rc == 0 and not (size is None) and _file_size(dest) != size:
+        return curl.RC_PARTIAL
+    return rc
+
+def segment_count(link, segments):
+    """ segment_count(link, segments)
+    
+    Returns number of connections for link, segments maps host names to
+    counts (a key matches its host and all subdomains, the longest
+    matching key wins), 'default' is used if nothing matches (else 1).
+    """
+    
+    host = urlparse.urlsplit(link).hostname or ''
+    best = None
+    
+    for key in segments:
+        if host == key or host.endswith('.' + key):
+            if best is None or len(key) > len(best):
+                best = key
+    
+    if best is None:
+        return segments.get('default', 1)
+    return segments[best]
+
+def _rate_changed(old, new):
+    "True if a curl limited to rate old should be restarted with new."
+    
+    if old <= 0 or new <= 0:
+        return old != new
+    return abs(new - old) > RATE_TOLERANCE * old
+
 def mklist(*elements):
     return elements
 
@@ -35,12 +94,24 @@ class pf_packet(object):
         self._firstfile = ''
         self._dl_links = Queue.Queue()
         self._msg = None
+        self._spoon_status = None
+        self._spoon_msg = (None, '')
         self._status = INIT
         self._run = True
         self._lock = threading.RLock()
         self._dl_count = 0
         self._repeated = repeated
         self._successful_links = []
+        self._usage = {LOADING : {}, EXTRACTING : {}}
+        self._dl_status = None
+        self._attempts = {}
+        self._bucket = None
+        self._rate_restart = False
+        self._error_page = None
+        # bumped on every change of what status() shows
+        self._version = 0
+        # rate of the bucket in the last version
+        self._version_rate = None
     
     def add(self, link):
         "Adds link to packet."
@@ -55,10 +126,79 @@ class pf_packet(object):
                 
                 self._links.append(link)
                 self._dl_links.put(link)
+                self._version += 1
                 return True
         finally:
             self._lock.release()
     
+    def get_links(self):
+        "Get (a copy of) the links of the packet."
+        
+        self._lock.acquire()
+        try:
+            return list(self._links)
+        finally:
+            self._lock.release()
+    
+    def resolve_links(self, resolve):
+        """ resolve_links(self, resolve)
+        
+        Replaces the links of the packet by resolve(links) (a list of
+        (link, resolved link, error), see pfscan.resolve_needed). Links
+        which couldn't be resolved are kept as they are and the packet
+        is set to ERROR (its message names them), a reset retries them.
+        Returns the number of links which couldn't be resolved.
+        """
+        
+        results = resolve(self.get_links())
+        resolved = dict([(link, result) for (link, result, error)
+            in results if error is None])
+        failed = ["%s (%s)" % (link, error) for (link, result, error)
+            in results if not (error is None)]
+        
+        self._lock.acquire()
+        try:
+            self._links = [resolved.get(link, link) for link in self._links]
+            self._version += 1
+            queued = []
+            while True:
+                try:
+                    queued.append(self._dl_links.get(timeout=0))
+                except Queue.Empty:
+                    break
+            for link in queued:
+                self._dl_links.put(resolved.get(link, link))
+            
+            if len(failed) > 0 and not (self._status in (KILLED, LOADING,
+                EXTRACTING, FINISHED)):
+                self._status = ERROR
+                self._msg = "couldn't resolve %s" % ", ".join(failed)
+        finally:
+            self._lock.release()
+        
+        return len(failed)
+    
+    def get_version(self):
+        """ get_version(self)
+        
+        Returns a number which changes whenever status() does (progress,
+        status, links, ...), unchanged packets needn't be formatted.
+        """
+        
+        self._lock.acquire()
+        try:
+            # the bandwidth changes the rate of the bucket without
+            # telling the packet
+            rate = None
+            if self._status == LOADING and not (self._bucket is None):
+                rate = self._bucket.get_rate()
+            if rate != self._version_rate:
+                self._version_rate = rate
+                self._version += 1
+            return self._version
+        finally:
+            self._lock.release()
+    
     def has_name(self, name):
         
         self._lock.acquire()
@@ -83,9 +223,20 @@ class pf_packet(object):
             
             if self._msg:
                 fields.append(self._msg)
+            elif not (self._spoon_status is None):
+                fields.append(self._format_spoon_status())
             
             fields.append("status: %s" % self._status)
             
+            if self._status == LOADING and not (self._bucket is None):
+                rate = self._bucket.get_rate()
+                if rate > 0:
+                    fields.append("rate: %s/s" % curl.format_rate(rate))
+            
+            for phase in (LOADING, EXTRACTING):
+                if self._usage[phase]:
+                    fields.append(self._format_usage(phase))
+            
             if not self._run:
                 fields.append("info: killed packet must be reset!")
             
@@ -94,6 +245,53 @@ class pf_packet(object):
         
         return ", ".join(fields)
     
+    def _format_spoon_status(self):
+        "Formats last status of spoon (only if it has changed)."
+        
+        status = self._spoon_status
+        if not (self._spoon_msg[0] is status):
+            self._spoon_msg = (status, ", ".join(
+                ["%s: %s" % (k,v) for (k,v) in status.iteritems()]))
+        
+        return self._spoon_msg[1]
+    
+    def _format_usage(self, phase):
+        
+        usage = self._usage[phase]
+        return ("%s-usage: user %.2fs, sys %.2fs, rss %dk, read %d, " +
+            "write %d, wall %.1fs") % (phase, usage[forks.CPU_USER],
+            usage[forks.CPU_SYS], usage[forks.MAX_RSS] / 1024,
+            usage[forks.READ_BYTES], usage[forks.WRITE_BYTES],
+            usage[forks.WALL_TIME])
+    
+    def _account(self, phase, status):
+        "Adds resource usage of a finished spoon to phase (LOADING, ...)."
+        
+        self._lock.acquire()
+        try:
+            usage = self._usage[phase]
+            for key in USAGE_SUMS:
+                usage[key] = usage.get(key, 0) + status[key]
+            usage[forks.MAX_RSS] = max(usage.get(forks.MAX_RSS, 0),
+                status[forks.MAX_RSS])
+            self._version += 1
+        finally:
+            self._lock.release()
+    
+    def usage(self):
+        """ usage(self)
+        
+        Returns accumulated resource usage of all curl (LOADING) and unrar
+        (EXTRACTING) processes of this packet, keys like forks.CPU_USER.
+        """
+        
+        self._lock.acquire()
+        try:
+            return {LOADING : dict(self._usage[LOADING]),
+                EXTRACTING : dict(self._usage[EXTRACTING])}
+        finally:
+            self._lock.release()
+    
     def set_waiting(self):
         "Tries to set status to wait."
         
@@ -103,6 +301,7 @@ class pf_packet(object):
                 return False
             else:
                 self._status = WAITING
+                self._version += 1
                 return True
         finally:
             self._lock.release()
@@ -116,11 +315,15 @@ class pf_packet(object):
                 
                 self._status = INIT
                 self._run = True
+                self._msg = None
                 self._dl_links = Queue.Queue()
+                self._attempts = {}
+                self._version += 1
                 
                 if force:
                     self._successful_links = []
                     self._dl_count = 0
+                    self._usage = {LOADING : {}, EXTRACTING : {}}
                 else:
                     self._dl_count = len(self._successful_links)
                 
@@ -156,72 +359,327 @@ class pf_packet(object):
         finally:
             self._lock.release()
     
-    def _has_exceeded(self, filepath):
+    def download_job(self, dl_dir, cookie, *curl_param, **options):
+        """ download_job(self, dl_dir, cookie, *curl_param, **options)
         
-        if os.stat(filepath).st_size < 1000000:
-            f = open(filepath)
-            try:
-                data = f.read()
-                if data.find(EXCEED_MSG) >= 0:
-                    return True
-            finally:
-                f.close()
+        Job (see forks.run_job) which downloads all remaining links.
+        Partial files are resumed, failed links are retried (up to
+        RETRY_COUNT times, waiting RETRY_BACKOFF seconds, doubled for
+        every attempt) after all other links.
+        Options:
+        - profile: forks.ResourceProfile for curl
+        - engine: curl.ENGINE_CURL (default) or curl.ENGINE_NATIVE
+          (curl.HttpSpoon, curl_param is ignored)
+        - segments: dict host -> number of connections per link (only
+          native engine, see segment_count)
+        - batch: max. number of links downloaded by one curl process
+          (default BATCH_SIZE, only curl engine, see curl.CurlBatchSpoon)
+        - bucket: curl.TokenBucket which limits the rate (its rate is
+          passed to curl as --limit-rate, curl is restarted if it changes
+          by more than RATE_TOLERANCE)
+        - write_buffer: size of the write buffer of a connection (only
+          native engine, see curl.HttpSpoon)
+        - error_pages: signatures of error pages (default ERROR_PAGES),
+          a part which turns out to be one of them stops the packet
+        """
         
-        return False
-                
-    
-    def download(self, dl_dir, cookie, *curl_param):
+        profile = options.get('profile')
+        engine = options.get('engine', curl.ENGINE_CURL)
+        segments = options.get('segments', {})
+        batch = options.get('batch', BATCH_SIZE)
+        bucket = options.get('bucket')
+        write_buffer = options.get('write_buffer', curl.WRITE_BUFFER_SIZE)
+        error_pages = options.get('error_pages', ERROR_PAGES)
+        if engine == curl.ENGINE_NATIVE or not curl.batch_supported():
+            # one CurlSpoon per part
+            batch = 1
         
         self._lock.acquire()
         try:
             if self._status in (KILLED, LOADING, 
                 EXTRACTING, FINISHED, ERROR):
                 
-                return False
+                return
             else:
                 self._status = LOADING
                 self._msg = None
+                self._spoon_status = None
+                self._bucket = bucket
+                self._version += 1
         finally:
             self._lock.release()
         
-        try:
-            while 1:
-                link = self._dl_links.get(timeout=0)
-                filename = FILENAME_RE.search(link).group(1)
-                dest = os.path.join(dl_dir, filename)
+        retries = []
+        
+        while self._is_running():
+            links = self._next_links(batch)
+            if len(links) <= 0:
+                if len(retries) <= 0:
+                    break
                 
-                dl = curl.CurlSpoon(link, dest, args=curl_param,
-                    cookie=cookie)
+                # only failed links are left, wait for the first one
+                retries.sort()
+                (when, link) = retries.pop(0)
+                if when > time.time():
+                    yield (forks.Delay(when - time.time()), self._update)
+                    if not self._is_running():
+                        break
+                links = [link]
+            
+            parts = [(link, os.path.join(dl_dir,
+                FILENAME_RE.search(link).group(1))) for link in links]
+            
+            if (engine == curl.ENGINE_NATIVE and
+                curl.native_supported(parts[0][0])):
+                (link, dest) = parts[0]
+                for step in self._native_download(link, dest, cookie,
+                    segment_count(link, segments), bucket, write_buffer,
+                    error_pages):
+                    yield step
+                results = [(link, dest,
+                    self._dl_status[forks.RETURN_CODE])]
+            else:
+                args = curl_param
+                if max([_file_size(dest) for (link, dest) in parts]) > 0:
+                    args = args + ('-C', '-')
                 
-                status = dl.update_loop(callback=self._update)
+                callback = self._update
+                if not (bucket is None):
+                    rate = bucket.get_rate()
+                    if rate > 0:
+                        args = args + ('--limit-rate', str(rate))
+                    callback = (lambda status, rate=rate:
+                        self._update_limited(status, bucket, rate))
+                self._rate_restart = False
                 
-                if self._has_exceeded(dest):
-                    self._status = ERROR
-                    self._msg = "Maybe exceeded the daily limit..."
-                    return False
+                if len(parts) == 1:
+                    (link, dest) = parts[0]
+                    dl = curl.CurlSpoon(link, dest, args=args,
+                        cookie=cookie, profile=profile,
+                        signatures=error_pages)
+                else:
+                    dl = curl.CurlBatchSpoon(parts, args=args,
+                        cookie=cookie, profile=profile,
+                        signatures=error_pages)
                 
-                if status[forks.RETURN_CODE] == 0:
-                    self._successful_links.append(link)
+                yield (dl, callback)
+                status = dl.get_status()
+                self._account(LOADING, status)
                 
-                self._dl_count += 1
+                if not (dl.error_page is None):
+                    self._error_page = dl.error_page
                 
-        except Queue.Empty:
-            pass
+                if len(parts) == 1:
+                    rc = _checked_rc(status[forks.RETURN_CODE], dest,
+                        dl.size)
+                    if not (dl.error_page is None):
+                        rc = curl.RC_ERROR_PAGE
+                    results = [parts[0] + (rc,)]
+                else:
+                    results = [(link, dest, _checked_rc(rc, dest, size))
+                        for (link, dest, rc, code, size) in dl.results]
+                    # parts curl didn't get to (killed, crashed, ...)
+                    for (link, dest) in parts[len(results):]:
+                        results.append((link, dest,
+                            status[forks.RETURN_CODE] or curl.RC_PARTIAL))
+            
+            for (link, dest, rc) in results:
+                if rc != 0 and self._rate_restart and self._is_running():
+                    # stopped for a new rate, not a failed attempt
+                    self._dl_links.put(link)
+                elif not self._finish_link(link, dest, rc, retries):
+                    return
         
         self._lock.acquire()
         try:
-            self._status = DOWNLOADED
+            self._bucket = None
+            self._version += 1
+            if not self._run:
+                self._status = KILLED
+            else:
+                self._status = DOWNLOADED
         finally:
             self._lock.release()
+    
+    def _next_links(self, count):
+        "Takes up to count links from the download queue."
+        
+        links = []
+        while len(links) < count:
+            try:
+                links.append(self._dl_links.get(timeout=0))
+            except Queue.Empty:
+                break
+        return links
+    
+    def _finish_link(self, link, dest, rc, retries):
+        """ _finish_link(self, link, dest, rc, retries)
+        
+        Handles a finished download of link (curl return code rc), failed
+        links are added to retries. Returns False if the packet has
+        failed (got an error page, e.g. daily limit exceeded).
+        """
+        
+        self._version += 1
+        if rc == curl.RC_ERROR_PAGE:
+            if os.path.exists(dest):
+                os.remove(dest)
+            self._status = ERROR
+            if self._error_page == 'exceeded':
+                self._msg = "Maybe exceeded the daily limit..."
+            else:
+                self._msg = "Got an error page (%s)..." % self._error_page
+            return False
+        
+        if rc in (curl.RC_HTTP, curl.RC_RANGE) and os.path.exists(dest):
+            # don't resume an error page (or what couldn't be resumed)
+            os.remove(dest)
+        
+        if rc == 0:
+            self._successful_links.append(link)
+            self._dl_count += 1
+        elif rc == curl.RC_RANGE:
+            # can't resume, start again from the beginning
+            retries.append((time.time(), link))
+        elif self._retry(link):
+            attempt = self._attempts[link]
+            retries.append((time.time() +
+                RETRY_BACKOFF * 2 ** (attempt - 1), link))
+        else:
+            self._dl_count += 1
         
         return True
     
+    def _native_download(self, link, dest, cookie, count, bucket=None,
+        write_buffer=curl.WRITE_BUFFER_SIZE, error_pages=None):
+        """ _native_download(self, link, dest, cookie, count, bucket=None,
+                             write_buffer=curl.WRITE_BUFFER_SIZE,
+                             error_pages=None)
+        
+        Job which downloads link with count connections (if the server
+        supports ranges, else with one) or resumes a partial download,
+        final status is stored in self._dl_status. A partial segmented
+        download is resumed with one connection per missing range.
+        """
+        
+        ranges = curl.read_segments(dest)
+        if not (ranges is None):
+            seg = curl.SegmentedDownload(link, dest, _file_size(dest),
+                len(ranges), cookie=cookie, callback=self._update,
+                bucket=bucket, write_buffer=write_buffer, ranges=ranges)
+            yield seg.steps()
+            for spoon in seg.spoons:
+                self._account(LOADING, spoon.get_status())
+            
+            # failed ranges are kept for the next attempt
+            self._dl_status = seg.get_status()
+            if self._dl_status[forks.RETURN_CODE] != curl.RC_RANGE:
+                return
+        
+        offset = _file_size(dest)
+        if ranges is None and offset > 0:
+            dl = curl.HttpSpoon(link, dest, cookie=cookie, first=offset,
+                bucket=bucket, write_buffer=write_buffer)
+            yield (dl, self._update)
+            self._account(LOADING, dl.get_status())
+            self._dl_status = self._validate(dl, dest)
+            if self._dl_status[forks.RETURN_CODE] != curl.RC_RANGE:
+                return
+        
+        total = None
+        if count > 1:
+            # a blocking request, mustn't stop the reactor thread
+            probe = forks.Call(curl.probe_size, (link, cookie))
+            yield (probe, self._update)
+            total = probe.result
+            if not self._is_running():
+                self._dl_status = probe.get_status()
+                return
+        
+        if not (total is None) and total >= count * curl.MIN_SEGMENT_SIZE:
+            seg = curl.SegmentedDownload(link, dest, total, count,
+                cookie=cookie, callback=self._update, bucket=bucket,
+                write_buffer=write_buffer)
+            yield seg.steps()
+            for spoon in seg.spoons:
+                self._account(LOADING, spoon.get_status())
+            
+            self._dl_status = seg.get_status()
+            if self._dl_status[forks.RETURN_CODE] in (0, curl.RC_KILLED):
+                return
+        
+        dl = curl.HttpSpoon(link, dest, cookie=cookie, bucket=bucket,
+            write_buffer=write_buffer, signatures=error_pages)
+        yield (dl, self._update)
+        self._error_page = dl.error_page
+        self._account(LOADING, dl.get_status())
+        self._dl_status = self._validate(dl, dest)
+    
+    def _update_limited(self, status, bucket, rate):
+        "Callback of a curl limited to rate, stops it if bucket's changed."
+        
+        self._update(status)
+        
+        if _rate_changed(rate, bucket.get_rate()):
+            self._rate_restart = True
+            raise forks.KillForkException()
+    
+    def _validate(self, dl, dest):
+        """ _validate(self, dl, dest)
+        
+        Returns status of HttpSpoon dl, return code is set to
+        curl.RC_PARTIAL if dest hasn't the size the server announced.
+        """
+        
+        status = dl.get_status()
+        rc = _checked_rc(status[forks.RETURN_CODE], dest, dl.size)
+        if rc != status[forks.RETURN_CODE]:
+            values = dict(status)
+            values[forks.RETURN_CODE] = rc
+            return forks.StatusView(values, status.version + 1)
+        return status
+    
+    def _retry(self, link):
+        "Counts failed attempt of link, True if it should be retried."
+        
+        self._lock.acquire()
+        try:
+            attempt = self._attempts.get(link, 0) + 1
+            self._attempts[link] = attempt
+            return self._run and attempt <= RETRY_COUNT
+        finally:
+            self._lock.release()
+    
+    def _is_running(self):
+        
+        self._lock.acquire()
+        try:
+            return self._run
+        finally:
+            self._lock.release()
+    
+    def download(self, dl_dir, cookie, *curl_param, **options):
+        
+        forks.run_job(self.download_job(dl_dir, cookie, *curl_param,
+            **options))
+        
+        self._lock.acquire()
+        try:
+            return (self._status == DOWNLOADED)
+        finally:
+            self._lock.release()
+    
     def _update(self, status):
         
         self._lock.acquire()
         try:
-            self._msg = ", ".join(
-                ["%s: %s" % (k,v) for (k,v) in status.iteritems()])
+            # status is a read-only forks.StatusView, the message is
+            # only built if someone asks for it (an unchanged status is
+            # the same view, e.g. a heartbeat)
+            if not (self._msg is None and status is self._spoon_status):
+                self._msg = None
+                self._spoon_status = status
+                self._version += 1
             
             if not self._run:
                 self._status = KILLED
@@ -229,42 +687,134 @@ class pf_packet(object):
         finally:
             self._lock.release()
     
-    def extract(self, source, dest, pwds):
+    def extract_job(self, source, dest, pwds, profile=None, readahead=False):
+        """ extract_job(self, source, dest, pwds, profile=None,
+                        readahead=False)
+        
+        Job (see forks.run_job) which extracts the packet, profile
+        (forks.ResourceProfile) is used for unrar. If readahead is set,
+        every volume is read into the page cache while unrar extracts
+        the one before it.
+        """
         
         self._lock.acquire()
         try:
             if self._status in (KILLED, LOADING,
                  EXTRACTING, FINISHED, ERROR):
                 
-                return False
+                return
             else:
                 self._status = EXTRACTING
+                self._version += 1
                 self._msg = None
+                self._spoon_status = None
         finally:
             self._lock.release()
             
-        extr_obj = pfextractor.extractor(source, dest, pwds)
-         
-        result = extr_obj.extract(self._firstfile, proc=self._update)
+        volumes = None
+        if readahead:
+            volumes = [os.path.join(source, name)
+                for name in self._volume_names()]
+        
+        extr_obj = pfextractor.extractor(source, dest, pwds, profile=profile,
+            volumes=volumes)
+        
+        for step in extr_obj.extract_job(self._firstfile, proc=self._update):
+            yield step
+            self._account(EXTRACTING, step[0].get_status())
         
         self._lock.acquire()
         try:
             if self._status == KILLED:
-                return False
+                return
             
-            if result:
+            self._version += 1
+            if extr_obj.result:
                 self._status = FINISHED
-                return True
             else:
                 self._status = ERROR
-                return False
         finally:
             self._lock.release()
     
+    def _volume_names(self):
+        "File names of all parts in volume order."
+        
+        def part_number(name):
+            re_part = PART_NUMBER_RE.search(name)
+            if re_part is None:
+                return 0
+            return int(re_part.group(1))
+        
+        self._lock.acquire()
+        try:
+            names = [FILENAME_RE.search(link).group(1)
+                for link in self._links]
+        finally:
+            self._lock.release()
+        
+        names.sort(key=part_number)
+        return names
+    
+    def extract(self, source, dest, pwds, profile=None, readahead=False):
+        
+        forks.run_job(self.extract_job(source, dest, pwds, profile=profile,
+            readahead=readahead))
+        return self.is_finished()
+    
     def kill(self):
         
         self._lock.acquire()
         try:
             self._run = False
+            self._version += 1
+        finally:
+            self._lock.release()
+    
+    def get_state(self):
+        """ get_state(self)
+        
+        Returns the state which survives a restart (see restore), a dict
+        which can be stored as json.
+        """
+        
+        self._lock.acquire()
+        try:
+            return {'name' : self._name, 'links' : list(self._links),
+                'done' : list(self._successful_links),
+                'status' : self._status, 'run' : self._run,
+                'repeated' : self._repeated}
+        finally:
+            self._lock.release()
+    
+    def restore(self, state):
+        """ restore(self, state)
+        
+        Takes over links and finished links of state (see get_state).
+        Stopped packets (killed, failed or finished) keep their status,
+        the others can be started again, their finished links aren't
+        downloaded again and partial files are resumed.
+        """
+        
+        self._lock.acquire()
+        try:
+            # json gives unicode strings
+            self._links = [str(link) for link in state['links']]
+            self._successful_links = [str(link) for link in state['done']
+                if link in self._links]
+            self._dl_count = len(self._successful_links)
+            self._dl_links = Queue.Queue()
+            for link in self._links:
+                if not (link in self._successful_links):
+                    self._dl_links.put(link)
+            if len(self._links) > 0:
+                self._firstfile = FILENAME_RE.search(
+                    self._links[0]).group(1)
+            
+            self._version += 1
+            self._status = INIT
+            self._run = True
+            if state['status'] in (FINISHED, ERROR, KILLED):
+                self._status = str(state['status'])
+                self._run = state['run']
         finally:
             self._lock.release()
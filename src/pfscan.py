@@ -1,18 +1,21 @@
 import os
 import re
+import itertools
 import curl
+import pfutil
 
-SP_LINK = re.compile('http://([^\\",^ ]+)')
+SP_LINK = re.compile('http://([^\\",^\\s<>]+)')
+# scan_stream keeps at most that much of a chunk for the next one
+SCAN_MAX_LINK = 2048
 #prev = "http://([^\",^\n^/,^\\s,^<,^>]+)([^\",^\\s,^\n,^<,^>]*)"
 RSDL_LINK_STR = ("http://(?P<srv>[^ ,^.]+)[.]{1}rapidshare[.]{1}com" + 
     "/files/(?P<link>[^ ,^\\\"]+)")
 RSDL_BUILD_STR = "http://%(srv)s.rapidshare.com/files/%(link)s"
 RSDL_LINK_RE = re.compile(RSDL_LINK_STR)
 
-def _resolve_link(link):
+def _resolve_link(pool, link):
     
-    site = curl.simple_download(link, '-L')
-    result = RSDL_LINK_RE.search(site)
+    (result, site) = pool.match(link, RSDL_LINK_RE, '-L')
     if result is None:
         return None
     else:
@@ -22,28 +25,99 @@ def _resolve_link(link):
         return RSDL_BUILD_STR % group
 
 
-def resolve_links(links):
+def resolve_all(links, pool=None):
+    """ resolve_all(links, pool=None)
+    
+    Resolves links in parallel (pool: pfutil.resolver_pool), returns a
+    list of (link, resolved link, error) in the order of links (see
+    pfutil.resolver_pool.map).
+    """
+    
+    if pool is None:
+        pool = pfutil.resolver_pool()
+    
+    return pool.map(_resolve_link, links)
+
+
+def needs_resolving(link):
+    "True if link points to a page (see scanlinks), not to the file."
+    
+    return link.startswith('http://') and _wanted(link[len('http://'):])
+
+
+def resolve_needed(links, pool=None):
+    """ resolve_needed(links, pool=None)
+    
+    Like resolve_all, but links which don't need resolving are returned
+    as they are.
+    """
+    
+    results = dict([(result[0], result) for result in resolve_all(
+        [link for link in links if needs_resolving(link)], pool)])
+    return [results.get(link, (link, link, None)) for link in links]
+
+
+def resolve_links(links, pool=None):
     
     out = []
     
-    for link in links:
-        result = _resolve_link(link)
-        
+    for (link, result, error) in resolve_all(links, pool):
         if not (result is None):
             out.append(result)
     
     return out
 
 
+def _wanted(link):
+    
+    return (link.startswith("download.serienjunkies.org") or
+        link.startswith("rapidshare.com"))
+
+
 def scanlinks(data):
     
     lsf = SP_LINK.findall(data)
     links = []
         
     for i in lsf:
-        if i.startswith("download.serienjunkies.org"):
-            links.append('http://%s' % i)
-        elif i.startswith("rapidshare.com"):
+        if _wanted(i):
             links.append('http://%s' % i)
         
     return links
+
+
+def scan_stream(chunks, seen=None):
+    """ scan_stream(chunks, seen=None)
+    
+    Like scanlinks, but for data which comes in chunks (any iterable of
+    strings, e.g. a file read piece by piece), links may cross chunk
+    boundaries. Links in seen (a set) are skipped and yielded links are
+    added to it, without seen a link is yielded whenever it's found.
+    Only the end of a chunk (at most SCAN_MAX_LINK bytes) is kept, seen
+    is the only thing which grows with the input.
+    """
+    
+    tail = ''
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        data = tail + (chunk or '')
+        # the beginning of a link (up to 'http://') could be at the end
+        keep = len(data) - len('http://')
+        
+        for match in SP_LINK.finditer(data):
+            if match.end() == len(data) and not final:
+                # the next chunk could continue it
+                keep = match.start()
+                break
+            
+            keep = max(keep, match.end())
+            link = 'http://%s' % match.group(1)
+            if not _wanted(match.group(1)):
+                continue
+            if not (seen is None):
+                if link in seen:
+                    continue
+                seen.add(link)
+            yield link
+        
+        tail = data[max(keep, len(data) - SCAN_MAX_LINK, 0):]
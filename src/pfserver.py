@@ -3,11 +3,18 @@
 DEBUG_ = True
 
 import socket
+import select
+import errno
+import fcntl
 import sys
 import traceback
 import os
 import time
 import logging
+import itertools
+import threading
+import Queue
+import json
 import pfutil
 import pfpacket
 import pfinfo
@@ -15,6 +22,8 @@ import pfutil
 import pfscan
 import pfmanager
 import pfdetainer
+import forks
+import curl
 
 LOGGER_NAME = 'pf-server'
 
@@ -44,8 +53,91 @@ INFO_PORT = CMD_PORT + 1
 HISTORY_SIZE = 20
 ACCEPT_LOOP_TIMEOUT = 1.0
 USER_TIMEOUT = 8.0
-RECV_SIZE = 1
-BIND_WAITTIME = 60.0
+RECV_SIZE = 64 * 1024
+CMD_DELIMITER = '\n\n'
+# threads which run commands, a slow one doesn't stall the others
+COMMAND_WORKERS = 4
+# after 'keep-alive' a connection serves any number of commands (each
+# reply is framed as '<length>\n<reply>') until it's idle that long
+KEEP_ALIVE_TIMEOUT = 300.0
+# bulk imports are read and resolved piece by piece
+IMPORT_CHUNK_SIZE = 64 * 1024
+IMPORT_BATCH = 50
+# 'add' and 'import <file>' run as jobs, that many finished are kept
+JOB_HISTORY = 100
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+# links are resolved when they're added or when their packet starts
+RESOLVE_EARLY = 'early'
+RESOLVE_LATE = 'late'
+# 'restart' passes the listening sockets (and info clients) as a list of
+# fds in this variable to the new process, the packets in this file
+RESTART_ENV = 'PF_RESTART_FDS'
+RESTART_STATE = 'restart-state'
+MAX_ACTIVE_PACKETS = 8
+DEFAULT_LAUNCHER = forks.LAUNCHER_SPAWN
+DEFAULT_DOWNLOADER = curl.ENGINE_CURL
+# extraction shouldn't starve downloads (of disk time)
+DEFAULT_DL_PROFILE = ''
+DEFAULT_EX_PROFILE = 'nice=10 ioclass=be ioprio=7'
+
+def _parse(text):
+    """ _parse(text)
+    
+    Splits a command into [name] or [name, arguments], the name ends at
+    the first space or newline.
+    """
+    
+    name = text.split(' ', 1)[0].split('\n', 1)[0]
+    if len(text) > len(name):
+        return [name, text[len(name) + 1:]]
+    return [name]
+
+
+class _connection(object):
+    "State of a command connection."
+    
+    def __init__(self, sock):
+        
+        self.sock = sock
+        self.buffer = ''
+        # that much of buffer has been searched for CMD_DELIMITER
+        self.scanned = 0
+        self.out = ''
+        self.deadline = time.time() + USER_TIMEOUT
+        # a worker runs its command, it's answered or the client is gone
+        self.busy = False
+        self.done = False
+        self.gone = False
+        self.persistent = False
+    
+    def reply(self, reply):
+        "Queues reply for sending."
+        
+        if self.persistent:
+            self.out += "%d\n%s" % (len(reply), reply)
+        else:
+            self.out += reply
+            self.done = True
+        # the client has to read it in time (see pfserver._flush)
+        self.deadline = time.time() + USER_TIMEOUT
+    
+    def timeout(self):
+        
+        if self.persistent:
+            return KEEP_ALIVE_TIMEOUT
+        return USER_TIMEOUT
+
+
+def _fromfd(fd):
+    "Socket object of an inherited socket fd (see pfserver._exec)."
+    
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    os.close(fd)
+    sock.setblocking(1)
+    return sock
+
 
 class pfserver(object):
     
@@ -62,32 +154,66 @@ class pfserver(object):
         
         self._log.info("loading configuration")
         self._cfg = self._loadconfig(cfg_path)
+        forks.set_launcher(self._cfg['launcher'])
         
-        self._log.info("creating socket for connections")
-        self._cmd_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
-        try:
-            self._cmd_sock.bind(('', CMD_PORT))
-        except socket.error:
-            self._log.warning("socket.bind failed (retrying once) %s" % 
-                traceback.format_exc())
-            time.sleep(BIND_WAITTIME)
-            self._cmd_sock.bind(('', CMD_PORT))
-            self._log.info("now bind worked...")
+        self._restart = False
+        restarted = os.environ.pop(RESTART_ENV, None)
+        info_clients = []
         
-        self._cmd_sock.listen(100)
-        self._cmd_sock.settimeout(ACCEPT_LOOP_TIMEOUT)
+        if restarted is None:
+            # socket activation: command socket first, then info socket
+            socks = pfutil.activated_sockets()
+            if len(socks) > 0:
+                self._log.info("got %d sockets by activation" % len(socks))
+            else:
+                self._log.info("creating socket for connections")
+                socks = [pfutil.listen(CMD_PORT)]
+            if len(socks) < 2:
+                socks.append(pfutil.listen(INFO_PORT))
+            (self._cmd_sock, info_sock) = socks[:2]
+        else:
+            self._log.info("taking over sockets of the last process")
+            socks = [_fromfd(int(fd)) for fd in restarted.split(',')]
+            self._cmd_sock = socks[0]
+            info_sock = socks[1]
+            info_clients = socks[2:]
         
         self._det = pfdetainer.file_detainer(self._cfg['cfg'],
             auto_sync_count = 1)
         
         self._log.info("creating info server")
-        self._info = pfinfo.info_server(INFO_PORT)
+        self._info = pfinfo.info_server(INFO_PORT, sock=info_sock,
+            clients=info_clients)
+        
+        self._resolver = pfutil.resolver_pool(
+            cache=pfutil.resolver_cache(
+                os.path.join(self._cfg['cfg'], pfutil.CACHE_NAME),
+                ttl=self._cfg['resolver-ttl'],
+                size=self._cfg['resolver-cache']))
         
         self._log.info("creating manager")
         self._man = pfmanager.manager(self._cfg, self._det, self._info,
-            load_pending=True, use_info_thread=True)
+            load_pending=True, use_info_thread=True, use_reactor=True,
+            max_active=MAX_ACTIVE_PACKETS, resolver=lambda links:
+                pfscan.resolve_needed(links, self._resolver))
+        
+        self._jobs = {}
+        self._job_ids = []
+        self._next_job = 1
+        self._job_lock = threading.RLock()
+        self._job_queue = Queue.Queue()
+        self._job_thread = threading.Thread(target=self._job_loop,
+            name="Job-Thread")
+        self._job_thread.start()
         
+        if not (restarted is None):
+            # after the pending links (see manager.restore)
+            self._submit(self._restore)
+        
+        self._conns = {}
+        self._cmd_workers = []
+        self._cmd_queue = Queue.Queue()
+        self._replies = Queue.Queue()
         self._running = True
     
     def _loadconfig(self, cfg_path):
@@ -102,7 +228,19 @@ class pfserver(object):
             data = f.read()
             f.close()
         
-        cfg = {}
+        cfg = {'launcher' : DEFAULT_LAUNCHER,
+               'downloader' : DEFAULT_DOWNLOADER,
+               'segments' : {},
+               'bandwidth' : [],
+               'write-buffer' : curl.WRITE_BUFFER_SIZE,
+               'readahead' : False,
+               'error-pages' : dict(pfpacket.ERROR_PAGES),
+               'resolver-ttl' : pfutil.CACHE_TTL,
+               'resolver-cache' : pfutil.CACHE_SIZE,
+               'resolve' : RESOLVE_EARLY,
+               'import-dir' : None,
+               'dl-profile' : forks.parse_profile(DEFAULT_DL_PROFILE),
+               'ex-profile' : forks.parse_profile(DEFAULT_EX_PROFILE)}
         
         for line in data.split('\n'):
             line = line.strip('\r')
@@ -114,6 +252,41 @@ class pfserver(object):
                 cfg['pwd'] = line.lstrip('pwd').strip(' ').split(' ')
             elif line.startswith('cfg'):
                 cfg['cfg'] = line.lstrip('cfg').strip(' ')
+            elif line.startswith('launcher'):
+                cfg['launcher'] = line[len('launcher'):].strip(' ')
+            elif line.startswith('downloader'):
+                cfg['downloader'] = line[len('downloader'):].strip(' ')
+            elif line.startswith('segments'):
+                for item in line[len('segments'):].split():
+                    (host, count) = item.split('=', 1)
+                    cfg['segments'][host] = int(count)
+            elif line.startswith('dl-profile'):
+                cfg['dl-profile'] = forks.parse_profile(
+                    line[len('dl-profile'):])
+            elif line.startswith('ex-profile'):
+                cfg['ex-profile'] = forks.parse_profile(
+                    line[len('ex-profile'):])
+            elif line.startswith('bandwidth'):
+                cfg['bandwidth'] = pfmanager.parse_bandwidth(
+                    line[len('bandwidth'):])
+            elif line.startswith('write-buffer'):
+                cfg['write-buffer'] = curl.parse_rate(
+                    line[len('write-buffer'):])
+            elif line.startswith('readahead'):
+                cfg['readahead'] = (line[len('readahead'):].strip(' ') in
+                    ('on', 'yes', 'true', '1'))
+            elif line.startswith('error-page'):
+                (name, text) = line[len('error-page'):].strip(' ').split(' ',
+                    1)
+                cfg['error-pages'][name] = text
+            elif line.startswith('resolver-ttl'):
+                cfg['resolver-ttl'] = float(line[len('resolver-ttl'):])
+            elif line.startswith('resolver-cache'):
+                cfg['resolver-cache'] = int(line[len('resolver-cache'):])
+            elif line.startswith('resolve'):
+                cfg['resolve'] = line[len('resolve'):].strip(' ')
+            elif line.startswith('import-dir'):
+                cfg['import-dir'] = line[len('import-dir'):].strip(' ')
         
         data = None
         
@@ -132,94 +305,661 @@ class pfserver(object):
     
     def mainloop(self):
         
-        while self._running:
+        self._cmd_sock.setblocking(0)
+        # workers wake the loop up when a reply is ready
+        (self._wake_read, self._wake_write) = os.pipe()
+        fcntl.fcntl(self._wake_read, fcntl.F_SETFL, os.O_NONBLOCK)
+        self._epoll = select.epoll()
+        self._epoll.register(self._cmd_sock.fileno(), select.EPOLLIN)
+        self._epoll.register(self._wake_read, select.EPOLLIN)
+        
+        for i in xrange(COMMAND_WORKERS):
+            worker = threading.Thread(target=self._command_loop,
+                name=("Command-%d" % i))
+            worker.start()
+            self._cmd_workers.append(worker)
+        
+        try:
+            while self._running:
+                try:
+                    ready = self._epoll.poll(self._poll_timeout())
+                except IOError, ex:
+                    # a signal (e.g. of an exiting child)
+                    if ex.errno != errno.EINTR:
+                        raise
+                    ready = []
+                for (fd, events) in ready:
+                    if fd == self._cmd_sock.fileno():
+                        self._accept()
+                    elif fd == self._wake_read:
+                        self._take_replies()
+                    elif fd in self._conns:
+                        self._serve(self._conns[fd], events)
+                self._check_timeouts()
+        except BaseException, ex:
+            self._running = False
+            self._restart = False
+            self._stop()
+            raise ex
+        
+        self._stop()
+    
+    def _stop(self):
+        """ _stop(self)
+        
+        Stops the command server, the workers and the manager. After
+        'restart' the process is replaced by a new one instead (which
+        gets the listening sockets).
+        """
+        
+        if not self._restart:
+            self._cmd_sock.close()
+        for worker in self._cmd_workers:
+            self._cmd_queue.put(None)
+        for worker in self._cmd_workers:
+            worker.join()
+        
+        # last replies (e.g. to 'exit')
+        self._take_replies()
+        for conn in self._conns.values():
+            if conn.out != '':
+                try:
+                    conn.sock.setblocking(1)
+                    conn.sock.settimeout(USER_TIMEOUT)
+                    conn.sock.sendall(conn.out)
+                except socket.error:
+                    pass
+            self._close(conn)
+        
+        self._epoll.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+        self._job_queue.put(None)
+        self._job_thread.join()
+        
+        if self._restart and not self._checkpoint():
+            # children could still write to the parts, just stop
+            self._log.error("restart failed, stopping")
+            self._restart = False
+            self._cmd_sock.close()
+        
+        if self._restart:
+            (info_sock, info_clients) = self._info.handover()
+        
+        self._man.kill()
+        
+        if self._restart:
+            self._exec([self._cmd_sock, info_sock] + info_clients)
+    
+    def _checkpoint(self):
+        """ _checkpoint(self)
+        
+        Stops the packets and saves them for the next process. Returns
+        False if their children didn't stop in time (nothing is saved).
+        """
+        
+        self._log.info("saving packets for restart")
+        states = self._man.checkpoint()
+        if states is None:
+            return False
+        
+        path = os.path.join(self._cfg['cfg'], RESTART_STATE)
+        f = open(path + '.tmp', 'w')
+        try:
+            json.dump(states, f)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+        return True
+    
+    def _restore(self):
+        "Restores the packets saved by the last process (see _checkpoint)."
+        
+        path = os.path.join(self._cfg['cfg'], RESTART_STATE)
+        try:
+            f = open(path, 'r')
+        except IOError:
+            self._log.warning("no saved packets (%s)" % path)
+            return "no saved packets"
+        
+        try:
+            states = json.load(f)
+        finally:
+            f.close()
+        
+        self._log.info("restoring %d packets" % len(states))
+        self._man.restore(states)
+        os.remove(path)
+        return "restored %d packets" % len(states)
+    
+    def _exec(self, socks):
+        """ _exec(self, socks)
+        
+        Replaces this process by a new pfserver (same pid and command
+        line) which inherits the sockets socks, every other fd is closed.
+        """
+        
+        fds = [sock.fileno() for sock in socks]
+        for name in os.listdir('/proc/self/fd'):
+            fd = int(name)
+            if fd <= 2:
+                continue
+            try:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                if fd in fds:
+                    flags &= ~fcntl.FD_CLOEXEC
+                else:
+                    flags |= fcntl.FD_CLOEXEC
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+            except IOError:
+                # the fd of listdir itself
+                pass
+        
+        os.environ[RESTART_ENV] = ",".join([str(fd) for fd in fds])
+        self._log.info("restarting (%s)" % os.environ[RESTART_ENV])
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    
+    def _poll_timeout(self):
+        "Seconds until the next connection times out (at most a second)."
+        
+        timeout = ACCEPT_LOOP_TIMEOUT
+        now = time.time()
+        for conn in self._conns.itervalues():
+            if not conn.busy:
+                timeout = min(timeout, conn.deadline - now)
+        return max(timeout, 0.0)
+    
+    def _accept(self):
+        
+        while True:
             try:
-                conn, address = self._cmd_sock.accept()
-                conn.settimeout(USER_TIMEOUT)
+                (sock, address) = self._cmd_sock.accept()
+            except socket.error, ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(0)
+            conn = _connection(sock)
+            self._conns[sock.fileno()] = conn
+            self._epoll.register(sock.fileno(), select.EPOLLIN)
+    
+    def _close(self, conn):
+        
+        fd = conn.sock.fileno()
+        if fd in self._conns:
+            del self._conns[fd]
+            self._epoll.unregister(fd)
+        # a worker still running its command only returns the reply
+        conn.sock.close()
+    
+    def _serve(self, conn, events):
+        "Reads from or writes to conn (events from epoll)."
+        
+        if events & select.EPOLLOUT:
+            self._flush(conn)
+            return
+        
+        if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            try:
+                data = conn.sock.recv(RECV_SIZE)
+            except socket.error, ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                data = ''
+            
+            if data == '':
+                # the client is gone, a running command is finished anyway
+                conn.gone = conn.busy
+                self._close(conn)
+                return
+            
+            conn.buffer += data
+            conn.deadline = time.time() + conn.timeout()
+            self._dispatch(conn)
+    
+    def _dispatch(self, conn):
+        "Hands the next complete command of conn to a worker."
+        
+        if conn.busy or conn.done:
+            return
+        
+        # only the new data (and the byte before) can hold the delimiter
+        pos = conn.buffer.find(CMD_DELIMITER, max(conn.scanned - 1, 0))
+        if pos < 0:
+            conn.scanned = len(conn.buffer)
+            return
+        
+        data = _parse(conn.buffer[:pos])
+        conn.buffer = conn.buffer[pos + len(CMD_DELIMITER):]
+        conn.scanned = 0
+        
+        if data == ['keep-alive']:
+            conn.persistent = True
+            conn.reply("ok")
+            self._flush(conn)
+            return
+        
+        conn.busy = True
+        if data == ['import']:
+            # the body is read by the worker, the connection is its own
+            fd = conn.sock.fileno()
+            del self._conns[fd]
+            self._epoll.unregister(fd)
+            conn.sock.setblocking(1)
+            conn.sock.settimeout(USER_TIMEOUT)
+        
+        self._cmd_queue.put((conn, data))
+    
+    def _command_loop(self):
+        "Worker, runs commands (None stops it)."
+        
+        item = self._cmd_queue.get()
+        while not (item is None):
+            (conn, data) = item
+            if data == ['import']:
+                self._import_stream(conn)
+            else:
                 try:
-                    self._recvcmd(conn)
-                except socket.timeout:
-                    conn.sendall("connection timeout")
+                    reply = self._execute(data)
                 except Exception, ex:
-                    self._log.debug("recvcmd: Exception ignored: %s"
+                    self._log.debug("command: Exception ignored: %s"
                         % traceback.format_exc())
-                finally:
-                    conn.close()
+                    reply = ''
+                self._replies.put((conn, reply))
+                os.write(self._wake_write, 'x')
+            item = self._cmd_queue.get()
+    
+    def _import_stream(self, conn):
+        "Imports the data following 'import', the client ends it."
+        
+        def chunks():
+            yield conn.buffer
+            recv_buffer = conn.sock.recv(IMPORT_CHUNK_SIZE)
+            while recv_buffer != '':
+                yield recv_buffer
+                recv_buffer = conn.sock.recv(IMPORT_CHUNK_SIZE)
+        
+        try:
+            try:
+                conn.sock.sendall(self._import(chunks()))
             except socket.timeout:
+                conn.sock.sendall("connection timeout")
+        except Exception, ex:
+            self._log.debug("import: Exception ignored: %s"
+                % traceback.format_exc())
+        finally:
+            conn.sock.close()
+    
+    def _take_replies(self):
+        "Queues the replies of the workers for sending."
+        
+        try:
+            while len(os.read(self._wake_read, RECV_SIZE)) == RECV_SIZE:
                 pass
-            except BaseException, ex:
-                self._cmd_sock.close()
-                self._man.kill()
-                self._running = False
-                raise ex
+        except OSError:
+            pass
         
-        self._cmd_sock.close()
-        self._man.kill()
-    
+        while True:
+            try:
+                (conn, reply) = self._replies.get(timeout=0)
+            except Queue.Empty:
+                break
+            conn.busy = False
+            conn.reply(reply)
+            if not conn.gone:
+                self._flush(conn)
     
-    def _recvcmd(self, conn):
-        
-        buffer = ''
-        recv_buffer = conn.recv(RECV_SIZE)
-        while recv_buffer != '':
-            buffer += recv_buffer
-            pos = buffer.find('\n\n')
-            if pos >= 0:
-                data = buffer[0:pos].split(' ', 1)
-                if data[0] == 'add':
-                    links = data[1].split(' ')
-                    links = pfscan.resolve_links(links)
-                    link_count = self._man.padd(links)
-                    conn.sendall("added %d links" % link_count)
-                elif data[0] == 'start':
-                    if self._man.pstart(data[1]):
-                        conn.sendall("ok")
-                    else:
-                        conn.sendall("failed")
-                elif data[0] == 'reset':
-                    if self._man.preset(data[1]):
-                        conn.sendall("resetted %s" % data[1])
-                    else:
-                        conn.sendall("resetting %s failed" % data[1])
-                elif data[0] == 'kill':
-                    if self._man.pkill(data[1]):
-                        conn.sendall("killed %s" % data[1])
-                    else:
-                        conn.sendall("killing %s failed" % data[1])
-                elif data[0] == 'exit-force-bad':
-                    conn.sendall("failed, not implemented")
-                elif data[0] == 'shutdown':
-                    result = pfutil.just_shutdown()
-                    if result:
-                        conn.sendall(result)
-                elif data[0] == 'exit':
-                    self._running = False
-                    conn.sendall("ok, state set")
-                elif data[0] == 'update':
-                    self._man.update_info(force=True)
-                    conn.sendall("ok")
-                elif data[0] == 'get-last-links':
-                    conn.sendall("not imlemented")
-                elif data[0] == 'tmp-add-pwd':
-                    if len(data) > 1:
-                        self._man.tmp_add_pwd(data[1])
-                        conn.sendall("ok")
-                    else:
-                        conn.sendall("failed")
-                elif data[0] == 'pwd-list':
-                    p_list = "\n".join(self._cfg['pwd'])
-                    conn.sendall(p_list)
-                elif data[0] == 'history':
-                    lt = '\n'.join(self._det.get_finished(count = 20))
-                    conn.sendall(lt)
-                else:
-                    conn.sendall("wrong cmd")
+    def _flush(self, conn):
+        """ _flush(self, conn)
+        
+        Sends what's left for conn, when all is sent it's closed (one
+        command per connection) or its next command is dispatched
+        (persistent connections). A client which doesn't read for
+        USER_TIMEOUT is closed (see _check_timeouts).
+        """
+        
+        sent = 0
+        try:
+            sent = conn.sock.send(conn.out)
+            conn.out = conn.out[sent:]
+        except socket.error, ex:
+            if not (ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                self._close(conn)
                 return
-                
+        
+        if conn.out != '':
+            # wait until the client reads, its next commands wait too
+            if sent > 0:
+                conn.deadline = time.time() + USER_TIMEOUT
+            self._epoll.modify(conn.sock.fileno(), select.EPOLLOUT)
+        elif conn.done:
+            self._close(conn)
+        else:
+            conn.deadline = time.time() + conn.timeout()
+            self._epoll.modify(conn.sock.fileno(), select.EPOLLIN)
+            self._dispatch(conn)
+    
+    def _check_timeouts(self):
+        
+        now = time.time()
+        for conn in self._conns.values():
+            if conn.busy or conn.deadline > now:
+                continue
+            if conn.out != '':
+                # the client doesn't read its reply
+                self._close(conn)
+            elif not conn.done:
+                conn.reply("connection timeout")
+                conn.done = True
+                self._flush(conn)
+    
+    def _submit(self, work, *args):
+        """ _submit(self, work, *args)
+        
+        Queues work(*args) (returns the reply), returns the job id.
+        """
+        
+        self._job_lock.acquire()
+        try:
+            job_id = self._next_job
+            self._next_job += 1
+            self._jobs[job_id] = [JOB_QUEUED, '']
+            self._job_ids.append(job_id)
+            
+            # forget the oldest finished jobs
+            finished = [old for old in self._job_ids
+                if self._jobs[old][0] == JOB_DONE]
+            for old in finished[:max(0, len(finished) - JOB_HISTORY)]:
+                self._job_ids.remove(old)
+                del self._jobs[old]
+        finally:
+            self._job_lock.release()
+        
+        self._job_queue.put((job_id, work, args))
+        return job_id
+    
+    def _set_job(self, job_id, state, reply=''):
+        
+        self._job_lock.acquire()
+        try:
+            self._jobs[job_id] = [state, reply]
+        finally:
+            self._job_lock.release()
+    
+    def _job_status(self, job_id):
+        "Returns the reply to 'job <id>'."
+        
+        self._job_lock.acquire()
+        try:
+            if not (job_id in self._jobs):
+                return "unknown job %s" % job_id
+            (state, reply) = self._jobs[job_id]
+        finally:
+            self._job_lock.release()
+        
+        return "\n".join(["job %d %s" % (job_id, state)] +
+            [line for line in [reply] if line != ''])
+    
+    def _job_loop(self):
+        "Runs the queued jobs one after another (None stops it)."
+        
+        item = self._job_queue.get()
+        while not (item is None):
+            (job_id, work, args) = item
+            self._set_job(job_id, JOB_RUNNING)
+            try:
+                reply = work(*args)
+            except Exception, ex:
+                self._log.debug("job %d: %s" % (job_id,
+                    traceback.format_exc()))
+                reply = "failed: %s" % ex
+            self._set_job(job_id, JOB_DONE, reply)
+            item = self._job_queue.get()
+    
+    def _resolve(self, links):
+        """ _resolve(self, links)
+        
+        Resolves links for adding them (see pfscan.resolve_all), if
+        resolve is late links which tell their packet are added as they
+        are (the manager resolves them when the packet starts).
+        """
+        
+        if self._cfg['resolve'] != RESOLVE_LATE:
+            return pfscan.resolve_all(links, self._resolver)
+        
+        early = [link for link in links if
+            pfutil.PACKET_NAME_RE.search(link) is None and
+            pfutil.PACKET_NAME_SIMPLE_RE.search(link) is None]
+        results = dict([(result[0], result) for result in
+            pfscan.resolve_all(early, self._resolver)])
+        return [results.get(link, (link, link, None)) for link in links]
+    
+    def _add(self, links):
+        "Adds links, returns the reply."
+        
+        results = self._resolve(links)
+        link_count = self._man.padd([result for (link, result,
+            error) in results if error is None])
+        lines = ["added %d links" % link_count]
+        for (link, result, error) in results:
+            if not (error is None):
+                lines.append("failed %s: %s" % (link, error))
+        self._update_stats()
+        return "\n".join(lines)
+    
+    def _import_path(self, name):
+        """ _import_path(self, name)
+        
+        Returns the path of file name in the import directory, None if
+        there is none or name is outside of it (clients mustn't read
+        other files of the server).
+        """
+        
+        if self._cfg['import-dir'] is None:
+            return None
+        
+        import_dir = os.path.realpath(self._cfg['import-dir'])
+        path = os.path.realpath(os.path.join(import_dir, name))
+        if not path.startswith(import_dir + os.sep):
+            return None
+        return path
+    
+    def _import_file(self, path):
+        "Imports the links of a file of the server, returns the reply."
+        
+        f = open(path, 'r')
+        try:
+            return self._import(iter(lambda: f.read(IMPORT_CHUNK_SIZE), ''))
+        finally:
+            f.close()
+    
+    def _update_stats(self):
+        "Sends the counters of the resolver cache to the info clients."
+        
+        (hits, misses, entries) = self._resolver.cache.stats()
+        self._info.update_stats({'cache-hits' : hits,
+            'cache-misses' : misses, 'cache-entries' : entries})
+    
+    def _import(self, chunks):
+        """ _import(self, chunks)
+        
+        Adds the links found in chunks (see pfscan.scan_stream), they
+        are resolved IMPORT_BATCH at a time. Links which are already in
+        a packet or pending are skipped. Only the added links are kept
+        (the manager keeps them anyway), a link found again is resolved
+        again (the resolver cache knows it) and skipped then. Returns
+        the reply.
+        """
+        
+        known = self._man.known_links()
+        scanned = 0
+        added = 0
+        failed = []
+        batch = []
+        links = pfscan.scan_stream(chunks)
+        
+        for link in itertools.chain(links, [None]):
+            if not (link is None):
+                scanned += 1
+                batch.append(link)
+                if len(batch) < IMPORT_BATCH:
+                    continue
+            
+            new = []
+            for (link, result, error) in self._resolve(batch):
+                if not (error is None):
+                    failed.append("failed %s: %s" % (link, error))
+                elif not (result in known):
+                    known.add(result)
+                    new.append(result)
+            if len(new) > 0:
+                added += self._man.padd(new)
+            batch = []
+        
+        self._update_stats()
+        return "\n".join(["imported %d of %d links" % (added, scanned)] +
+            failed)
+    
+    def _batch(self, lines):
+        """ _batch(self, lines)
+        
+        Runs 'start', 'kill', 'reset' and 'weight' commands (one per
+        line) with one manager.pbatch call, returns one reply line per
+        command (the reply the command alone would get).
+        """
+        
+        ops = []
+        for line in lines:
+            args = line.split(' ')
+            command = args[0]
+            name = ' '.join(args[1:])
+            weight = None
+            if command == 'weight':
+                name = ' '.join(args[1:-1])
+                try:
+                    weight = float(args[-1])
+                except ValueError:
+                    weight = 0.0
+            ops.append((command, name, weight))
+        
+        replies = []
+        for ((command, name, weight), result) in zip(ops,
+            self._man.pbatch(ops)):
+            if command == 'start':
+                replies.append(result and "ok" or "failed")
+            elif command == 'kill':
+                replies.append(result and "killed %s" % name or
+                    "killing %s failed" % name)
+            elif command == 'reset':
+                replies.append(result and "resetted %s" % name or
+                    "resetting %s failed" % name)
+            elif command == 'weight' and result:
+                replies.append("weight of %s is %s" % (name, weight))
+            elif command == 'weight':
+                replies.append("failed")
+            else:
+                replies.append("wrong cmd")
+        return "\n".join(replies)
+    
+    def _execute(self, data):
+        """ _execute(self, data)
+        
+        Runs a command (data: [name] or [name, arguments]), returns the
+        reply.
+        """
+        
+        if data[0] == 'add':
+            job_id = self._submit(self._add, data[1].split(' '))
+            return "job %d" % job_id
+        elif data[0] == 'job':
+            try:
+                return self._job_status(int(data[1]))
+            except (IndexError, ValueError):
+                return "failed"
+        elif data[0] == 'import':
+            # a file in the import directory ('import' alone: see
+            # _import_stream)
+            path = self._import_path(data[1])
+            if path is None:
+                return "failed"
+            job_id = self._submit(self._import_file, path)
+            return "job %d" % job_id
+        elif data[0] == 'batch':
+            return self._batch(data[1].split('\n'))
+        elif data[0] == 'start':
+            if self._man.pstart(data[1]):
+                return "ok"
+            else:
+                return "failed"
+        elif data[0] == 'reset':
+            if self._man.preset(data[1]):
+                return "resetted %s" % data[1]
+            else:
+                return "resetting %s failed" % data[1]
+        elif data[0] == 'kill':
+            if self._man.pkill(data[1]):
+                return "killed %s" % data[1]
             else:
-                recv_buffer = conn.recv(RECV_SIZE)
-                
-        return
+                return "killing %s failed" % data[1]
+        elif data[0] == 'weight':
+            args = data[1].split(' ')
+            try:
+                weight = float(args[1])
+            except (IndexError, ValueError):
+                weight = 0.0
+            if self._man.pweight(args[0], weight):
+                return "weight of %s is %s" % (args[0], weight)
+            else:
+                return "failed"
+        elif data[0] == 'rates':
+            (total, rates) = self._man.rates()
+            lines = ["total %s" % curl.format_rate(total)]
+            for (name, rate) in sorted(rates.items()):
+                lines.append("%s %s" % (name, curl.format_rate(rate)))
+            return "\n".join(lines)
+        elif data[0] == 'clients':
+            # info clients: unsent bytes and for how long, coalesced
+            (clients, dropped) = self._info.client_stats()
+            lines = ["dropped %d" % dropped]
+            for (address, queued, lag, coalesced, sent) in clients:
+                lines.append("%s:%d queued %d lag %.1fs coalesced %d "
+                    "sent %d" % (address + (queued, lag, coalesced, sent)))
+            return "\n".join(lines)
+        elif data[0] == 'exit-force-bad':
+            return "failed, not implemented"
+        elif data[0] == 'shutdown':
+            return pfutil.just_shutdown()
+        elif data[0] == 'exit':
+            self._running = False
+            os.write(self._wake_write, 'x')
+            return "ok, state set"
+        elif data[0] == 'restart':
+            # new code and config, downloads are resumed (see _stop)
+            self._restart = True
+            self._running = False
+            os.write(self._wake_write, 'x')
+            return "ok, restarting"
+        elif data[0] == 'update':
+            self._man.update_info(force=True)
+            return "ok"
+        elif data[0] == 'get-last-links':
+            return "not imlemented"
+        elif data[0] == 'tmp-add-pwd':
+            if len(data) > 1:
+                self._man.tmp_add_pwd(data[1])
+                return "ok"
+            else:
+                return "failed"
+        elif data[0] == 'pwd-list':
+            p_list = "\n".join(self._cfg['pwd'])
+            return p_list
+        elif data[0] == 'history':
+            lt = '\n'.join(self._det.get_finished(count = 20))
+            return lt
+        else:
+            return "wrong cmd"
 
 
 def main(args):
@@ -6,6 +6,7 @@ import re
 import os
 import time
 import subprocess
+import collections
 
 import curl
 
@@ -18,56 +19,331 @@ LINK_FINDER_RE = re.compile(LINK_FINDER_STR)
 PACKET_NAME_RE = re.compile(".*/([^/]*)[.]{1}part\\d+[.]{1}rar")
 PACKET_NAME_SIMPLE_RE = re.compile(".*/([^/]*)[.]{1}rar")
 FILENAME_RE = re.compile(".*/([^/]*)")
+# the first link after the first form action
+FORM_ACTION_RE = re.compile("form action")
+FORM_LINK_RE = re.compile("form action.*?" + LINK_FINDER_STR, re.S)
+HOST_RE = re.compile("[a-z]+://([^/:]+)")
+# link resolution: threads at all and requests per host at once
+RESOLVE_WORKERS = 8
+RESOLVE_HOST_LIMIT = 4
+NO_LINK_MSG = "no link found"
+# resolved links are kept for a day, at most this many
+CACHE_NAME = 'resolver-cache'
+CACHE_TTL = 24 * 3600.0
+CACHE_SIZE = 1000
+# a port which is still in use (not just in TIME_WAIT) is tried again
+BIND_RETRIES = 10
+BIND_RETRY_WAIT = 0.5
+# socket activation (see activated_sockets), fds start at 3
+LISTEN_FDS_START = 3
 
-def resolve_links(links):
+
+class resolver_cache(object):
+    """ resolver_cache(path=None, ttl=CACHE_TTL, size=CACHE_SIZE)
+    
+    Maps links to resolved links, entries expire after ttl seconds and
+    the least recently used are dropped if there are more than size.
+    If path is set the cache is loaded from it and written back by sync
+    (one 'time link resolved-link' line per entry, least recently used
+    first).
+    """
+    
+    def __init__(self, path=None, ttl=CACHE_TTL, size=CACHE_SIZE):
+        
+        self._path = path
+        self._ttl = ttl
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._changed = False
+        self._hits = 0
+        self._misses = 0
+        
+        if not (path is None) and os.path.exists(path):
+            self._load()
+    
+    def _load(self):
+        
+        now = time.time()
+        f = open(self._path, 'r')
+        try:
+            for line in f:
+                fields = line.rstrip('\r\n').split(' ')
+                if len(fields) != 3:
+                    continue
+                try:
+                    stored = float(fields[0])
+                except ValueError:
+                    continue
+                if stored + self._ttl > now:
+                    self._entries.pop(fields[1], None)
+                    self._entries[fields[1]] = (stored, fields[2])
+        finally:
+            f.close()
+        
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+    
+    def get(self, link):
+        "Returns the resolved link (None if it isn't cached or expired)."
+        
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(link, None)
+            if entry is None or entry[0] + self._ttl <= time.time():
+                if not (entry is None):
+                    self._changed = True
+                self._misses += 1
+                return None
+            
+            # most recently used go to the end
+            self._entries[link] = entry
+            self._hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+    
+    def put(self, link, resolved):
+        
+        self._lock.acquire()
+        try:
+            self._entries.pop(link, None)
+            if self._size > 0:
+                self._entries[link] = (time.time(), resolved)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+            self._changed = True
+        finally:
+            self._lock.release()
+    
+    def sync(self):
+        "Writes the cache to its file (if it has one and has changed)."
+        
+        self._lock.acquire()
+        try:
+            if self._path is None or not self._changed:
+                return
+            
+            tmp_path = self._path + '.tmp'
+            f = open(tmp_path, 'w')
+            try:
+                for (link, (stored, resolved)) in self._entries.iteritems():
+                    f.write("%.3f %s %s\n" % (stored, link, resolved))
+            finally:
+                f.close()
+            os.rename(tmp_path, self._path)
+            self._changed = False
+        finally:
+            self._lock.release()
+    
+    def stats(self):
+        "Returns (hits, misses, entries)."
+        
+        self._lock.acquire()
+        try:
+            return (self._hits, self._misses, len(self._entries))
+        finally:
+            self._lock.release()
+
+
+class resolver_pool(object):
+    """ resolver_pool(workers=RESOLVE_WORKERS,
+                      host_limit=RESOLVE_HOST_LIMIT, cache=None)
+    
+    Resolves links with up to workers threads, at most host_limit
+    pages are fetched from one host at once (see match). Links found in
+    cache (resolver_cache) aren't resolved again.
+    """
+    
+    def __init__(self, workers=RESOLVE_WORKERS,
+        host_limit=RESOLVE_HOST_LIMIT, cache=None):
+        
+        self._workers = workers
+        self._host_limit = host_limit
+        self.cache = cache
+        self._hosts = {}
+        self._lock = threading.Lock()
+    
+    def _host_slot(self, link):
+        
+        result = HOST_RE.match(link)
+        host = ''
+        if not (result is None):
+            host = result.group(1).lower()
+        
+        self._lock.acquire()
+        try:
+            if not (host in self._hosts):
+                self._hosts[host] = threading.Semaphore(self._host_limit)
+            return self._hosts[host]
+        finally:
+            self._lock.release()
+    
+    def match(self, link, expr, *args, **options):
+        """ match(self, link, expr, *args, **options)
+        
+        curl.match_download, but waits while host_limit pages are
+        fetched from the host of link.
+        """
+        
+        slot = self._host_slot(link)
+        slot.acquire()
+        try:
+            return curl.match_download(link, expr, *args, **options)
+        finally:
+            slot.release()
+    
+    def map(self, resolve, links):
+        """ map(self, resolve, links)
+        
+        Calls resolve(self, link) for all links, resolve should use
+        self.match to download pages. Returns a list of
+        (link, result, error) in the order of links, error is None if
+        resolve returned something other than None (else NO_LINK_MSG or
+        the message of the exception it raised).
+        """
+        
+        results = [None] * len(links)
+        todo = Queue.Queue()
+        for (i, link) in enumerate(links):
+            cached = None
+            if not (self.cache is None):
+                cached = self.cache.get(link)
+            if cached is None:
+                todo.put((i, link))
+            else:
+                results[i] = (link, cached, None)
+        
+        def work():
+            while True:
+                try:
+                    (i, link) = todo.get(timeout=0)
+                except Queue.Empty:
+                    return
+                try:
+                    result = resolve(self, link)
+                    error = None
+                    if result is None:
+                        error = NO_LINK_MSG
+                except Exception, ex:
+                    result = None
+                    error = str(ex) or ex.__class__.__name__
+                if not (result is None or self.cache is None):
+                    self.cache.put(link, result)
+                results[i] = (link, result, error)
+        
+        threads = [threading.Thread(target=work, name="Resolver-Thread")
+            for i in xrange(min(self._workers, todo.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        if not (self.cache is None):
+            self.cache.sync()
+        return results
+
+
+def resolve_links(links, pool=None):
     "Scans data and finds links, converts them to rapidshare-links."
     
-    def __sjdecode(link):
+    def __sjdecode(pool, link):
         "Extract Rapidshare link from Serienjunkies."
         
-        site = curl.simple_download(link, '-L')
-        result = LINK_FINDER_RE.search(site)
+        (result, site) = pool.match(link, LINK_FINDER_RE, '-L')
         if result is None:
             return ''
         else:
             return "".join(result.groups())
     
-    def __rsdecode(link):
+    def __rsdecode(pool, link):
         "Prepare Rapidshare link for final download."
         
         if link == '':
             return ''
         
-        site = curl.simple_download(link, '-L')
-        pos = site.find("form action")
-        
-        if pos != -1:
-            site = site[pos:]
-        
-        item = LINK_FINDER_RE.search(site)
+        # same groups as LINK_FINDER_RE, the link can be far away from
+        # the form action
+        (item, site) = pool.match(link, FORM_LINK_RE, '-L',
+            anchor=FORM_ACTION_RE)
         if item is None:
-            return ''
+            if not (FORM_ACTION_RE.search(site) is None):
+                # a form without a link (in the part which was read)
+                return ''
+            # no form, take the first link of the page
+            item = LINK_FINDER_RE.search(site)
+            if item is None:
+                return ''
         
         path = os.path.split(item.group(2))
         link_end = os.path.join(path[0], 'dl', path[1])
         link = "".join(("http://", item.group(1), link_end))
         return link
     
-    resolved_links = []
+    def __decode(pool, link):
         
-    for link in links:
         if link.startswith("http://download.serienjunkies.org"):
-            link = __sjdecode(link)
-            link = __rsdecode(link)
-            if link != '':
-                resolved_links.append(link)
-                
+            link = __rsdecode(pool, __sjdecode(pool, link))
         elif link.startswith("http://rapidshare.com"):
-            link = __rsdecode(link)
-            if link != '':
-                resolved_links.append(link)
+            link = __rsdecode(pool, link)
+        else:
+            return None
         
-    return resolved_links
+        if link == '':
+            return None
+        return link
+    
+    if pool is None:
+        pool = resolver_pool()
+    
+    return [result for (link, result, error) in pool.map(__decode, links)
+        if not (result is None)]
+
+def listen(port, backlog=100):
+    """ listen(port, backlog=100)
+    
+    Returns a socket listening on port. The address is reused, so a
+    port in TIME_WAIT (left by the last server) can be bound right
+    away; if another process still listens on it, binding is retried
+    BIND_RETRIES times.
+    """
+    
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    
+    for i in xrange(BIND_RETRIES):
+        try:
+            sock.bind(('', port))
+            break
+        except socket.error:
+            if i == BIND_RETRIES - 1:
+                sock.close()
+                raise
+            time.sleep(BIND_RETRY_WAIT)
+    
+    sock.listen(backlog)
+    return sock
+
+def activated_sockets():
+    """ activated_sockets()
+    
+    Returns the listening sockets passed by a service manager (socket
+    activation: LISTEN_PID and LISTEN_FDS, e.g. systemd) in their
+    order, an empty list if there aren't any.
+    """
+    
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return []
+    
+    count = int(os.environ.get('LISTEN_FDS', '0'))
+    del os.environ['LISTEN_PID']
+    os.environ.pop('LISTEN_FDS', None)
+    
+    socks = []
+    for fd in xrange(LISTEN_FDS_START, LISTEN_FDS_START + count):
+        socks.append(socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM))
+        os.close(fd)
+    return socks
 
 def shutdown():
     args = ['smbstatus', '--locks']
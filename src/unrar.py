@@ -1,4 +1,5 @@
 import re
+import os
 
 import forks
 
@@ -7,16 +8,32 @@ UNRAR_PERCENT = re.compile("(\\d+)%")
 UNRAR_MISSING_VOLUME = re.compile("Cannot find volume ([A-Za-z0-9,\\/, ,\\.,_,\\-,\\,,#]+)")
 UNRAR_ALL_OK = re.compile("All OK")
 UNRAR_NOOPEN = re.compile("Cannot open ([A-Za-z0-9,\\/, ,\\.,_,\\-,\\,,#]+)")
+UNRAR_VOLUME = re.compile("Extracting from (.+)")
 
 STATUS_PERCENT = 'percent'
 STATUS_OK = 'success'
 STATUS_MSG = 'status'
 
 DEFAULT_WAITTIME = 0.01
+UNRAR_DELIMITERS = '\r\n\x08'
+MIN_CALLBACK_INTERVAL = 0.25
 
 def _mklist(*elements):
     return elements
 
+def _prefetch(path):
+    "Starts reading file path into the page cache (unrar needs it soon)."
+    
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    
+    try:
+        forks.fadvise(fd, 0, 0, forks.FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
 class UnrarSpoon(forks.Spoon):
     """ UnrarSpoon
     
@@ -36,51 +53,74 @@ class UnrarSpoon(forks.Spoon):
     threading.RLock() for example...
     """
     
-    def __init__(self, filepath, dst_dir, pwd):
-        """"__init__(self, filepath, dst_dir, pwd)
+    def __init__(self, filepath, dst_dir, pwd, profile=None, volumes=None):
+        """"__init__(self, filepath, dst_dir, pwd, profile=None,
+                     volumes=None)
         
         starts extraction of filepath (absolut path) to dst_dir with 
         pwd (password)
         Note that this class will always use a password... (ugly)
+        Profile (forks.ResourceProfile) is applied to the unrar process.
+        Volumes is the ordered list of all volumes (absolut paths), if it
+        is set, the next volume is read ahead while unrar is busy with
+        the current one.
         """
         
         forks.Spoon.__init__(self)
         self._status[STATUS_MSG] = 'extracting'
         self._status[STATUS_PERCENT] = 0
         self._status[STATUS_OK] = False
+        self.set_callback_policy(min_interval=MIN_CALLBACK_INTERVAL,
+            changes_only=True)
         
         self._err_crc = None
         self._err_miss = None
         self._no_open = None
         self._line = ''
+        self._volumes = volumes
+        
+        if volumes:
+            _prefetch(volumes[0])
         
         args = ['unrar', '-ierr', 'e', '-o+', '-p' + pwd, filepath]
-        self.start(args, use_stderr=True, cwd=dst_dir)
+        self.start(args, use_stderr=True, cwd=dst_dir, profile=profile)
     
     def _read_line(self):
         
-        while self._status[forks.STREAM_OPEN]:
-            ch = self.read_char(wait=DEFAULT_WAITTIME)
+        result = False
+        
+        for (data, delim) in self.read_frames(UNRAR_DELIMITERS,
+            wait=DEFAULT_WAITTIME):
             
-            if ch == '\r' or ch == '\n':
-                self._update_line()
-                self._line = ''
-                return True
-            elif ch == '\x08':
+            self._line += data
+            
+            if delim == '\x08':
                 re_percent = UNRAR_PERCENT.search(self._line)
-        
+                
                 if not (re_percent is None):
                     self._status[STATUS_PERCENT] = int(re_percent.group(1))
                     self._line = self._line[re_percent.end():]
-                    return True
-            elif ch != '':
-                self._line += ch
+                    result = True
+            else:
+                self._update_line()
+                self._line = ''
+                result = True
         
-        return False
+        return result
     
     def _update(self):
         self._read_line()
     
+    def _read_ahead(self, volume):
+        "Unrar has started reading volume, prefetches the next one."
+        
+        names = [os.path.basename(path) for path in self._volumes]
+        name = os.path.basename(volume)
+        if name in names:
+            index = names.index(name)
+            if index + 1 < len(self._volumes):
+                _prefetch(self._volumes[index + 1])
+    
     def _update_line(self):
         
         re_error = UNRAR_CRC_ERROR.search(self._line)
@@ -89,6 +129,11 @@ class UnrarSpoon(forks.Spoon):
         re_percent = UNRAR_PERCENT.search(self._line)
         re_noopen = UNRAR_NOOPEN.search(self._line)
         
+        if self._volumes:
+            re_volume = UNRAR_VOLUME.search(self._line)
+            if not (re_volume is None):
+                self._read_ahead(re_volume.group(1).strip())
+        
         if not (re_percent is None):
             self._status[STATUS_PERCENT] = int(re_percent.group(1))
         